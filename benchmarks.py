@@ -0,0 +1,709 @@
+import argparse
+import gc
+import itertools
+import math
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, func, insert, update
+from sqlalchemy.orm import sessionmaker
+
+import servicios
+
+RUTA_APLICACION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+def base_temporal(directorio, productos=500, perfil=None):
+    engine = servicios.crear_engine(f"sqlite:///{os.path.join(directorio, 'bench.db')}", perfil)
+    servicios.preparar_base_datos(engine)
+    Sesion = sessionmaker(bind=engine)
+    with Sesion() as sesion:
+        caja = servicios.Caja(monto_apertura=0)
+        sesion.add(caja)
+        sesion.add_all(
+            servicios.Producto(nombre=f"Producto {i}", precio_compra=1, precio_venta=2,
+                          stock=10 ** 9, codigo_barras=f"B{i:06d}")
+            for i in range(productos)
+        )
+        sesion.commit()
+        caja_id = caja.id
+    return engine, Sesion, caja_id
+
+def carrito_aleatorio(rng, productos, lineas):
+    return [
+        {"producto_id": producto_id, "cantidad": 1, "subtotal": 2.0}
+        for producto_id in rng.sample(range(1, productos + 1), lineas)
+    ]
+
+def bench_checkout(args):
+    rng = random.Random(args.semilla)
+    print(f"{'lineas':>8} {'ventas':>8} {'ventas/s':>10} {'ms/venta':>10}")
+    for lineas in args.lineas:
+        with tempfile.TemporaryDirectory() as directorio:
+            engine, Sesion, caja_id = base_temporal(directorio, args.productos)
+            carritos = [carrito_aleatorio(rng, args.productos, lineas) for _ in range(args.ventas)]
+            with Sesion() as sesion:
+                inicio = time.perf_counter()
+                for carrito in carritos:
+                    servicios.registrar_venta(sesion, caja_id, carrito)
+                duracion = time.perf_counter() - inicio
+            engine.dispose()
+        print(f"{lineas:>8} {args.ventas:>8} {args.ventas / duracion:>10.1f} {duracion * 1000 / args.ventas:>10.2f}")
+
+def consulta_reporte_caja(caja_id):
+    # Misma forma que el reporte de cierre: detalle y totales por producto
+    detalle = select(servicios.Venta.id, servicios.Venta.fecha, servicios.Producto.nombre,
+                     servicios.DetalleVenta.cantidad, servicios.DetalleVenta.subtotal)\
+        .join(servicios.DetalleVenta, servicios.Venta.id == servicios.DetalleVenta.venta_id)\
+        .join(servicios.Producto, servicios.Producto.id == servicios.DetalleVenta.producto_id)\
+        .where(servicios.Venta.caja_id == caja_id, servicios.Venta.estado == servicios.VENTA_ACTIVA).order_by(servicios.Venta.fecha)
+    resumen = select(servicios.Producto.nombre, func.sum(servicios.DetalleVenta.cantidad), func.sum(servicios.DetalleVenta.subtotal))\
+        .join(servicios.DetalleVenta, servicios.Producto.id == servicios.DetalleVenta.producto_id)\
+        .join(servicios.Venta, servicios.Venta.id == servicios.DetalleVenta.venta_id)\
+        .where(servicios.Venta.caja_id == caja_id, servicios.Venta.estado == servicios.VENTA_ACTIVA).group_by(servicios.Producto.nombre)
+    return detalle, resumen
+
+def bench_perfiles(args):
+    rng = random.Random(args.semilla)
+    carritos = [carrito_aleatorio(rng, args.productos, args.lineas) for _ in range(args.ventas)]
+    print(f"{'perfil':>12} {'ventas/s':>10} {'ms/reporte':>12}")
+    for perfil in args.perfiles:
+        with tempfile.TemporaryDirectory() as directorio:
+            engine, Sesion, caja_id = base_temporal(directorio, args.productos, perfil)
+            with Sesion() as sesion:
+                inicio = time.perf_counter()
+                for carrito in carritos:
+                    servicios.registrar_venta(sesion, caja_id, carrito)
+                duracion_ventas = time.perf_counter() - inicio
+            detalle, resumen = consulta_reporte_caja(caja_id)
+            inicio = time.perf_counter()
+            for _ in range(args.reportes):
+                with engine.connect() as conn:
+                    conn.execute(detalle).all()
+                    conn.execute(resumen).all()
+            duracion_reportes = time.perf_counter() - inicio
+            engine.dispose()
+        print(f"{perfil:>12} {args.ventas / duracion_ventas:>10.1f} {duracion_reportes * 1000 / args.reportes:>12.2f}")
+
+LOTE_SIEMBRA = 10000
+
+def sembrar_detalle(engine, caja_id, lineas, productos, lineas_por_venta):
+    # Alta masiva directa, sin registrar_venta: solo hacen falta líneas que reportar
+    ventas = servicios.Venta.__table__
+    detalle = servicios.DetalleVenta.__table__
+    num_ventas = -(-lineas // lineas_por_venta)
+    inicio = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        for desde in range(1, num_ventas + 1, LOTE_SIEMBRA):
+            ids = range(desde, min(desde + LOTE_SIEMBRA, num_ventas + 1))
+            conn.execute(insert(ventas), [
+                {"id": i, "fecha": inicio + timedelta(minutes=i), "total": 2 * lineas_por_venta,
+                 "caja_id": caja_id, "estado": servicios.VENTA_ACTIVA}
+                for i in ids
+            ])
+            conn.execute(insert(detalle), [
+                {"venta_id": i, "producto_id": (i * lineas_por_venta + j) % productos + 1,
+                 "cantidad": 1, "subtotal": 2, "costo": 1}
+                for i in ids for j in range(lineas_por_venta)
+            ])
+    return num_ventas * lineas_por_venta
+
+# El hijo informa su propio VmHWM (Linux): el ru_maxrss de un hijo hereda el
+# pico del proceso padre, que acaba de sembrar la base
+MEDIR_REPORTE = (
+    "import sys, servicios\n"
+    "servicios.iniciar_base_datos()\n"
+    "servicios.escribir_reporte_ventas(sys.argv[1])\n"
+    "pico = next(l for l in open('/proc/self/status') if l.startswith('VmHWM'))\n"
+    "print(pico.split()[1], file=sys.stderr)\n"
+)
+
+def escribir_reporte_medido(url, destino, perfil=None):
+    # Cada reporte en un proceso aparte para medir solo su pico de memoria
+    entorno = dict(os.environ, SALUS_DATABASE_URL=url, PYTHONPATH=os.path.dirname(RUTA_APLICACION))
+    if perfil:
+        entorno["SALUS_PERFIL_ALMACENAMIENTO"] = perfil
+    inicio = time.perf_counter()
+    proceso = subprocess.run([sys.executable, "-c", MEDIR_REPORTE, destino], env=entorno,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    duracion = time.perf_counter() - inicio
+    if proceso.returncode:
+        raise RuntimeError(f"El reporte {destino} falló: {proceso.stderr.strip()}")
+    return duracion, int(proceso.stderr.split()[-1]) / 1024
+
+def bench_reporte(args):
+    print(f"{'lineas':>10} {'formato':>8} {'segundos':>10} {'MB pico':>9} {'MB archivo':>11}")
+    for lineas in args.lineas:
+        with tempfile.TemporaryDirectory() as directorio:
+            engine, Sesion, caja_id = base_temporal(directorio, args.productos)
+            lineas = sembrar_detalle(engine, caja_id, lineas, args.productos, args.lineas_por_venta)
+            with Sesion() as sesion:
+                servicios.reconstruir_ventas_diarias(sesion)
+            url = str(engine.url)
+            engine.dispose()
+            for formato in args.formatos:
+                destino = os.path.join(directorio, f"reporte.{formato}")
+                duracion, pico = escribir_reporte_medido(url, destino, args.perfil)
+                tamano = sum(os.path.getsize(os.path.join(directorio, f)) for f in os.listdir(directorio)
+                             if f.startswith("reporte") and f.endswith(formato))
+                print(f"{lineas:>10} {formato:>8} {duracion:>10.1f} {pico:>9.1f} {tamano / 2 ** 20:>11.1f}")
+
+def bench_arranque(args):
+    # Arranca la aplicación real con la traza activa y la cierra en cuanto
+    # termina de abrir la base; informa la mediana de cada etapa
+    with tempfile.TemporaryDirectory() as directorio:
+        engine, _, _ = base_temporal(directorio, args.productos)
+        url = str(engine.url)
+        engine.dispose()
+        entorno = dict(os.environ, SALUS_DATABASE_URL=url, SALUS_TRAZA_ARRANQUE="1",
+                       SALUS_SALIR_TRAS_ARRANQUE="1")
+        etapas = {}
+        for _ in range(args.repeticiones):
+            proceso = subprocess.run([sys.executable, RUTA_APLICACION], env=entorno, cwd=directorio,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=60)
+            if proceso.returncode:
+                raise SystemExit(f"La aplicación terminó con código {proceso.returncode}:\n{proceso.stderr}")
+            for etapa, ms in re.findall(r"^\[arranque\] (.+): (\d+) ms$", proceso.stderr, re.MULTILINE):
+                etapas.setdefault(etapa, []).append(int(ms))
+    print(f"{'etapa':>20} {'mediana ms':>11} {'máximo ms':>10}")
+    for etapa, tiempos in etapas.items():
+        print(f"{etapa:>20} {statistics.median(tiempos):>11.0f} {max(tiempos):>10}")
+    pintado = statistics.median(etapas.get("primer pintado", [float("inf")]))
+    if pintado > args.limite_ms:
+        raise SystemExit(f"Primer pintado en {pintado:.0f} ms, por encima del límite de {args.limite_ms} ms")
+
+def memoria_residente_mb():
+    linea = next(l for l in open("/proc/self/status") if l.startswith("VmRSS"))
+    return int(linea.split()[1]) / 1024
+
+def sesiones_vivas():
+    return sum(isinstance(objeto, servicios.Session) for objeto in gc.get_objects())
+
+def bench_soak(args):
+    # Simula un turno largo en la aplicación real (sin pantalla): ventas por
+    # escáner, búsquedas, cambios de módulo y cancelaciones. La memoria debe
+    # quedar plana una vez que las pantallas y las cachés están armadas
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    import main
+    rng = random.Random(args.semilla)
+    with tempfile.TemporaryDirectory() as directorio:
+        os.environ["SALUS_DIRECTORIO_REPORTES"] = os.path.join(directorio, "reportes")
+        engine, _, _ = base_temporal(directorio, args.productos)
+        url = str(engine.url)
+        engine.dispose()
+        os.environ["SALUS_DATABASE_URL"] = url
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        ventana = main.VentanaPrincipal()
+        ventana.iniciar_datos()
+        navegar = [ventana.mostrar_productos, ventana.mostrar_inventario, ventana.mostrar_ventas,
+                   ventana.mostrar_ventas_realizadas, ventana.mostrar_caja, ventana.mostrar_devoluciones]
+        ventana.mostrar_ventas()
+        ventas = ventana.modulos[main.VentanaVentas]
+        print(f"{'operaciones':>12} {'RSS MB':>8} {'sesiones':>9} {'ops/s':>8}")
+        muestras = []
+        inicio = tramo = time.perf_counter()
+        for operacion in range(1, args.operaciones + 1):
+            tipo = rng.random()
+            if tipo < 0.4:
+                ventana.mostrar_ventas()
+                for _ in range(rng.randint(1, 5)):
+                    ventas.scanLineEdit.setText(f"B{rng.randrange(args.productos):06d}")
+                    ventas.agregar_por_codigo()
+                ventas.realizar_venta()
+            elif tipo < 0.7:
+                ventana.mostrar_ventas()
+                ventas.busquedaLineEdit.setText(f"Producto {rng.randrange(args.productos)}")
+                ventas.temporizadorBusqueda.stop()
+                ventas.solicitarProductos()
+            elif tipo < 0.9:
+                rng.choice(navegar)()
+            else:
+                with servicios.sesion_operacion() as sesion:
+                    venta_id = sesion.scalar(
+                        select(servicios.Venta.id).where(servicios.Venta.estado == servicios.VENTA_ACTIVA)
+                        .order_by(func.random()).limit(1)
+                    )
+                    if venta_id:
+                        servicios.cancelar_venta(sesion, venta_id, "soak")
+            app.processEvents()
+            if operacion % args.muestra == 0:
+                main.obtener_cola_reportes().pool.waitForDone()
+                app.processEvents()
+                gc.collect()
+                ahora = time.perf_counter()
+                muestras.append(memoria_residente_mb())
+                print(f"{operacion:>12} {muestras[-1]:>8.1f} {sesiones_vivas():>9} "
+                      f"{args.muestra / (ahora - tramo):>8.1f}")
+                tramo = ahora
+        duracion = time.perf_counter() - inicio
+        ventana.close()
+        servicios.engine.dispose()
+    # La primera muestra incluye el calentamiento (módulos, cachés, pool)
+    crecimiento = muestras[-1] - muestras[0] if muestras else 0
+    print(f"{args.operaciones} operaciones en {duracion:.1f} s; "
+          f"crecimiento tras la primera muestra: {crecimiento:.1f} MB")
+    if crecimiento > args.limite_mb:
+        raise SystemExit(f"La memoria creció {crecimiento:.1f} MB, por encima del límite de {args.limite_mb} MB")
+
+def repartir_en_cajas(engine, cajas):
+    # Reparte las ventas sembradas en turnos cerrados consecutivos y recalcula
+    # sus acumulados como los habría dejado registrar_venta
+    ventas = servicios.Venta.__table__
+    caja = servicios.Caja.__table__
+    with engine.begin() as conn:
+        num_ventas = conn.scalar(select(func.max(ventas.c.id)))
+        ids = conn.scalars(insert(caja).returning(caja.c.id, sort_by_parameter_order=True),
+                           [{"monto_apertura": 0} for _ in range(cajas)]).all()
+        por_caja = -(-num_ventas // cajas)
+        for i, caja_id in enumerate(ids):
+            conn.execute(update(ventas).where(ventas.c.id.between(i * por_caja + 1, (i + 1) * por_caja))
+                         .values(caja_id=caja_id))
+        del_turno = lambda columna: select(columna).where(ventas.c.caja_id == caja.c.id).scalar_subquery()
+        conn.execute(update(caja).where(caja.c.id.in_(ids)).values(
+            fecha_apertura=del_turno(func.min(ventas.c.fecha)),
+            fecha_cierre=del_turno(func.max(ventas.c.fecha)),
+            num_ventas=del_turno(func.count()),
+            total_bruto=del_turno(func.sum(ventas.c.total)),
+            total_ventas=del_turno(func.sum(ventas.c.total)),
+            monto_cierre=del_turno(func.sum(ventas.c.total)),
+        ))
+    return ids
+
+def percentil(valores, p):
+    # Rango más cercano: con pocas repeticiones no inventa valores intermedios
+    ordenados = sorted(valores)
+    return ordenados[max(math.ceil(p / 100 * len(ordenados)) - 1, 0)]
+
+def medir(tiempos, operacion, funcion, *args):
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    tiempos.setdefault(operacion, []).append((time.perf_counter() - inicio) * 1000)
+    return resultado
+
+def en_operacion(servicio, *args):
+    # Igual que en la aplicación: una sesión por operación del usuario
+    with servicios.sesion_operacion() as sesion:
+        return servicio(sesion, *args)
+
+# p95 aceptable en ms para la base por defecto (10k productos, 1M líneas)
+LIMITES_P95_MS = {
+    "búsqueda": 20,
+    "alta de stock": 20,
+    "venta": 30,
+    "cancelación": 30,
+    "apertura de caja": 20,
+    "cierre de caja": 20,
+    "totales del historial": 200,
+    "resumen de ventas": 600,
+    "datos de reporte": 1000,
+    "exportación de reporte": 5000,
+}
+
+def limite_argumento(valor):
+    operacion, _, ms = valor.rpartition("=")
+    if operacion not in LIMITES_P95_MS:
+        raise argparse.ArgumentTypeError(f"Operación desconocida: {operacion}")
+    return operacion, float(ms)
+
+def fecha_argumento(valor):
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fecha inválida: {valor} (se espera AAAA-MM-DD)")
+
+def bench_servicios(args):
+    # Latencia de las operaciones de la aplicación, sin interfaz, sobre una base
+    # sintética grande: el p95 de cada una se compara con LIMITES_P95_MS
+    rng = random.Random(args.semilla)
+    tiempos = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        inicio = time.perf_counter()
+        engine, Sesion, caja_id = base_temporal(directorio, args.productos)
+        sembrar_detalle(engine, caja_id, args.lineas, args.productos, args.lineas_por_venta)
+        cajas = repartir_en_cajas(engine, args.cajas)
+        with Sesion() as sesion:
+            servicios.reconstruir_ventas_diarias(sesion)
+        url = str(engine.url)
+        engine.dispose()
+        print(f"Base sembrada en {time.perf_counter() - inicio:.1f} s: {args.productos} productos, "
+              f"{args.lineas} líneas en {len(cajas)} cajas")
+        servicios.iniciar_base_datos(url)
+        with servicios.sesion_operacion() as sesion:
+            activas = sesion.scalars(select(servicios.Venta.id)).all()
+        for _ in range(args.repeticiones):
+            medir(tiempos, "búsqueda", en_operacion, servicios.buscar_productos,
+                  f"Producto {rng.randrange(args.productos)}")
+            medir(tiempos, "alta de stock", en_operacion, servicios.registrar_entrada_inventario,
+                  rng.randrange(1, args.productos + 1), 10)
+            medir(tiempos, "venta", en_operacion, servicios.registrar_venta, caja_id,
+                  carrito_aleatorio(rng, args.productos, args.lineas_por_venta))
+            medir(tiempos, "cancelación", en_operacion, servicios.cancelar_venta,
+                  activas.pop(rng.randrange(len(activas))), "benchmark")
+            desde = datetime(2024, 1, 1) + timedelta(days=rng.randrange(120))
+            condiciones = (servicios.Venta.fecha >= desde, servicios.Venta.fecha < desde + timedelta(days=30))
+            medir(tiempos, "totales del historial", en_operacion, servicios.totales_ventas, *condiciones)
+            medir(tiempos, "resumen de ventas", en_operacion, servicios.resumen_ventas,
+                  desde.date(), (desde + timedelta(days=30)).date())
+        medir(tiempos, "cierre de caja", en_operacion, servicios.cerrar_caja, caja_id)
+        for _ in range(args.repeticiones):
+            nueva = medir(tiempos, "apertura de caja", en_operacion, servicios.abrir_caja, 0)
+            medir(tiempos, "cierre de caja", en_operacion, servicios.cerrar_caja, nueva)
+        for i in range(args.reportes):
+            datos = medir(tiempos, "datos de reporte", en_operacion, servicios.construir_datos_reporte, rng.choice(cajas))
+            destino = os.path.join(directorio, f"reporte_{i}.{args.formato}")
+            medir(tiempos, "exportación de reporte", servicios.escribir_reporte_caja, destino, datos)
+            del datos
+        servicios.engine.dispose()
+    limites = dict(LIMITES_P95_MS, **dict(args.limite))
+    print(f"{'operación':>24} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'límite':>8}")
+    excedidas = []
+    for operacion, valores in tiempos.items():
+        p95 = percentil(valores, 95)
+        print(f"{operacion:>24} {len(valores):>5} {percentil(valores, 50):>8.1f} {p95:>8.1f} "
+              f"{percentil(valores, 99):>8.1f} {max(valores):>8.1f} {limites[operacion]:>8.0f}")
+        if p95 > limites[operacion]:
+            excedidas.append(f"{operacion} ({p95:.1f} ms)")
+    if excedidas and not args.sin_limites:
+        raise SystemExit(f"p95 por encima del límite en: {', '.join(excedidas)}")
+
+CATEGORIAS = ["Analgésicos", "Antibióticos", "Vitaminas", "Higiene", "Dermocosmética",
+              "Infantil", "Primeros auxilios", "Digestivos", "Respiratorios", "Cardiología"]
+SILABAS = ["pa", "ra", "ce", "ta", "mol", "fe", "na", "zo", "lin", "cor", "du", "vi", "to", "rex", "san"]
+PRESENTACIONES = ["500 mg x 10", "500 mg x 20", "1 g x 8", "jarabe 120 ml", "crema 30 g",
+                  "gotas 15 ml", "x 30 comprimidos", "sobres x 12", "ampolla 2 ml", "spray 100 ml"]
+MOTIVOS_CANCELACION = ["Error de cobro", "Devolución del cliente", "Producto vencido", "Cambio de producto"]
+# Ventas relativas por día de la semana, de lunes a domingo
+DEMANDA_SEMANAL = [1.0, 0.95, 0.95, 1.0, 1.15, 1.25, 0.7]
+HORA_APERTURA = 8
+HORA_CIERRE = 22
+
+class GeneradorTienda:
+    # Puebla una base vacía con un historial de tienda verosímil: popularidad
+    # Zipf, varios turnos de caja por día, cancelaciones y vencimientos. Todo
+    # sale de una sola semilla, así que la misma línea de comando da la misma base
+    def __init__(self, engine, args):
+        self.engine = engine
+        self.args = args
+        self.rng = random.Random(args.semilla)
+        self.pendientes = {}
+        self.contados = {}
+
+    def agregar(self, tabla, fila):
+        filas = self.pendientes.setdefault(tabla, [])
+        filas.append(fila)
+        if len(filas) >= LOTE_SIEMBRA:
+            self.volcar()
+
+    def volcar(self):
+        # Las tablas padre primero, para no depender del orden de llegada
+        with self.engine.begin() as conn:
+            for tabla in (servicios.Producto.__table__, servicios.Caja.__table__, servicios.Venta.__table__,
+                          servicios.DetalleVenta.__table__, servicios.VentaCancelada.__table__, servicios.InventarioEntry.__table__):
+                filas = self.pendientes.pop(tabla, None)
+                if filas:
+                    conn.execute(insert(tabla), filas)
+                    self.contados[tabla.name] = self.contados.get(tabla.name, 0) + len(filas)
+
+    def nombre_producto(self, i):
+        nombre = "".join(self.rng.choice(SILABAS) for _ in range(self.rng.randint(2, 4))).capitalize()
+        return f"{nombre} {self.rng.choice(PRESENTACIONES)} #{i}"
+
+    def generar_productos(self):
+        self.precios = []
+        for i in range(1, self.args.productos + 1):
+            compra = round(min(math.exp(self.rng.gauss(1.5, 0.8)), 900), 2)
+            venta = round(compra * self.rng.uniform(1.2, 1.8), 2)
+            self.precios.append((venta, compra))
+            self.agregar(servicios.Producto.__table__, {
+                "id": i, "nombre": self.nombre_producto(i), "descripcion": None,
+                "precio_compra": compra, "precio_venta": venta,
+                "stock": self.rng.randint(0, 300), "categoria": self.rng.choice(CATEGORIAS),
+                # Una parte queda vencida respecto del último día generado
+                "fecha_vencimiento": self.hasta + timedelta(days=self.rng.randint(-60, 720)),
+                "codigo_barras": f"779{i:010d}",
+            })
+        # Popularidad Zipf sobre un orden aleatorio: el más vendido no es el ID 1
+        orden = list(range(1, self.args.productos + 1))
+        self.rng.shuffle(orden)
+        self.populares = orden
+        self.acumulado = list(itertools.accumulate(1 / rango ** self.args.zipf
+                                                   for rango in range(1, len(orden) + 1)))
+
+    def elegir_productos(self, cantidad):
+        return self.rng.choices(self.populares, cum_weights=self.acumulado, k=cantidad)
+
+    def generar_dia(self, dia):
+        inicio = datetime.combine(dia, datetime.min.time()) + timedelta(hours=HORA_APERTURA)
+        duracion = (HORA_CIERRE - HORA_APERTURA) * 3600 / self.args.cajas_por_dia
+        turnos = []
+        for t in range(self.args.cajas_por_dia):
+            self.caja_id += 1
+            apertura = inicio + timedelta(seconds=t * duracion)
+            turnos.append({"id": self.caja_id, "fecha_apertura": apertura,
+                           "fecha_cierre": apertura + timedelta(seconds=duracion),
+                           "monto_apertura": self.rng.choice([0, 500, 1000, 2000]),
+                           "num_ventas": 0, "num_canceladas": 0, "total_bruto": 0, "total_cancelado": 0})
+        demanda = self.args.ventas_por_dia * DEMANDA_SEMANAL[dia.weekday()] * self.rng.uniform(0.8, 1.2)
+        segundos = sorted(self.rng.uniform(0, duracion * len(turnos)) for _ in range(round(demanda)))
+        for segundo in segundos:
+            self.generar_venta(turnos[int(segundo // duracion)], inicio + timedelta(seconds=segundo))
+        for _ in range(self.args.entradas_por_dia):
+            self.agregar(servicios.InventarioEntry.__table__, {
+                "producto_id": self.elegir_productos(1)[0], "cantidad": self.rng.choice([12, 24, 50, 100, 200]),
+                "fecha_ingreso": inicio + timedelta(seconds=self.rng.uniform(0, duracion * len(turnos))),
+            })
+        for caja in turnos:
+            caja["total_ventas"] = caja["total_bruto"] - caja["total_cancelado"]
+            caja["monto_cierre"] = caja["monto_apertura"] + caja["total_ventas"]
+            self.agregar(servicios.Caja.__table__, caja)
+
+    def generar_venta(self, caja, fecha):
+        self.venta_id += 1
+        # Líneas con distribución geométrica de media lineas_por_venta, sin repetir producto
+        lineas = 1
+        while self.rng.random() > 1 / self.args.lineas_por_venta:
+            lineas += 1
+        total = 0
+        for producto_id in dict.fromkeys(self.elegir_productos(lineas)):
+            cantidad = self.rng.choices((1, 2, 3), weights=(80, 15, 5))[0]
+            venta, compra = self.precios[producto_id - 1]
+            subtotal = round(venta * cantidad, 2)
+            total += subtotal
+            self.agregar(servicios.DetalleVenta.__table__, {
+                "venta_id": self.venta_id, "producto_id": producto_id, "cantidad": cantidad,
+                "subtotal": subtotal, "costo": round(compra * cantidad, 2),
+            })
+        total = round(total, 2)
+        cancelada = self.rng.random() < self.args.tasa_cancelacion
+        caja["num_ventas"] += 1
+        caja["total_bruto"] = round(caja["total_bruto"] + total, 2)
+        if cancelada:
+            caja["num_canceladas"] += 1
+            caja["total_cancelado"] = round(caja["total_cancelado"] + total, 2)
+            self.agregar(servicios.VentaCancelada.__table__, {
+                "venta_id": self.venta_id, "motivo": self.rng.choice(MOTIVOS_CANCELACION),
+                "fecha_cancelacion": fecha + timedelta(minutes=self.rng.randint(1, 120)),
+            })
+        self.agregar(servicios.Venta.__table__, {
+            "id": self.venta_id, "fecha": fecha, "total": total, "caja_id": caja["id"],
+            "estado": servicios.VENTA_CANCELADA if cancelada else servicios.VENTA_ACTIVA,
+        })
+
+    def generar(self):
+        self.hasta = self.args.hasta or date.today()
+        self.venta_id = self.caja_id = 0
+        self.generar_productos()
+        for n in range(self.args.dias - 1, -1, -1):
+            self.generar_dia(self.hasta - timedelta(days=n))
+        self.volcar()
+        # El último turno queda abierto, como en una tienda funcionando
+        caja = servicios.Caja.__table__
+        with self.engine.begin() as conn:
+            conn.execute(update(caja).where(caja.c.id == self.caja_id)
+                         .values(fecha_cierre=None, monto_cierre=None, total_ventas=None))
+        return self.contados
+
+def bench_generar(args):
+    if os.path.exists(args.destino):
+        raise SystemExit(f"{args.destino} ya existe; elija otro destino o bórrelo antes")
+    inicio = time.perf_counter()
+    engine = servicios.crear_engine(f"sqlite:///{args.destino}", args.perfil)
+    servicios.preparar_base_datos(engine)
+    contados = GeneradorTienda(engine, args).generar()
+    with sessionmaker(bind=engine)() as sesion:
+        contados[servicios.VentaDiaria.__tablename__] = servicios.reconstruir_ventas_diarias(sesion)
+    engine.dispose()
+    duracion = time.perf_counter() - inicio
+    for tabla, filas in contados.items():
+        print(f"{tabla:>20} {filas:>10}")
+    total = sum(contados.values())
+    print(f"{total} filas en {duracion:.1f} s ({total / duracion:.0f} filas/s) en {args.destino}")
+
+def terminal(url, perfil, numero, args, inicio):
+    # Una terminal simulada en su propio proceso: vende sobre un puñado de
+    # productos con poco stock (para que haya competencia real por las mismas
+    # filas), cancela algunas de sus ventas y recibe mercadería
+    if perfil:
+        os.environ["SALUS_PERFIL_ALMACENAMIENTO"] = perfil
+    servicios.iniciar_base_datos(url, preparar=False)
+    rng = random.Random(args.semilla * 1000 + numero)
+    resultado = {"ventas": 0, "sin_stock": 0, "canceladas": 0, "entradas": 0, "ocupada": 0, "latencias": []}
+    propias = []
+    time.sleep(max(inicio - time.time(), 0))
+    fin = inicio + args.segundos
+    with servicios.sesion_operacion() as sesion:
+        caja_id = servicios.caja_abierta(sesion).id
+    while time.time() < fin:
+        tipo = rng.random()
+        comienzo = time.perf_counter()
+        try:
+            with servicios.sesion_operacion() as sesion:
+                if tipo < 0.8:
+                    carrito = [{"producto_id": producto_id, "cantidad": rng.randint(1, 3), "subtotal": 2.0}
+                               for producto_id in rng.sample(range(1, args.productos + 1), rng.randint(1, 4))]
+                    propias.append(servicios.registrar_venta(sesion, caja_id, carrito).id)
+                    resultado["ventas"] += 1
+                elif tipo < 0.9 and propias:
+                    servicios.cancelar_venta(sesion, propias.pop(rng.randrange(len(propias))), "terminales")
+                    resultado["canceladas"] += 1
+                else:
+                    servicios.registrar_entrada_inventario(sesion, rng.randint(1, args.productos), rng.randint(5, 20))
+                    resultado["entradas"] += 1
+        except servicios.StockInsuficienteError:
+            resultado["sin_stock"] += 1
+        except servicios.BaseOcupadaError:
+            resultado["ocupada"] += 1
+        resultado["latencias"].append((time.perf_counter() - comienzo) * 1000)
+    resultado["reintentos"] = servicios.reintentos_bloqueo
+    servicios.engine.dispose()
+    return resultado
+
+def verificar_consistencia(engine, stock_inicial):
+    # El stock final de cada producto debe ser el inicial, más lo ingresado,
+    # menos lo vendido en ventas que siguen activas, y nunca negativo
+    errores = []
+    with engine.connect() as conn:
+        ingresado = dict(conn.execute(
+            select(servicios.InventarioEntry.producto_id, func.sum(servicios.InventarioEntry.cantidad))
+            .group_by(servicios.InventarioEntry.producto_id)
+        ).all())
+        vendido = dict(conn.execute(
+            select(servicios.DetalleVenta.producto_id, func.sum(servicios.DetalleVenta.cantidad))
+            .join(servicios.Venta, servicios.Venta.id == servicios.DetalleVenta.venta_id)
+            .where(servicios.Venta.estado == servicios.VENTA_ACTIVA)
+            .group_by(servicios.DetalleVenta.producto_id)
+        ).all())
+        for producto_id, stock in conn.execute(select(servicios.Producto.id, servicios.Producto.stock)):
+            esperado = stock_inicial + ingresado.get(producto_id, 0) - vendido.get(producto_id, 0)
+            if stock != esperado or stock < 0:
+                errores.append(f"producto {producto_id}: stock {stock}, esperado {esperado}")
+    with sessionmaker(bind=engine)() as sesion:
+        for caja_id in sesion.scalars(select(servicios.Caja.id)):
+            for campo, (acumulado, calculado) in servicios.conciliar_caja(sesion, caja_id).items():
+                errores.append(f"caja {caja_id}: {campo} acumulado {acumulado}, calculado {calculado}")
+    return errores
+
+def bench_terminales(args):
+    import multiprocessing
+    directorio = args.directorio or tempfile.mkdtemp()
+    try:
+        engine, Sesion, _ = base_temporal(directorio, args.productos, args.perfil)
+        with Sesion() as sesion:
+            sesion.execute(update(servicios.Producto).values(stock=args.stock))
+            sesion.commit()
+        url = str(engine.url)
+        engine.dispose()
+        # spawn: cada terminal arranca como un proceso nuevo, igual que en otra máquina
+        contexto = multiprocessing.get_context("spawn")
+        inicio = time.time() + 3
+        with contexto.Pool(args.terminales) as pool:
+            resultados = pool.starmap(terminal, [(url, args.perfil, n, args, inicio) for n in range(args.terminales)])
+        print(f"{'terminal':>8} {'ventas':>7} {'sin stock':>10} {'cancel.':>8} {'entradas':>9} "
+              f"{'ocupada':>8} {'reintentos':>11} {'p50 ms':>7} {'p99 ms':>7}")
+        for n, r in enumerate(resultados):
+            print(f"{n:>8} {r['ventas']:>7} {r['sin_stock']:>10} {r['canceladas']:>8} {r['entradas']:>9} "
+                  f"{r['ocupada']:>8} {r['reintentos']:>11} {percentil(r['latencias'], 50):>7.1f} "
+                  f"{percentil(r['latencias'], 99):>7.1f}")
+        operaciones = sum(len(r["latencias"]) for r in resultados)
+        print(f"{operaciones / args.segundos:.1f} operaciones/s, "
+              f"{sum(r['ventas'] for r in resultados) / args.segundos:.1f} ventas/s entre {args.terminales} terminales")
+        engine = servicios.crear_engine(url, args.perfil)
+        errores = verificar_consistencia(engine, args.stock)
+        with engine.connect() as conn:
+            ventas = conn.scalar(select(func.count()).select_from(servicios.Venta))
+        engine.dispose()
+        if ventas != sum(r["ventas"] for r in resultados):
+            errores.append(f"{ventas} ventas en la base, {sum(r['ventas'] for r in resultados)} informadas")
+        if errores:
+            raise SystemExit("Inconsistencias:\n" + "\n".join(errores[:50]))
+        print("Stock y cajas consistentes")
+    finally:
+        if not args.directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks de Salus JJV")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    checkout = sub.add_parser("checkout", help="Ventas por segundo según líneas por carrito")
+    checkout.add_argument("--lineas", type=int, nargs="+", default=[1, 10, 50])
+    checkout.add_argument("--ventas", type=int, default=500)
+    checkout.add_argument("--productos", type=int, default=500)
+    checkout.add_argument("--semilla", type=int, default=1)
+    checkout.set_defaults(funcion=bench_checkout)
+    perfiles = sub.add_parser("perfiles", help="Compara perfiles de almacenamiento en ventas y reportes")
+    perfiles.add_argument("--perfiles", nargs="+", default=list(servicios.PERFILES_ALMACENAMIENTO))
+    perfiles.add_argument("--ventas", type=int, default=500)
+    perfiles.add_argument("--lineas", type=int, default=5)
+    perfiles.add_argument("--reportes", type=int, default=20)
+    perfiles.add_argument("--productos", type=int, default=500)
+    perfiles.add_argument("--semilla", type=int, default=1)
+    perfiles.set_defaults(funcion=bench_perfiles)
+    reporte = sub.add_parser("reporte", help="Tiempo y pico de memoria del reporte según líneas y formato")
+    reporte.add_argument("--lineas", type=int, nargs="+", default=[100000, 1000000])
+    reporte.add_argument("--formatos", nargs="+", default=["xlsx", "csv", "parquet"])
+    reporte.add_argument("--lineas-por-venta", type=int, default=5)
+    reporte.add_argument("--productos", type=int, default=500)
+    # El caché de páginas y el mmap de SQLite también cuentan en el pico de memoria
+    reporte.add_argument("--perfil", choices=list(servicios.PERFILES_ALMACENAMIENTO))
+    reporte.set_defaults(funcion=bench_reporte)
+    arranque = sub.add_parser("arranque", help="Tiempos de arranque hasta el primer pintado del menú")
+    arranque.add_argument("--repeticiones", type=int, default=5)
+    arranque.add_argument("--productos", type=int, default=5000)
+    arranque.add_argument("--limite-ms", type=int, default=1000, help="Falla si la mediana del primer pintado lo supera")
+    arranque.set_defaults(funcion=bench_arranque)
+    soak = sub.add_parser("soak", help="Memoria a lo largo de muchas operaciones simuladas en la aplicación")
+    soak.add_argument("--operaciones", type=int, default=10000)
+    soak.add_argument("--muestra", type=int, default=1000, help="Operaciones entre mediciones de memoria")
+    soak.add_argument("--productos", type=int, default=2000)
+    soak.add_argument("--semilla", type=int, default=1)
+    soak.add_argument("--limite-mb", type=float, default=10, help="Falla si la memoria crece más que esto tras la primera muestra")
+    soak.set_defaults(funcion=bench_soak)
+    latencias = sub.add_parser("servicios", help="Percentiles de latencia de los servicios sobre una base grande")
+    latencias.add_argument("--productos", type=int, default=10000)
+    latencias.add_argument("--lineas", type=int, default=1000000)
+    latencias.add_argument("--lineas-por-venta", type=int, default=5)
+    latencias.add_argument("--cajas", type=int, default=50, help="Turnos cerrados entre los que se reparten las ventas")
+    latencias.add_argument("--repeticiones", type=int, default=200)
+    latencias.add_argument("--reportes", type=int, default=10)
+    latencias.add_argument("--formato", choices=["xlsx", "csv", "parquet"], default="xlsx")
+    latencias.add_argument("--semilla", type=int, default=1)
+    latencias.add_argument("--limite", type=limite_argumento, action="append", default=[],
+                           metavar="OPERACION=MS", help="Reemplaza el p95 aceptable de una operación")
+    latencias.add_argument("--sin-limites", action="store_true", help="Solo informa, sin fallar por los límites")
+    latencias.set_defaults(funcion=bench_servicios)
+    generar = sub.add_parser("generar", help="Genera una base con datos sintéticos de una tienda para pruebas de carga")
+    generar.add_argument("destino", help="Archivo SQLite nuevo")
+    generar.add_argument("--productos", type=int, default=20000)
+    generar.add_argument("--dias", type=int, default=365)
+    generar.add_argument("--hasta", type=fecha_argumento, help="Último día generado, AAAA-MM-DD (por defecto hoy)")
+    generar.add_argument("--ventas-por-dia", type=int, default=3000)
+    generar.add_argument("--cajas-por-dia", type=int, default=3)
+    generar.add_argument("--lineas-por-venta", type=float, default=3, help="Media de líneas por venta")
+    generar.add_argument("--entradas-por-dia", type=int, default=40, help="Entradas de inventario por día")
+    generar.add_argument("--tasa-cancelacion", type=float, default=0.02)
+    generar.add_argument("--zipf", type=float, default=1.1, help="Exponente de popularidad de los productos")
+    generar.add_argument("--perfil", choices=list(servicios.PERFILES_ALMACENAMIENTO))
+    generar.add_argument("--semilla", type=int, default=1)
+    generar.set_defaults(funcion=bench_generar)
+    terminales = sub.add_parser("terminales", help="Varias terminales en procesos aparte sobre la misma base")
+    terminales.add_argument("--terminales", type=int, default=3)
+    terminales.add_argument("--segundos", type=float, default=20)
+    terminales.add_argument("--productos", type=int, default=20, help="Pocos productos: todas las terminales compiten por ellos")
+    terminales.add_argument("--stock", type=int, default=100, help="Stock inicial de cada producto")
+    terminales.add_argument("--directorio", help="Carpeta de la base, por ejemplo en un recurso de red (por defecto, una temporal)")
+    terminales.add_argument("--perfil", choices=list(servicios.PERFILES_ALMACENAMIENTO))
+    terminales.add_argument("--semilla", type=int, default=1)
+    terminales.set_defaults(funcion=bench_terminales)
+    args = parser.parse_args()
+    args.funcion(args)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,213 +1,370 @@
+import time
+# Antes del resto de las importaciones, para que la traza de arranque las incluya
+INICIO_ARRANQUE = time.perf_counter()
 import sys
-from datetime import datetime
-import json
-import pandas as pd
-from PyQt6.QtCore import Qt
+import os
+import argparse
+from datetime import date, datetime, timedelta
+from PyQt6.QtCore import (
+    Qt, QDate, QEvent, QTimer, QAbstractTableModel, QModelIndex, QObject, QRunnable, QThreadPool, QThread, pyqtSignal
+)
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QGridLayout, QPushButton, QTableWidget, QTableWidgetItem, QDialog,
     QFormLayout, QLineEdit, QMessageBox, QComboBox, QHeaderView, QLabel, QSpinBox,
-    QFileDialog, QFrame
+    QFileDialog, QFrame, QTableView, QAbstractItemView, QProgressDialog, QDateEdit, QInputDialog,
+    QStackedWidget, QMenu, QAbstractButton
 )
-from PyQt6.QtGui import QAction, QFont, QIcon
-from sqlalchemy import create_engine, Column, Integer, String, Numeric, Date, DateTime, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base
+from PyQt6.QtGui import QAction, QFont, QIcon, QKeySequence
+from sqlalchemy import text, select, func, and_, or_, false, type_coerce, Column
 from sqlalchemy.exc import IntegrityError
-
-# Configuración del engine con pool ampliado
-DATABASE_URL = "sqlite:///database.db"
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,
-    future=True,
-    pool_size=10,
-    max_overflow=20
+from sqlalchemy.types import NullType
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression
+
+# Datos y servicios sin Qt. engine se lee siempre como servicios.engine:
+# iniciar_base_datos lo reemplaza.
+import servicios
+from servicios import (
+    config_valor, medidor_sql, SessionLocal, sesion_operacion, registro_cambios, iniciar_base_datos,
+    preparar_base_datos, Producto, InventarioEntry, Venta, DetalleVenta, Caja, VENTA_ACTIVA, ESTADOS_VENTA,
+    SQL_ACUMULAR_VENTAS_DIARIAS, filtro_busqueda_productos, buscar_productos, cache_productos, cache_reportes,
+    BaseOcupadaError, StockInsuficienteError, VentaNoCancelableError, EntradaNoEncontradaError,
+    CajaNoAbiertaError, ProductoModificadoError, registrar_venta, reposicion_stock_venta, cancelar_venta,
+    reconstruir_ventas_diarias, consulta_resumen_ventas, resumen_ventas, totales_ventas, total_neto_caja,
+    conciliar_caja, corregir_caja, crear_producto, actualizar_producto, eliminar_producto,
+    registrar_entrada_inventario, modificar_entrada_inventario, eliminar_entrada_inventario, caja_abierta,
+    abrir_caja, cerrar_caja, importar_productos, COLUMNAS_DETALLE_REPORTE, consulta_detalle_reporte,
+    FORMATOS_REPORTE, escribir_reporte_caja, escribir_reporte_ventas, escribir_reporte_venta,
+    formato_desde_nombre, exportar_base_datos
 )
-SessionLocal = sessionmaker(bind=engine)
-Base = declarative_base()
-
-class Producto(Base):
-    __tablename__ = "productos"
-    id = Column(Integer, primary_key=True)
-    nombre = Column(String(255), nullable=False)
-    descripcion = Column(String)
-    precio_compra = Column(Numeric(10, 2), nullable=False)
-    precio_venta = Column(Numeric(10, 2), nullable=False)
-    stock = Column(Integer, nullable=False)
-    categoria = Column(String(100))
-    fecha_vencimiento = Column(Date)
-    codigo_barras = Column(String(50), unique=True)
-
-class InventarioEntry(Base):
-    __tablename__ = "inventario"
-    id = Column(Integer, primary_key=True)
-    producto_id = Column(Integer, ForeignKey("productos.id"))
-    cantidad = Column(Integer, nullable=False)
-    fecha_ingreso = Column(DateTime, default=lambda: datetime.now(), onupdate=lambda: datetime.now())
-
-class Venta(Base):
-    __tablename__ = "ventas"
-    id = Column(Integer, primary_key=True)
-    fecha = Column(DateTime, default=lambda: datetime.now())
-    total = Column(Numeric(10, 2), nullable=False)
-    caja_id = Column(Integer, ForeignKey("caja.id"), nullable=True)
-
-class DetalleVenta(Base):
-    __tablename__ = "detalle_ventas"
-    id = Column(Integer, primary_key=True)
-    venta_id = Column(Integer, ForeignKey("ventas.id"))
-    producto_id = Column(Integer, ForeignKey("productos.id"))
-    cantidad = Column(Integer, nullable=False)
-    subtotal = Column(Numeric(10, 2), nullable=False)
-
-class Caja(Base):
-    __tablename__ = "caja"
-    id = Column(Integer, primary_key=True)
-    fecha_apertura = Column(DateTime, default=lambda: datetime.now(), nullable=False)
-    fecha_cierre = Column(DateTime, nullable=True)
-    monto_apertura = Column(Numeric(10, 2), nullable=False)
-    monto_cierre = Column(Numeric(10, 2), nullable=True)
-    total_ventas = Column(Numeric(10, 2), nullable=True)
-
-class VentaCancelada(Base):
-    __tablename__ = "ventas_canceladas"
-    id = Column(Integer, primary_key=True)
-    venta_id = Column(Integer, ForeignKey("ventas.id"))
-    fecha_cancelacion = Column(DateTime, default=lambda: datetime.now())
-    motivo = Column(String(255))
-
-Base.metadata.create_all(engine)
-
-def generar_reporte_excel(caja):
-    session = SessionLocal()
-    resumen_data = {
-        "Caja ID": caja.id,
-        "Fecha Apertura": caja.fecha_apertura.strftime("%Y-%m-%d %H:%M:%S"),
-        "Monto Apertura": float(caja.monto_apertura),
-        "Fecha Cierre": caja.fecha_cierre.strftime("%Y-%m-%d %H:%M:%S") if caja.fecha_cierre else "Caja abierta",
-        "Monto Cierre": float(caja.monto_cierre) if caja.monto_cierre is not None else 0.0,
-        "Total Ventas": float(caja.total_ventas) if caja.total_ventas else 0.0,
-    }
-    saldo_final = float(caja.monto_apertura) + (float(caja.total_ventas) if caja.total_ventas else 0.0)
-    resumen_data["Saldo Final"] = saldo_final
-
-    df_resumen = pd.DataFrame([resumen_data])
-    
-    query = session.query(Venta, DetalleVenta, Producto)\
-        .join(DetalleVenta, Venta.id == DetalleVenta.venta_id)\
-        .join(Producto, Producto.id == DetalleVenta.producto_id)\
-        .filter(Venta.caja_id == caja.id).order_by(Venta.fecha.asc()).all()
-    detalle_list = []
-    for venta, detalle, producto in query:
-        detalle_list.append({
-            "Venta ID": venta.id,
-            "Fecha Venta": venta.fecha.strftime("%Y-%m-%d %H:%M:%S"),
-            "Producto": producto.nombre,
-            "Cantidad": detalle.cantidad,
-            "Precio Venta": float(producto.precio_venta),
-            "Subtotal": float(detalle.subtotal)
-        })
-    df_detalle = pd.DataFrame(detalle_list)
-    if not df_detalle.empty:
-        df_productos = df_detalle.groupby("Producto", as_index=False)\
-            .agg({"Cantidad": "sum", "Subtotal": "sum"})\
-            .rename(columns={"Cantidad": "Cantidad Total", "Subtotal": "Total Ventas"})
-    else:
-        df_productos = pd.DataFrame(columns=["Producto", "Cantidad Total", "Total Ventas"])
-    
-    filename, _ = QFileDialog.getSaveFileName(None, "Guardar reporte Excel", "", "Excel Files (*.xlsx)")
+
+# Espera tras la última tecla antes de buscar
+RETARDO_BUSQUEDA_MS = 250
+
+def formato_fecha(valor):
+    return valor.strftime("%Y-%m-%d %H:%M:%S") if valor else ""
+
+def formato_monto(valor):
+    return f"{float(valor or 0):.2f}"
+
+# Modelo compartido de las grillas grandes: trae las filas por páginas a medida
+# que la vista las necesita y resuelve orden y filtros en SQL. Las páginas se
+# piden por clave (keyset), a partir de la última fila cargada, de modo que
+# bajar en la grilla no vuelve a recorrer las filas anteriores como un OFFSET.
+# Comparaciones que nunca son ciertas con NULL
+COMPARACIONES_SIN_NULOS = (operators.eq, operators.lt, operators.le, operators.gt, operators.ge)
+
+class ModeloTablaSQL(QAbstractTableModel):
+    TAMANO_PAGINA = 200
+    # Claves por consulta al releer filas sueltas
+    LOTE_CLAVES = 500
+    # Con más claves (una importación masiva) sale más barato recargar
+    MAXIMO_CLAVES = 2000
+
+    def __init__(self, columnas, origen, clave, parent=None):
+        super().__init__(parent)
+        # columnas: lista de (título, expresión SQL, formato opcional)
+        self.columnas = columnas
+        # origen: agrega FROM/JOIN/WHERE fijos al select de las columnas
+        self.origen = origen
+        # clave: expresión única que desempata el orden para paginar
+        self.clave = clave
+        self.filtros = []
+        self.orden = None
+        self.filas = []
+        self.agotado = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.filas)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columnas)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.columnas[section][0]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        valor = self.filas[index.row()][index.column()]
+        formato = self.columnas[index.column()][2]
+        if formato:
+            return formato(valor)
+        return "" if valor is None else str(valor)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.agotado
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.agotado:
+            return
+        nuevas = self.consultar_pagina(self.filas[-1] if self.filas else None)
+        if len(nuevas) < self.TAMANO_PAGINA:
+            self.agotado = True
+        if nuevas:
+            inicio = len(self.filas)
+            self.beginInsertRows(QModelIndex(), inicio, inicio + len(nuevas) - 1)
+            self.filas.extend(nuevas)
+            self.endInsertRows()
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.orden = (column, order == Qt.SortOrder.DescendingOrder)
+        self.recargar()
+
+    def set_filtros(self, *filtros, recargar=True):
+        self.filtros = [f for f in filtros if f is not None]
+        if recargar:
+            self.recargar()
+
+    def recargar(self):
+        self.beginResetModel()
+        self.filas = []
+        self.agotado = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def expresion_orden(self):
+        # Sin conversión de tipos: el valor leído se compara tal cual al pedir la
+        # página siguiente (un Numeric redondeado a 2 decimales no sería igual)
+        return type_coerce(self.columnas[self.orden[0]][1], NullType())
+
+    def consulta(self, condicion=None):
+        # Cada fila lleva, después de las columnas visibles, el valor crudo del
+        # orden (si lo hay) y la clave
+        extras = [self.expresion_orden()] if self.orden else []
+        stmt = self.origen(select(*[c[1] for c in self.columnas], *extras, self.clave))
+        # La condición de la página va antes que los filtros: con dos cotas
+        # sobre la misma columna (la del rango de fechas y la de la última fila)
+        # SQLite usa la primera para el recorrido del índice
+        if condicion is not None:
+            stmt = stmt.where(condicion)
+        if self.filtros:
+            stmt = stmt.where(*self.filtros)
+        if self.orden and self.orden[1]:
+            # La clave desempata en el mismo sentido que el orden: un índice
+            # sobre la columna (que termina en el rowid) sirve recorrido al revés
+            # sin ordenar aparte
+            return stmt.order_by(self.columnas[self.orden[0]][1].desc(), self.clave.desc())
+        if self.orden:
+            stmt = stmt.order_by(self.columnas[self.orden[0]][1].asc())
+        return stmt.order_by(self.clave)
+
+    def condiciones_siguientes(self, ultima):
+        # Una condición por tramo, en el orden en que se recorren. SQLite ordena
+        # los NULL primero en ASC y al final en DESC; el tramo de los NULL se
+        # pide aparte porque un OR con IS NULL no deja buscar en el índice y
+        # cada página costaría más que la anterior
+        if not self.orden:
+            return [self.clave > ultima[-1]]
+        despues = self.clave < ultima[-1] if self.orden[1] else self.clave > ultima[-1]
+        expresion = self.expresion_orden()
+        valor = ultima[-2]
+        descendente = self.orden[1]
+        if valor is None:
+            mismos = and_(expresion.is_(None), despues)
+            return [mismos] if descendente else [mismos, expresion.is_not(None)]
+        # La cota <= (>= en ASC) fuera del OR es la que deja a SQLite empezar
+        # el recorrido del índice en la última fila leída
+        siguiente = and_(expresion <= valor if descendente else expresion >= valor,
+                         or_(expresion < valor if descendente else expresion > valor, despues))
+        return [siguiente, expresion.is_(None)] if descendente and self.admite_nulos() else [siguiente]
+
+    def admite_nulos(self):
+        # Una columna NOT NULL de la tabla principal (la de la clave; las de un
+        # outer join sí pueden venir en NULL) o una ya comparada en los filtros,
+        # como la fecha del historial, no tiene tramo de NULL
+        columna = getattr(self.columnas[self.orden[0]][1], "expression", None)
+        if columna is None or not isinstance(columna, Column):
+            return True
+        if not columna.nullable and columna.table is getattr(self.clave, "table", None):
+            return False
+        return not any(
+            isinstance(filtro, BinaryExpression) and filtro.operator in COMPARACIONES_SIN_NULOS
+            and filtro.left.compare(columna)
+            for filtro in self.filtros
+        )
+
+    def consultar_pagina(self, ultima):
+        with servicios.engine.connect() as conn:
+            if ultima is None:
+                return [tuple(fila) for fila in conn.execute(self.consulta().limit(self.TAMANO_PAGINA))]
+            filas = []
+            for condicion in self.condiciones_siguientes(ultima):
+                resultado = conn.execute(self.consulta(condicion).limit(self.TAMANO_PAGINA - len(filas)))
+                filas.extend(tuple(fila) for fila in resultado)
+                if len(filas) == self.TAMANO_PAGINA:
+                    break
+            return filas
+
+    def antes(self, a, b):
+        # Mismo orden que consulta(): columna de orden y luego la clave, en el mismo sentido
+        if self.orden and a[-2] != b[-2]:
+            if a[-2] is None or b[-2] is None:
+                # SQLite ordena los NULL primero en ASC y al final en DESC
+                return (a[-2] is None) != self.orden[1]
+            return a[-2] > b[-2] if self.orden[1] else a[-2] < b[-2]
+        return a[-1] > b[-1] if self.orden and self.orden[1] else a[-1] < b[-1]
+
+    def actualizar_filas(self, claves):
+        # Relee solo las filas de esas claves: las cargadas se reemplazan, las
+        # que ya no pasan los filtros se quitan y las que cambian de lugar o son
+        # nuevas se ubican por el orden; si caen después de lo cargado llegarán
+        # con fetchMore. Sin claves (no se sabe qué cambió) se recarga todo.
+        if claves is None or len(claves) > self.MAXIMO_CLAVES:
+            self.recargar()
+            return
+        claves = list(claves)
+        leidas = {}
+        with servicios.engine.connect() as conn:
+            for inicio in range(0, len(claves), self.LOTE_CLAVES):
+                consulta = self.consulta().where(self.clave.in_(claves[inicio:inicio + self.LOTE_CLAVES]))
+                leidas.update((fila[-1], tuple(fila)) for fila in conn.execute(consulta))
+        try:
+            self.ubicar_filas(claves, leidas)
+        except TypeError:
+            # Valores de orden que Python no sabe comparar
+            self.recargar()
+
+    def ubicar_filas(self, claves, leidas):
+        posiciones = {fila[-1]: i for i, fila in enumerate(self.filas)}
+        quitar = []
+        for clave in claves:
+            i = posiciones.get(clave)
+            if i is None:
+                continue
+            fila = leidas.get(clave)
+            if fila is not None and (not self.orden or fila[-2] == self.filas[i][-2]):
+                self.filas[i] = fila
+                self.dataChanged.emit(self.index(i, 0), self.index(i, len(self.columnas) - 1))
+                del leidas[clave]
+            else:
+                quitar.append(i)
+        for i in sorted(quitar, reverse=True):
+            self.beginRemoveRows(QModelIndex(), i, i)
+            del self.filas[i]
+            self.endRemoveRows()
+        for fila in leidas.values():
+            i = next((i for i, otra in enumerate(self.filas) if self.antes(fila, otra)), len(self.filas))
+            if i == len(self.filas) and not self.agotado:
+                continue
+            self.beginInsertRows(QModelIndex(), i, i)
+            self.filas.insert(i, fila)
+            self.endInsertRows()
+
+    def valor(self, fila, columna):
+        return self.filas[fila][columna]
+
+def crear_vista_tabla(modelo, columna_orden=0, orden=Qt.SortOrder.AscendingOrder):
+    vista = QTableView()
+    vista.setModel(modelo)
+    header = vista.horizontalHeader()
+    header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+    vista.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+    vista.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+    vista.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+    vista.setSortingEnabled(True)
+    # Dispara la primera carga
+    vista.sortByColumn(columna_orden, orden)
+    return vista
+
+def generar_reporte_excel(caja_id):
+    datos = cache_reportes.obtener(caja_id)
+    filename, _ = QFileDialog.getSaveFileName(
+        None, "Guardar reporte", "", "Excel Files (*.xlsx);;CSV (*.csv);;Parquet (*.parquet)"
+    )
     if filename:
+        if os.path.splitext(filename)[1].lower() not in FORMATOS_REPORTE:
+            filename += ".xlsx"
         try:
-            with pd.ExcelWriter(filename, engine="openpyxl") as writer:
-                df_resumen.to_excel(writer, sheet_name="Resumen Caja", index=False)
-                df_detalle.to_excel(writer, sheet_name="Detalle Ventas", index=False)
-                df_productos.to_excel(writer, sheet_name="Productos Vendidos", index=False)
+            escribir_reporte_caja(filename, datos)
             QMessageBox.information(None, "Reporte Excel", "Reporte generado exitosamente.")
         except Exception as e:
             QMessageBox.warning(None, "Reporte Excel", f"Error al exportar: {str(e)}")
-    session.close()
-
-def generar_reporte_excel_venta(venta):
-    session = SessionLocal()
-    venta_info = {
-        "Venta ID": venta.id,
-        "Fecha": venta.fecha.strftime("%Y-%m-%d %H:%M:%S"),
-        "Total": float(venta.total)
-    }
-    df_venta = pd.DataFrame([venta_info])
-    query = session.query(DetalleVenta, Producto)\
-        .join(Producto, Producto.id == DetalleVenta.producto_id)\
-        .filter(DetalleVenta.venta_id == venta.id).all()
-    detalle_list = []
-    for detalle, producto in query:
-        detalle_list.append({
-            "Producto": producto.nombre,
-            "Cantidad": detalle.cantidad,
-            "Precio Venta": float(producto.precio_venta),
-            "Subtotal": float(detalle.subtotal)
-        })
-    df_detalle = pd.DataFrame(detalle_list)
-    if not df_detalle.empty:
-        df_productos = df_detalle.groupby("Producto", as_index=False)\
-            .agg({"Cantidad": "sum", "Subtotal": "sum"})\
-            .rename(columns={"Cantidad": "Cantidad Total", "Subtotal": "Total Ventas"})
-    else:
-        df_productos = pd.DataFrame(columns=["Producto", "Cantidad Total", "Total Ventas"])
-    filename, _ = QFileDialog.getSaveFileName(None, "Guardar reporte Excel de Venta", "", "Excel Files (*.xlsx)")
-    if filename:
+
+class TrabajoReporteVenta(QRunnable):
+    def __init__(self, cola, venta_id):
+        super().__init__()
+        self.cola = cola
+        self.venta_id = venta_id
+
+    def run(self):
         try:
-            with pd.ExcelWriter(filename, engine="openpyxl") as writer:
-                df_venta.to_excel(writer, sheet_name="Venta", index=False)
-                df_detalle.to_excel(writer, sheet_name="Detalle Venta", index=False)
-                df_productos.to_excel(writer, sheet_name="Productos Vendidos", index=False)
-            QMessageBox.information(None, "Reporte Excel", "Reporte de venta generado exitosamente.")
+            self.cola.terminado.emit(escribir_reporte_venta(self.venta_id))
         except Exception as e:
-            QMessageBox.warning(None, "Reporte Excel", f"Error al exportar: {str(e)}")
-    session.close()
-
-def exportar_base_datos_json():
-    session = SessionLocal()
-    data = {}
-    models = [Producto, InventarioEntry, Venta, DetalleVenta, Caja, VentaCancelada]
-    for model in models:
-        table_name = model.__tablename__
-        items = session.query(model).all()
-        data[table_name] = [{col.name: getattr(item, col.name) for col in model.__table__.columns} for item in items]
-    filename, _ = QFileDialog.getSaveFileName(None, "Exportar Base de Datos", "", "JSON Files (*.json)")
-    if filename:
+            self.cola.fallido.emit(f"Reporte de la venta {self.venta_id}: {str(e)}")
+
+# Los reportes por venta se escriben en segundo plano, uno a la vez, para
+# no demorar al siguiente cliente
+class ColaReportes(QObject):
+    terminado = pyqtSignal(str)
+    fallido = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+
+    def encolar_venta(self, venta_id):
+        self.pool.start(TrabajoReporteVenta(self, venta_id))
+
+_cola_reportes = None
+
+def obtener_cola_reportes():
+    global _cola_reportes
+    if _cola_reportes is None:
+        _cola_reportes = ColaReportes()
+    return _cola_reportes
+
+def mostrar_estado(widget, mensaje, duracion_ms=5000):
+    ventana = widget.window()
+    if isinstance(ventana, QMainWindow):
+        ventana.statusBar().showMessage(mensaje, duracion_ms)
+
+class HiloExportacion(QThread):
+    progreso = pyqtSignal(int, int)
+    terminado = pyqtSignal(str)
+    fallido = pyqtSignal(str)
+
+    def __init__(self, ruta, formato, compresion, parent=None):
+        super().__init__(parent)
+        self.ruta = ruta
+        self.formato = formato
+        self.compresion = compresion
+        self.cancelar = False
+
+    def run(self):
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4, default=str)
-            QMessageBox.information(None, "Exportar Base de Datos", "Base de datos exportada exitosamente.")
+            exportar_base_datos(self.ruta, self.formato, self.compresion,
+                                progreso=self.progreso.emit, cancelado=lambda: self.cancelar)
+            self.terminado.emit(self.ruta)
         except Exception as e:
-            QMessageBox.warning(None, "Exportar Base de Datos", f"Error al exportar: {str(e)}")
-    session.close()
+            self.fallido.emit(str(e))
 
 # ReportePreviewDialog mejorada y estilizada
 class ReportePreviewDialog(QDialog):
-    def __init__(self, caja, parent=None):
+    def __init__(self, caja_id, parent=None):
         super().__init__(parent)
-        self.caja = caja
-        self.setWindowTitle(f"Previsualización Reporte - Caja ID: {caja.id}")
+        self.caja_id = caja_id
+        self.datos = cache_reportes.obtener(caja_id)
+        self.setWindowTitle(f"Previsualización Reporte - Caja ID: {caja_id}")
         self.resize(800, 600)
         
         layout = QVBoxLayout(self)
         
         # Encabezado resumen con HTML
-        monto_apertura = float(caja.monto_apertura)
-        total_ventas = float(caja.total_ventas) if caja.total_ventas is not None else 0.0
-        monto_cierre = float(caja.monto_cierre) if caja.monto_cierre is not None else 0.0
-        saldo_final = monto_apertura + total_ventas
-
+        resumen = self.datos.resumen
         summary_text = (
             f"<div style='text-align:center; font-family: Arial; font-size:14px; padding:10px;'>"
-            f"<b>Caja ID:</b> {caja.id}<br>"
-            f"<b>Fecha Apertura:</b> {caja.fecha_apertura.strftime('%Y-%m-%d %H:%M:%S')}<br>"
-            f"<b>Monto Apertura:</b> {monto_apertura:.2f}<br>"
-            f"<b>Fecha Cierre:</b> {caja.fecha_cierre.strftime('%Y-%m-%d %H:%M:%S') if caja.fecha_cierre else 'Caja abierta'}<br>"
-            f"<b>Monto Cierre:</b> {monto_cierre:.2f}<br>"
-            f"<b>Total Ventas:</b> {total_ventas:.2f}<br>"
-            f"<b>Saldo Final:</b> {saldo_final:.2f}"
+            f"<b>Caja ID:</b> {resumen['Caja ID']}<br>"
+            f"<b>Fecha Apertura:</b> {resumen['Fecha Apertura']}<br>"
+            f"<b>Monto Apertura:</b> {resumen['Monto Apertura']:.2f}<br>"
+            f"<b>Fecha Cierre:</b> {resumen['Fecha Cierre']}<br>"
+            f"<b>Monto Cierre:</b> {resumen['Monto Cierre']:.2f}<br>"
+            f"<b>Total Ventas:</b> {resumen['Total Ventas']:.2f}<br>"
+            f"<b>Saldo Final:</b> {resumen['Saldo Final']:.2f}"
             f"</div>"
         )
         self.labelSummary = QLabel(summary_text)
@@ -222,10 +379,8 @@ class ReportePreviewDialog(QDialog):
         
         # Tabla de detalle de ventas
         self.tablaDetalle = QTableWidget()
-        self.tablaDetalle.setColumnCount(6)
-        self.tablaDetalle.setHorizontalHeaderLabels(
-            ["Venta ID", "Fecha Venta", "Producto", "Cantidad", "Precio Venta", "Subtotal"]
-        )
+        self.tablaDetalle.setColumnCount(len(COLUMNAS_DETALLE_REPORTE))
+        self.tablaDetalle.setHorizontalHeaderLabels(COLUMNAS_DETALLE_REPORTE)
         header = self.tablaDetalle.horizontalHeader()
         header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
         # Estilo básico para la tabla
@@ -248,24 +403,15 @@ class ReportePreviewDialog(QDialog):
         self.cargar_detalle()
 
     def cargar_detalle(self):
-        session = SessionLocal()
-        query = session.query(Venta, DetalleVenta, Producto)\
-            .join(DetalleVenta, Venta.id == DetalleVenta.venta_id)\
-            .join(Producto, Producto.id == DetalleVenta.producto_id)\
-            .filter(Venta.caja_id == self.caja.id)\
-            .order_by(Venta.fecha.asc()).all()
-        self.tablaDetalle.setRowCount(len(query))
-        for i, (venta, detalle, producto) in enumerate(query):
-            self.tablaDetalle.setItem(i, 0, QTableWidgetItem(str(venta.id)))
-            self.tablaDetalle.setItem(i, 1, QTableWidgetItem(venta.fecha.strftime("%Y-%m-%d %H:%M:%S")))
-            self.tablaDetalle.setItem(i, 2, QTableWidgetItem(producto.nombre))
-            self.tablaDetalle.setItem(i, 3, QTableWidgetItem(str(detalle.cantidad)))
-            self.tablaDetalle.setItem(i, 4, QTableWidgetItem(str(producto.precio_venta)))
-            self.tablaDetalle.setItem(i, 5, QTableWidgetItem(str(detalle.subtotal)))
-        session.close()
+        detalle = self.datos.detalle
+        self.tablaDetalle.setRowCount(len(detalle))
+        for i, fila in enumerate(detalle):
+            for j, valor in enumerate(fila):
+                texto = f"{valor:.2f}" if isinstance(valor, float) else str(valor)
+                self.tablaDetalle.setItem(i, j, QTableWidgetItem(texto))
 
     def generar_reporte(self):
-        generar_reporte_excel(self.caja)
+        generar_reporte_excel(self.caja_id)
 
 class ProductoDialog(QDialog):
     def __init__(self, parent=None, producto=None):
@@ -335,52 +481,52 @@ class ProductoDialog(QDialog):
         return data
 
 class VentanaProductos(QWidget):
+    TABLAS = ("productos",)
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setLayout(QVBoxLayout())
         self.busquedaLineEdit = QLineEdit()
         self.busquedaLineEdit.setPlaceholderText("Buscar producto para vender...")
-        self.busquedaLineEdit.textChanged.connect(self.cargar_productos)
+        self.temporizadorBusqueda = QTimer(self)
+        self.temporizadorBusqueda.setSingleShot(True)
+        self.temporizadorBusqueda.setInterval(RETARDO_BUSQUEDA_MS)
+        self.temporizadorBusqueda.timeout.connect(self.cargar_productos)
+        self.busquedaLineEdit.textChanged.connect(lambda _: self.temporizadorBusqueda.start())
         self.layout().addWidget(self.busquedaLineEdit)
-        self.tabla = QTableWidget()
-        self.tabla.setColumnCount(9)
-        self.tabla.setHorizontalHeaderLabels(["ID", "Nombre", "Descripción", "Precio Compra", "Precio Venta", "Inventario", "Precio Absoluto", "Categoría", "Código Barras"])
-        header = self.tabla.horizontalHeader()
-        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        self.tabla.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-        self.tabla.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.modelo = ModeloTablaSQL([
+            ("ID", Producto.id, None),
+            ("Nombre", Producto.nombre, None),
+            ("Descripción", Producto.descripcion, None),
+            ("Precio Compra", Producto.precio_compra, None),
+            ("Precio Venta", Producto.precio_venta, None),
+            ("Inventario", Producto.stock, None),
+            ("Precio Absoluto", Producto.precio_compra * Producto.stock, formato_monto),
+            ("Categoría", Producto.categoria, None),
+            ("Código Barras", Producto.codigo_barras, None),
+        ], lambda q: q.select_from(Producto), Producto.id, self)
+        self.tabla = crear_vista_tabla(self.modelo)
         self.layout().addWidget(self.tabla)
         btnLayout = QHBoxLayout()
         btnAgregar = QPushButton("Agregar")
         btnEditar = QPushButton("Editar")
         btnEliminar = QPushButton("Eliminar")
+        btnImportar = QPushButton("Importar")
         btnLayout.addWidget(btnAgregar)
         btnLayout.addWidget(btnEditar)
         btnLayout.addWidget(btnEliminar)
+        btnLayout.addWidget(btnImportar)
         self.layout().addLayout(btnLayout)
         btnAgregar.clicked.connect(self.agregar_producto)
         btnEditar.clicked.connect(self.editar_producto)
         btnEliminar.clicked.connect(self.eliminar_producto)
-        self.cargar_productos()
+        btnImportar.clicked.connect(self.importar_productos)
 
     def cargar_productos(self):
-        busqueda = self.busquedaLineEdit.text().strip().lower()
-        productos = self.sesion.query(Producto).all()
-        if busqueda:
-            productos = [p for p in productos if busqueda in p.nombre.lower()]
-        self.tabla.setRowCount(len(productos))
-        for i, p in enumerate(productos):
-            self.tabla.setItem(i, 0, QTableWidgetItem(str(p.id)))
-            self.tabla.setItem(i, 1, QTableWidgetItem(p.nombre))
-            self.tabla.setItem(i, 2, QTableWidgetItem(p.descripcion or ""))
-            self.tabla.setItem(i, 3, QTableWidgetItem(str(p.precio_compra)))
-            self.tabla.setItem(i, 4, QTableWidgetItem(str(p.precio_venta)))
-            self.tabla.setItem(i, 5, QTableWidgetItem(str(p.stock)))
-            precio_absoluto = float(p.precio_compra) * p.stock
-            self.tabla.setItem(i, 6, QTableWidgetItem(f"{precio_absoluto:.2f}"))
-            self.tabla.setItem(i, 7, QTableWidgetItem(p.categoria or ""))
-            self.tabla.setItem(i, 8, QTableWidgetItem(p.codigo_barras or ""))
+        self.modelo.set_filtros(filtro_busqueda_productos(self.busquedaLineEdit.text()))
+
+    def aplicar_cambio(self, cambio):
+        self.modelo.actualizar_filas(cambio.claves)
 
     def agregar_producto(self):
         dlg = ProductoDialog(self)
@@ -388,49 +534,56 @@ class VentanaProductos(QWidget):
             data = dlg.get_data()
             if data is None:
                 return
-            nuevo = Producto(**data)
-            self.sesion.add(nuevo)
             try:
-                self.sesion.commit()
+                with sesion_operacion() as sesion:
+                    crear_producto(sesion, data)
             except IntegrityError:
-                self.sesion.rollback()
                 QMessageBox.warning(self, "Error", "Ya existe un producto con ese código de barras.")
-            self.cargar_productos()
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
 
     def editar_producto(self):
-        fila = self.tabla.currentRow()
+        fila = self.tabla.currentIndex().row()
         if fila < 0:
             QMessageBox.warning(self, "Aviso", "Selecciona un producto")
             return
-        producto_id = int(self.tabla.item(fila, 0).text())
-        producto = self.sesion.query(Producto).filter_by(id=producto_id).first()
+        producto_id = self.modelo.valor(fila, 0)
+        with sesion_operacion() as sesion:
+            producto = sesion.get(Producto, producto_id)
+        if producto is None:
+            QMessageBox.warning(self, "Error", "Producto no encontrado")
+            return
+        # El diálogo trabaja sobre la copia leída; la escritura es otra operación
         dlg = ProductoDialog(self, producto)
         if dlg.exec() == QDialog.DialogCode.Accepted:
             data = dlg.get_data()
             if data is None:
                 return
-            for clave, valor in data.items():
-                setattr(producto, clave, valor)
             try:
-                self.sesion.commit()
+                with sesion_operacion() as sesion:
+                    actualizar_producto(sesion, producto_id, data, producto.version)
             except IntegrityError:
-                self.sesion.rollback()
                 QMessageBox.warning(self, "Error", "No se pudo actualizar el producto. Verifica el código de barras.")
-            self.cargar_productos()
+            except ProductoModificadoError:
+                QMessageBox.warning(self, "Error", "Otra terminal modificó el producto mientras lo editaba. "
+                                                   "Vuelva a abrirlo para ver los datos actuales.")
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
 
     def eliminar_producto(self):
-        fila = self.tabla.currentRow()
+        fila = self.tabla.currentIndex().row()
         if fila < 0:
             QMessageBox.warning(self, "Aviso", "Selecciona un producto")
             return
-        producto_id = int(self.tabla.item(fila, 0).text())
-        producto = self.sesion.query(Producto).filter_by(id=producto_id).first()
-        if QMessageBox.question(self, "Eliminar", f"¿Eliminar {producto.nombre}?") == QMessageBox.StandardButton.Yes:
+        producto_id = self.modelo.valor(fila, 0)
+        nombre = cache_productos.nombre(producto_id)
+        if QMessageBox.question(self, "Eliminar", f"¿Eliminar {nombre}?") == QMessageBox.StandardButton.Yes:
             try:
-                self.sesion.delete(producto)
-                self.sesion.commit()
+                with sesion_operacion() as sesion:
+                    eliminar_producto(sesion, producto_id)
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
             except IntegrityError:
-                self.sesion.rollback()
                 reply = QMessageBox.question(
                     self,
                     "Error",
@@ -438,33 +591,55 @@ class VentanaProductos(QWidget):
                     QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
                 )
                 if reply == QMessageBox.StandardButton.Yes:
-                    self.destruir_producto(producto)
-            self.cargar_productos()
+                    self.destruir_producto(producto_id, nombre)
 
-    def destruir_producto(self, producto):
+    def destruir_producto(self, producto_id, nombre):
         try:
-            inventario_entries = self.sesion.query(InventarioEntry).filter_by(producto_id=producto.id).all()
-            for entry in inventario_entries:
-                self.sesion.delete(entry)
-            detalles = self.sesion.query(DetalleVenta).filter_by(producto_id=producto.id).all()
-            for detalle in detalles:
-                self.sesion.delete(detalle)
-            self.sesion.delete(producto)
-            self.sesion.commit()
-            QMessageBox.information(self, "Eliminación Extrema", f"Producto {producto.nombre} y todas sus referencias han sido eliminadas.")
+            with sesion_operacion() as sesion:
+                eliminar_producto(sesion, producto_id, con_referencias=True)
+            QMessageBox.information(self, "Eliminación Extrema", f"Producto {nombre} y todas sus referencias han sido eliminadas.")
         except Exception as e:
-            self.sesion.rollback()
             QMessageBox.warning(self, "Error", f"Error al eliminar el producto de forma extrema: {str(e)}")
 
+    def importar_productos(self):
+        ruta, _ = QFileDialog.getOpenFileName(self, "Importar Productos", "", "Planillas (*.csv *.xlsx)")
+        if not ruta:
+            return
+        # En el hilo de la interfaz: al confirmar, los avisos de cambios
+        # actualizan las pantallas abiertas
+        progreso = QProgressDialog("Importando productos...", "Cancelar", 0, 0, self)
+        progreso.setWindowModality(Qt.WindowModality.WindowModal)
+        progreso.show()
+
+        def avanzar(filas):
+            progreso.setLabelText(f"Importando productos... {filas} filas leídas")
+            QApplication.processEvents()
+
+        try:
+            with sesion_operacion() as sesion:
+                resultado = importar_productos(sesion, ruta, avanzar, progreso.wasCanceled)
+        except Exception as e:
+            progreso.reset()
+            QMessageBox.warning(self, "Importar Productos", f"No se importó ninguna fila: {e}")
+            return
+        progreso.reset()
+        mensaje = (f"{resultado.filas} filas leídas: {resultado.creados} productos nuevos, "
+                   f"{resultado.actualizados} actualizados y {resultado.entradas} entradas de stock.")
+        if resultado.errores:
+            mensaje += f"\n\n{len(resultado.errores)} filas con errores:\n" + "\n".join(
+                f"Línea {numero}: {error}" for numero, error in resultado.errores[:20])
+            if len(resultado.errores) > 20:
+                mensaje += f"\n... y {len(resultado.errores) - 20} más"
+        QMessageBox.information(self, "Importar Productos", mensaje)
+
 class InventarioDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Agregar Stock")
         self.layout = QFormLayout(self)
         self.comboProducto = QComboBox()
-        self.sesion = SessionLocal()
-        for prod in self.sesion.query(Producto).all():
-            self.comboProducto.addItem(f"{prod.nombre} (ID: {prod.id})", prod.id)
+        for producto_id, nombre in cache_productos.nombres().items():
+            self.comboProducto.addItem(f"{nombre} (ID: {producto_id})", producto_id)
         self.inputCantidad = QLineEdit()
         self.layout.addRow("Producto", self.comboProducto)
         self.layout.addRow("Cantidad a agregar", self.inputCantidad)
@@ -510,21 +685,28 @@ class InventarioEditDialog(QDialog):
             return None
 
 class VentanaInventario(QWidget):
+    TABLAS = ("inventario", "productos")
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setLayout(QVBoxLayout())
         self.busquedaLineEdit = QLineEdit()
         self.busquedaLineEdit.setPlaceholderText("Buscar en inventario por producto...")
-        self.busquedaLineEdit.textChanged.connect(self.cargar_inventario)
+        self.temporizadorBusqueda = QTimer(self)
+        self.temporizadorBusqueda.setSingleShot(True)
+        self.temporizadorBusqueda.setInterval(RETARDO_BUSQUEDA_MS)
+        self.temporizadorBusqueda.timeout.connect(self.cargar_inventario)
+        self.busquedaLineEdit.textChanged.connect(lambda _: self.temporizadorBusqueda.start())
         self.layout().addWidget(self.busquedaLineEdit)
-        self.tabla = QTableWidget()
-        self.tabla.setColumnCount(5)
-        self.tabla.setHorizontalHeaderLabels(["ID", "Producto", "Cantidad", "Fecha Ingreso", "Precio Absoluto"])
-        header = self.tabla.horizontalHeader()
-        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        self.tabla.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-        self.tabla.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.modelo = ModeloTablaSQL([
+            ("ID", InventarioEntry.id, None),
+            ("Producto", func.coalesce(Producto.nombre, "Desconocido"), None),
+            ("Cantidad", InventarioEntry.cantidad, None),
+            ("Fecha Ingreso", InventarioEntry.fecha_ingreso, formato_fecha),
+            ("Precio Absoluto", func.coalesce(Producto.precio_compra, 0) * InventarioEntry.cantidad, formato_monto),
+        ], lambda q: q.select_from(InventarioEntry).outerjoin(Producto, Producto.id == InventarioEntry.producto_id),
+            InventarioEntry.id, self)
+        self.tabla = crear_vista_tabla(self.modelo)
         self.layout().addWidget(self.tabla)
         btnLayout = QHBoxLayout()
         btnAgregar = QPushButton("Agregar Stock")
@@ -537,29 +719,25 @@ class VentanaInventario(QWidget):
         btnAgregar.clicked.connect(self.agregar_entrada)
         btnModificar.clicked.connect(self.modificar_entrada)
         btnEliminar.clicked.connect(self.eliminar_entrada)
-        self.cargar_inventario()
 
     def cargar_inventario(self):
-        busqueda = self.busquedaLineEdit.text().strip().lower()
-        entradas = self.sesion.query(InventarioEntry).all()
-        if busqueda:
-            entradas = [e for e in entradas if busqueda in (
-                self.sesion.query(Producto).filter_by(id=e.producto_id).first().nombre.lower() 
-                if self.sesion.query(Producto).filter_by(id=e.producto_id).first() else ""
-            )]
-        self.tabla.setRowCount(len(entradas))
-        for i, entry in enumerate(entradas):
-            self.tabla.setItem(i, 0, QTableWidgetItem(str(entry.id)))
-            prod = self.sesion.query(Producto).filter_by(id=entry.producto_id).first()
-            producto_nombre = prod.nombre if prod else "Desconocido"
-            self.tabla.setItem(i, 1, QTableWidgetItem(producto_nombre))
-            self.tabla.setItem(i, 2, QTableWidgetItem(str(entry.cantidad)))
-            self.tabla.setItem(i, 3, QTableWidgetItem(entry.fecha_ingreso.strftime("%Y-%m-%d %H:%M:%S")))
-            if prod:
-                precio_absoluto = float(prod.precio_compra) * entry.cantidad
-            else:
-                precio_absoluto = 0
-            self.tabla.setItem(i, 4, QTableWidgetItem(f"{precio_absoluto:.2f}"))
+        busqueda = self.busquedaLineEdit.text().strip()
+        self.modelo.set_filtros(Producto.nombre.icontains(busqueda, autoescape=True) if busqueda else None)
+
+    def aplicar_cambio(self, cambio):
+        if cambio.tabla == InventarioEntry.__tablename__ or cambio.claves is None:
+            self.modelo.actualizar_filas(cambio.claves)
+            return
+        # De un producto las entradas solo muestran el nombre y el costo: el
+        # stock que descuenta cada venta no las afecta, y uno nuevo no tiene entradas
+        if cambio.operacion == "insert" or (
+                cambio.columnas is not None and not cambio.columnas & {"nombre", "precio_compra"}):
+            return
+        with servicios.engine.connect() as conn:
+            entradas = conn.scalars(
+                select(InventarioEntry.id).where(InventarioEntry.producto_id.in_(cambio.claves))
+            ).all()
+        self.modelo.actualizar_filas(entradas)
 
     def agregar_entrada(self):
         dlg = InventarioDialog(self)
@@ -567,21 +745,20 @@ class VentanaInventario(QWidget):
             data = dlg.get_data()
             if data is None:
                 return
-            prod = self.sesion.query(Producto).filter_by(id=data["producto_id"]).first()
-            if prod:
-                prod.stock += data["cantidad"]
-            nueva = InventarioEntry(producto_id=data["producto_id"], cantidad=data["cantidad"], fecha_ingreso=datetime.now())
-            self.sesion.add(nueva)
-            self.sesion.commit()
-            self.cargar_inventario()
+            try:
+                with sesion_operacion() as sesion:
+                    registrar_entrada_inventario(sesion, data["producto_id"], data["cantidad"])
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
 
     def modificar_entrada(self):
-        fila = self.tabla.currentRow()
+        fila = self.tabla.currentIndex().row()
         if fila < 0:
             QMessageBox.warning(self, "Aviso", "Selecciona una entrada")
             return
-        entrada_id = int(self.tabla.item(fila, 0).text())
-        entrada = self.sesion.query(InventarioEntry).filter_by(id=entrada_id).first()
+        entrada_id = self.modelo.valor(fila, 0)
+        with sesion_operacion() as sesion:
+            entrada = sesion.get(InventarioEntry, entrada_id)
         if not entrada:
             QMessageBox.warning(self, "Error", "Entrada no encontrada")
             return
@@ -590,43 +767,52 @@ class VentanaInventario(QWidget):
             nueva = dlg.get_nueva_cantidad()
             if nueva is None:
                 return
-            diferencia = nueva - entrada.cantidad
-            entrada.cantidad = nueva
-            prod = self.sesion.query(Producto).filter_by(id=entrada.producto_id).first()
-            if prod:
-                prod.stock += diferencia
-            self.sesion.commit()
-            self.cargar_inventario()
+            try:
+                with sesion_operacion() as sesion:
+                    modificar_entrada_inventario(sesion, entrada_id, nueva)
+            except EntradaNoEncontradaError:
+                QMessageBox.warning(self, "Error", "Entrada no encontrada")
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
 
     def eliminar_entrada(self):
-        fila = self.tabla.currentRow()
+        fila = self.tabla.currentIndex().row()
         if fila < 0:
             QMessageBox.warning(self, "Aviso", "Selecciona una entrada")
             return
-        entrada_id = int(self.tabla.item(fila, 0).text())
-        entrada = self.sesion.query(InventarioEntry).filter_by(id=entrada_id).first()
-        if not entrada:
-            QMessageBox.warning(self, "Error", "Entrada no encontrada")
-            return
+        entrada_id = self.modelo.valor(fila, 0)
         if QMessageBox.question(self, "Eliminar Entrada", "¿Está seguro?") != QMessageBox.StandardButton.Yes:
             return
-        prod = self.sesion.query(Producto).filter_by(id=entrada.producto_id).first()
-        if prod:
-            prod.stock -= entrada.cantidad
-        self.sesion.delete(entrada)
-        self.sesion.commit()
-        self.cargar_inventario()
+        try:
+            with sesion_operacion() as sesion:
+                eliminar_entrada_inventario(sesion, entrada_id)
+        except EntradaNoEncontradaError:
+            QMessageBox.warning(self, "Error", "Entrada no encontrada")
+        except BaseOcupadaError as e:
+            QMessageBox.warning(self, "Error", str(e))
 
 class VentanaVentas(QWidget):
+    TABLAS = ("productos", "caja")
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setLayout(QVBoxLayout())
-        if not self.obtener_caja_abierta():
+        caja = self.obtener_caja_abierta()
+        self.caja_id = caja.id if caja else None
+        if not caja:
             QMessageBox.warning(self, "Caja", "La caja no está abierta. Abra la caja antes de vender.")
+        cache_productos.asegurar_cargado()
+        self.scanLineEdit = QLineEdit()
+        self.scanLineEdit.setPlaceholderText("Escanear código de barras...")
+        self.scanLineEdit.returnPressed.connect(self.agregar_por_codigo)
+        self.layout().addWidget(self.scanLineEdit)
         self.busquedaLineEdit = QLineEdit()
         self.busquedaLineEdit.setPlaceholderText("Buscar producto para vender...")
-        self.busquedaLineEdit.textChanged.connect(self.solicitarProductos)
+        self.temporizadorBusqueda = QTimer(self)
+        self.temporizadorBusqueda.setSingleShot(True)
+        self.temporizadorBusqueda.setInterval(RETARDO_BUSQUEDA_MS)
+        self.temporizadorBusqueda.timeout.connect(self.solicitarProductos)
+        self.busquedaLineEdit.textChanged.connect(lambda _: self.temporizadorBusqueda.start())
         self.layout().addWidget(self.busquedaLineEdit)
         formLayout = QHBoxLayout()
         self.comboProducto = QComboBox()
@@ -658,18 +844,49 @@ class VentanaVentas(QWidget):
         totalLayout.addWidget(btnVenta)
         self.layout().addLayout(totalLayout)
         self.carrito = []
+        self.indice_carrito = {}
+        self.scanLineEdit.setFocus()
 
     def obtener_caja_abierta(self):
-        return self.sesion.query(Caja).filter(Caja.fecha_cierre == None).first()
+        with sesion_operacion() as sesion:
+            return caja_abierta(sesion)
+
+    def aplicar_cambio(self, cambio):
+        # El carrito se conserva; solo cambian la caja y el stock mostrado
+        if cambio.tabla == Caja.__tablename__:
+            caja = self.obtener_caja_abierta()
+            self.caja_id = caja.id if caja else None
+        elif cambio.claves is None or cambio.operacion == "insert":
+            self.solicitarProductos()
+        else:
+            self.actualizar_productos_combo(cambio.claves)
+
+    def texto_producto(self, nombre, stock):
+        return f"{nombre} (Stock: {stock})"
 
     def solicitarProductos(self):
-        busqueda = self.busquedaLineEdit.text().strip().lower()
         self.comboProducto.clear()
-        productos = self.sesion.query(Producto).all()
-        if busqueda:
-            productos = [p for p in productos if busqueda in p.nombre.lower()]
+        with sesion_operacion() as sesion:
+            productos = buscar_productos(sesion, self.busquedaLineEdit.text())
         for prod in productos:
-            self.comboProducto.addItem(f"{prod.nombre} (Stock: {prod.stock})", prod.id)
+            self.comboProducto.addItem(self.texto_producto(prod.nombre, prod.stock), prod.id)
+
+    def actualizar_productos_combo(self, claves):
+        indices = {self.comboProducto.itemData(i): i for i in range(self.comboProducto.count())}
+        afectados = [producto_id for producto_id in claves if producto_id in indices]
+        if not afectados:
+            return
+        with servicios.engine.connect() as conn:
+            filas = {fila.id: fila for fila in conn.execute(
+                select(Producto.id, Producto.nombre, Producto.stock).where(Producto.id.in_(afectados))
+            )}
+        # De atrás hacia adelante para que quitar un ítem no corra los demás índices
+        for producto_id in sorted(afectados, key=indices.get, reverse=True):
+            fila = filas.get(producto_id)
+            if fila is None:
+                self.comboProducto.removeItem(indices[producto_id])
+            else:
+                self.comboProducto.setItemText(indices[producto_id], self.texto_producto(fila.nombre, fila.stock))
 
     def agregar_carrito(self):
         if not self.obtener_caja_abierta():
@@ -677,140 +894,302 @@ class VentanaVentas(QWidget):
             return
         prod_id = self.comboProducto.currentData()
         cantidad = self.spinCantidad.value()
-        producto = self.sesion.query(Producto).filter_by(id=prod_id).first()
+        with sesion_operacion() as sesion:
+            producto = sesion.get(Producto, prod_id) if prod_id is not None else None
         if not producto:
             QMessageBox.warning(self, "Error", "Producto no encontrado")
             return
         if cantidad > producto.stock:
             QMessageBox.warning(self, "Error", f"Stock insuficiente para {producto.nombre}")
             return
-        precio = float(producto.precio_venta)
-        subtotal = precio * cantidad
-        for item in self.carrito:
-            if item["producto"].id == prod_id:
-                item["cantidad"] += cantidad
-                item["subtotal"] = item["cantidad"] * precio
-                break
-        else:
-            self.carrito.append({"producto": producto, "cantidad": cantidad, "precio": precio, "subtotal": subtotal})
-        self.actualizar_tabla_carrito()
+        self.agregar_item_carrito(producto.id, producto.nombre, float(producto.precio_venta), cantidad)
+
+    def agregar_por_codigo(self):
+        # Camino rápido del lector: el código se resuelve en cache_productos, sin
+        # tocar el combo. Solo va a la base el primer escaneo después de editar
+        # el nombre, el precio o el código de un producto, para releer esos
+        # productos; las ventas y entradas de stock no la invalidan. El stock se
+        # valida al confirmar la venta.
+        codigo = self.scanLineEdit.text().strip()
+        self.scanLineEdit.clear()
+        if not codigo:
+            return
+        if self.caja_id is None:
+            QMessageBox.warning(self, "Caja", "La caja no está abierta.")
+            return
+        producto = cache_productos.por_codigo(codigo)
+        if producto is None:
+            QMessageBox.warning(self, "Error", f"No hay un producto con el código {codigo}")
+            return
+        producto_id, nombre, precio = producto
+        self.agregar_item_carrito(producto_id, nombre, precio, 1)
+
+    def agregar_item_carrito(self, producto_id, nombre, precio, cantidad):
+        fila = self.indice_carrito.get(producto_id)
+        if fila is None:
+            fila = len(self.carrito)
+            self.indice_carrito[producto_id] = fila
+            self.carrito.append({"producto_id": producto_id, "nombre": nombre, "cantidad": 0, "precio": precio, "subtotal": 0})
+            self.tablaCarrito.setRowCount(fila + 1)
+        item = self.carrito[fila]
+        item["cantidad"] += cantidad
+        item["subtotal"] = item["cantidad"] * item["precio"]
+        self.actualizar_fila_carrito(fila)
+        self.actualizar_total_carrito()
+
+    def actualizar_fila_carrito(self, fila):
+        item = self.carrito[fila]
+        self.tablaCarrito.setItem(fila, 0, QTableWidgetItem(item["nombre"]))
+        self.tablaCarrito.setItem(fila, 1, QTableWidgetItem(str(item["cantidad"])))
+        self.tablaCarrito.setItem(fila, 2, QTableWidgetItem(str(item["precio"])))
+        self.tablaCarrito.setItem(fila, 3, QTableWidgetItem(str(item["subtotal"])))
+
+    def actualizar_total_carrito(self):
+        total = sum(item["subtotal"] for item in self.carrito)
+        self.labelTotal.setText(f"Total: {total:.2f}")
 
     def actualizar_tabla_carrito(self):
         self.tablaCarrito.setRowCount(len(self.carrito))
-        total = 0
-        for i, item in enumerate(self.carrito):
-            self.tablaCarrito.setItem(i, 0, QTableWidgetItem(item["producto"].nombre))
-            self.tablaCarrito.setItem(i, 1, QTableWidgetItem(str(item["cantidad"])))
-            self.tablaCarrito.setItem(i, 2, QTableWidgetItem(str(item["precio"])))
-            self.tablaCarrito.setItem(i, 3, QTableWidgetItem(str(item["subtotal"])))
-            total += item["subtotal"]
-        self.labelTotal.setText(f"Total: {total:.2f}")
+        for fila in range(len(self.carrito)):
+            self.actualizar_fila_carrito(fila)
+        self.actualizar_total_carrito()
 
     def realizar_venta(self):
-        if not self.obtener_caja_abierta():
+        caja = self.obtener_caja_abierta()
+        if not caja:
             QMessageBox.warning(self, "Caja", "La caja no está abierta.")
             return
         if not self.carrito:
             QMessageBox.warning(self, "Error", "El carrito está vacío")
             return
         total = sum(item["subtotal"] for item in self.carrito)
-        caja = self.obtener_caja_abierta()
-        venta = Venta(total=total, caja_id=caja.id)
-        self.sesion.add(venta)
-        self.sesion.commit()
-        for item in self.carrito:
-            prod = self.sesion.query(Producto).filter_by(id=item["producto"].id).first()
-            if item["cantidad"] > prod.stock:
-                QMessageBox.warning(self, "Error", f"Stock insuficiente para {prod.nombre}")
-                return
-            prod.stock -= item["cantidad"]
-            detalle = DetalleVenta(venta_id=venta.id, producto_id=prod.id, cantidad=item["cantidad"], subtotal=item["subtotal"])
-            self.sesion.add(detalle)
-        self.sesion.commit()
-        QMessageBox.information(self, "Venta Realizada", f"Venta realizada. Total: {total:.2f}")
-        generar_reporte_excel_venta(venta)
+        try:
+            with sesion_operacion() as sesion:
+                venta_id = registrar_venta(sesion, caja.id, self.carrito).id
+        except (StockInsuficienteError, BaseOcupadaError) as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+        obtener_cola_reportes().encolar_venta(venta_id)
+        mostrar_estado(self, f"Venta {venta_id} realizada. Total: {total:.2f}")
         self.carrito = []
+        self.indice_carrito = {}
         self.actualizar_tabla_carrito()
-        self.solicitarProductos()
 
-def generar_reporte_excel_venta(venta):
-    session = SessionLocal()
-    venta_info = {
-        "Venta ID": venta.id,
-        "Fecha": venta.fecha.strftime("%Y-%m-%d %H:%M:%S"),
-        "Total": float(venta.total)
-    }
-    df_venta = pd.DataFrame([venta_info])
-    query = session.query(DetalleVenta, Producto)\
-        .join(Producto, Producto.id == DetalleVenta.producto_id)\
-        .filter(DetalleVenta.venta_id == venta.id).all()
-    detalle_list = []
-    for detalle, producto in query:
-        detalle_list.append({
-            "Producto": producto.nombre,
-            "Cantidad": detalle.cantidad,
-            "Precio Venta": float(producto.precio_venta),
-            "Subtotal": float(detalle.subtotal)
-        })
-    df_detalle = pd.DataFrame(detalle_list)
-    if not df_detalle.empty:
-        df_productos = df_detalle.groupby("Producto", as_index=False)\
-            .agg({"Cantidad": "sum", "Subtotal": "sum"})\
-            .rename(columns={"Cantidad": "Cantidad Total", "Subtotal": "Total Ventas"})
-    else:
-        df_productos = pd.DataFrame(columns=["Producto", "Cantidad Total", "Total Ventas"])
-    filename, _ = QFileDialog.getSaveFileName(None, "Guardar reporte Excel de Venta", "", "Excel Files (*.xlsx)")
-    if filename:
-        try:
-            with pd.ExcelWriter(filename, engine="openpyxl") as writer:
-                df_venta.to_excel(writer, sheet_name="Venta", index=False)
-                df_detalle.to_excel(writer, sheet_name="Detalle Venta", index=False)
-                df_productos.to_excel(writer, sheet_name="Productos Vendidos", index=False)
-            QMessageBox.information(None, "Reporte Excel", "Reporte de venta generado exitosamente.")
-        except Exception as e:
-            QMessageBox.warning(None, "Reporte Excel", f"Error al exportar: {str(e)}")
-    session.close()
+def condiciones_ventas(desde, hasta=None, caja_id=None):
+    # desde y hasta son fechas inclusivas; sin hasta, sin cota superior
+    condiciones = [Venta.fecha >= datetime.combine(desde, datetime.min.time()), None, None]
+    if hasta:
+        condiciones[1] = Venta.fecha < datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+    if caja_id:
+        condiciones[2] = Venta.caja_id == caja_id
+    return condiciones
+
+# Historial de ventas y detalle de una venta; verificar_planes_consulta
+# revisa sus páginas
+def modelo_historial_ventas(parent=None):
+    return ModeloTablaSQL([
+        ("Venta ID", Venta.id, None),
+        ("Fecha", Venta.fecha, formato_fecha),
+        ("Caja", Venta.caja_id, None),
+        ("Total", Venta.total, formato_monto),
+    ], lambda q: q.select_from(Venta).where(Venta.estado == VENTA_ACTIVA), Venta.id, parent)
+
+def modelo_detalle_venta(parent=None):
+    return ModeloTablaSQL([
+        ("Producto ID", Producto.id, None),
+        ("Producto", Producto.nombre, None),
+        ("Cantidad", DetalleVenta.cantidad, None),
+        ("Subtotal", DetalleVenta.subtotal, formato_monto),
+    ], lambda q: q.select_from(DetalleVenta).join(Producto, Producto.id == DetalleVenta.producto_id),
+        DetalleVenta.id, parent)
+
+# Rango de fechas y caja de las pantallas de ventas; por defecto, el turno actual
+class FiltrosVentas(QWidget):
+    LIMITE_CAJAS = 100
+    cambiado = pyqtSignal()
 
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.fechaDesde = QDateEdit()
+        self.fechaHasta = QDateEdit(QDate.currentDate())
+        for campo in (self.fechaDesde, self.fechaHasta):
+            campo.setCalendarPopup(True)
+            campo.setDisplayFormat("yyyy-MM-dd")
+        self.comboCaja = QComboBox()
+        self.cargar_cajas()
+        # Mientras el usuario no los cambie, los filtros siguen al turno abierto
+        # y "hasta" queda sin cota, así entran las ventas de pasada la medianoche
+        self.cajaTurno = None
+        self.desdeTurno = QDate.currentDate()
+        self.hastaAbierto = True
+        self.fechaDesde.setDate(self.desdeTurno)
+        self.seguir_turno()
+        layout.addWidget(QLabel("Desde:"))
+        layout.addWidget(self.fechaDesde)
+        layout.addWidget(QLabel("Hasta:"))
+        layout.addWidget(self.fechaHasta)
+        layout.addWidget(QLabel("Caja:"))
+        layout.addWidget(self.comboCaja)
+        self.fechaDesde.dateChanged.connect(self.cambiado)
+        self.fechaHasta.dateChanged.connect(self.fijar_hasta)
+        self.comboCaja.currentIndexChanged.connect(self.cambiado)
+
+    def fijar_hasta(self):
+        self.hastaAbierto = False
+        self.cambiado.emit()
+
+    def avanzar_hasta(self):
+        if self.hastaAbierto:
+            self.fechaHasta.blockSignals(True)
+            self.fechaHasta.setDate(QDate.currentDate())
+            self.fechaHasta.blockSignals(False)
+
+    def seguir_turno(self):
+        # Devuelve si movió los filtros al turno abierto
+        if self.comboCaja.currentData() != self.cajaTurno or self.fechaDesde.date() != self.desdeTurno:
+            return False
+        with sesion_operacion() as sesion:
+            caja = caja_abierta(sesion)
+        if caja is None or caja.id == self.cajaTurno:
+            return False
+        apertura = caja.fecha_apertura
+        self.cajaTurno = caja.id
+        self.desdeTurno = QDate(apertura.year, apertura.month, apertura.day)
+        for campo in (self.fechaDesde, self.comboCaja):
+            campo.blockSignals(True)
+        self.fechaDesde.setDate(self.desdeTurno)
+        self.comboCaja.setCurrentIndex(max(self.comboCaja.findData(caja.id), 0))
+        for campo in (self.fechaDesde, self.comboCaja):
+            campo.blockSignals(False)
+        self.avanzar_hasta()
+        return True
+
+    def condiciones(self):
+        self.avanzar_hasta()
+        hasta = None if self.hastaAbierto else self.fechaHasta.date().toPyDate()
+        return condiciones_ventas(self.fechaDesde.date().toPyDate(), hasta, self.comboCaja.currentData())
+
+    def cargar_cajas(self):
+        seleccion = self.comboCaja.currentData()
+        self.comboCaja.blockSignals(True)
+        self.comboCaja.clear()
+        self.comboCaja.addItem("Todas las cajas", None)
+        with sesion_operacion() as sesion:
+            cajas = sesion.execute(
+                select(Caja.id, Caja.fecha_apertura).order_by(Caja.id.desc()).limit(self.LIMITE_CAJAS)
+            ).all()
+        for caja_id, apertura in cajas:
+            self.comboCaja.addItem(f"Caja {caja_id} ({apertura.strftime('%Y-%m-%d %H:%M')})", caja_id)
+        self.comboCaja.setCurrentIndex(max(self.comboCaja.findData(seleccion), 0))
+        self.comboCaja.blockSignals(False)
+
+    def aplicar_cambio_cajas(self, cambio):
+        # El combo solo cambia con altas y bajas de cajas
+        if cambio.claves is None or cambio.operacion != "update":
+            self.cargar_cajas()
+            if self.seguir_turno():
+                self.cambiado.emit()
+
+    def showEvent(self, evento):
+        super().showEvent(evento)
+        self.avanzar_hasta()
+
+# Historial de ventas: una fila por venta, páginas por (fecha, id) y totales
+# del rango calculados en SQL; el detalle se carga solo para la venta elegida
 class VentanaVentasRealizadas(QWidget):
+    TABLAS = ("ventas", "detalle_ventas", "productos", "caja")
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setLayout(QVBoxLayout())
-        self.tablaVentas = QTableWidget()
-        self.tablaVentas.setColumnCount(7)
-        self.tablaVentas.setHorizontalHeaderLabels(["Venta ID", "Fecha", "Total", "Producto ID", "Producto", "Cantidad", "Subtotal"])
-        header = self.tablaVentas.horizontalHeader()
-        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        self.tablaVentas.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-        self.tablaVentas.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
-        self.layout().addWidget(self.tablaVentas)
-        self.cargar_ventas()
+        filtrosLayout = QHBoxLayout()
+        self.filtrosVentas = FiltrosVentas()
+        self.filtrosVentas.cambiado.connect(self.cargar_ventas)
+        filtrosLayout.addWidget(self.filtrosVentas)
+        self.productoLineEdit = QLineEdit()
+        self.productoLineEdit.setPlaceholderText("Filtrar por producto...")
+        self.temporizadorBusqueda = QTimer(self)
+        self.temporizadorBusqueda.setSingleShot(True)
+        self.temporizadorBusqueda.setInterval(RETARDO_BUSQUEDA_MS)
+        self.temporizadorBusqueda.timeout.connect(self.cargar_ventas)
+        self.productoLineEdit.textChanged.connect(lambda _: self.temporizadorBusqueda.start())
+        filtrosLayout.addWidget(QLabel("Producto:"))
+        filtrosLayout.addWidget(self.productoLineEdit)
+        filtrosLayout.addStretch()
+        self.layout().addLayout(filtrosLayout)
+        self.labelTotales = QLabel()
+        self.layout().addWidget(self.labelTotales)
+        self.modeloVentas = modelo_historial_ventas(self)
+        self.modeloVentas.set_filtros(*self.filtros(), recargar=False)
+        self.tablaVentas = crear_vista_tabla(self.modeloVentas, 1, Qt.SortOrder.DescendingOrder)
+        self.tablaVentas.selectionModel().currentRowChanged.connect(self.mostrar_detalle)
+        self.layout().addWidget(self.tablaVentas, 3)
+        self.modeloDetalle = modelo_detalle_venta(self)
+        self.modeloDetalle.set_filtros(false(), recargar=False)
+        self.tablaDetalle = crear_vista_tabla(self.modeloDetalle)
+        self.layout().addWidget(self.tablaDetalle, 1)
+        self.actualizar_totales()
+
+    def filtros(self):
+        producto = filtro_busqueda_productos(self.productoLineEdit.text())
+        if producto is not None:
+            producto = Venta.id.in_(
+                select(DetalleVenta.venta_id).join(Producto, Producto.id == DetalleVenta.producto_id).where(producto)
+            )
+        return self.filtrosVentas.condiciones() + [producto]
 
     def cargar_ventas(self):
-        query = self.sesion.query(Venta, DetalleVenta, Producto)\
-            .join(DetalleVenta, Venta.id == DetalleVenta.venta_id)\
-            .join(Producto, Producto.id == DetalleVenta.producto_id).all()
-        self.tablaVentas.setRowCount(len(query))
-        for i, (venta, detalle, producto) in enumerate(query):
-            self.tablaVentas.setItem(i, 0, QTableWidgetItem(str(venta.id)))
-            self.tablaVentas.setItem(i, 1, QTableWidgetItem(venta.fecha.strftime("%Y-%m-%d %H:%M:%S")))
-            self.tablaVentas.setItem(i, 2, QTableWidgetItem(str(venta.total)))
-            self.tablaVentas.setItem(i, 3, QTableWidgetItem(str(producto.id)))
-            self.tablaVentas.setItem(i, 4, QTableWidgetItem(producto.nombre))
-            self.tablaVentas.setItem(i, 5, QTableWidgetItem(str(detalle.cantidad)))
-            self.tablaVentas.setItem(i, 6, QTableWidgetItem(str(detalle.subtotal)))
+        self.modeloVentas.set_filtros(*self.filtros())
+        self.modeloDetalle.set_filtros(false())
+        self.actualizar_totales()
+
+    def actualizar_totales(self):
+        with sesion_operacion() as sesion:
+            cantidad, total, promedio = totales_ventas(sesion, *self.filtros())
+        self.labelTotales.setText(
+            f"Ventas: {cantidad}    Total: {float(total):.2f}    Ticket promedio: {float(promedio or 0):.2f}"
+        )
+        self.totalesVigentes = True
+
+    def mostrar_detalle(self, actual, anterior=None):
+        venta_id = self.modeloVentas.valor(actual.row(), 0) if actual.isValid() else None
+        self.modeloDetalle.set_filtros(DetalleVenta.venta_id == venta_id if venta_id else false())
+
+    def showEvent(self, evento):
+        super().showEvent(evento)
+        if not self.totalesVigentes:
+            self.actualizar_totales()
+
+    def aplicar_cambio(self, cambio):
+        if cambio.tabla == Venta.__tablename__:
+            self.modeloVentas.actualizar_filas(cambio.claves)
+            # Oculta, la pantalla recalcula los totales cuando se vuelve a mostrar
+            self.totalesVigentes = False
+            if self.isVisible():
+                self.actualizar_totales()
+        elif cambio.tabla == Caja.__tablename__:
+            self.filtrosVentas.aplicar_cambio_cajas(cambio)
+        elif cambio.tabla == DetalleVenta.__tablename__ or cambio.claves is None:
+            self.modeloDetalle.actualizar_filas(cambio.claves)
+        else:
+            # Producto cambiado: solo las líneas a la vista que lo muestran
+            self.modeloDetalle.actualizar_filas(
+                [fila[-1] for fila in self.modeloDetalle.filas if fila[0] in cambio.claves])
 
 class VentanaCaja(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setWindowTitle("Caja")
         self.layout = QVBoxLayout(self)
         self.caja_abierta = self.obtener_caja_abierta()
         if self.caja_abierta:
             self.labelInfo = QLabel(
                 f"Caja abierta desde: {self.caja_abierta.fecha_apertura.strftime('%Y-%m-%d %H:%M:%S')}<br>"
-                f"Monto Apertura: {self.caja_abierta.monto_apertura:.2f}"
+                f"Monto Apertura: {self.caja_abierta.monto_apertura:.2f}<br>"
+                f"Ventas del turno: {self.caja_abierta.num_ventas - self.caja_abierta.num_canceladas} "
+                f"por {total_neto_caja(self.caja_abierta):.2f}"
             )
             self.labelInfo.setTextFormat(Qt.TextFormat.RichText)
             self.layout.addWidget(self.labelInfo)
@@ -830,7 +1209,8 @@ class VentanaCaja(QDialog):
             self.layout.addWidget(self.btnAbrirCaja)
 
     def obtener_caja_abierta(self):
-        return self.sesion.query(Caja).filter(Caja.fecha_cierre == None).first()
+        with sesion_operacion() as sesion:
+            return caja_abierta(sesion)
 
     def abrir_caja(self):
         try:
@@ -838,53 +1218,42 @@ class VentanaCaja(QDialog):
         except ValueError:
             QMessageBox.warning(self, "Error", "Monto inválido")
             return
-        caja = Caja(monto_apertura=monto)
-        self.sesion.add(caja)
-        self.sesion.commit()
+        try:
+            with sesion_operacion() as sesion:
+                abrir_caja(sesion, monto)
+        except BaseOcupadaError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
         QMessageBox.information(self, "Caja", "Caja abierta exitosamente.")
         self.accept()
 
     def cerrar_caja(self):
-        caja = self.caja_abierta
-        if not caja:
+        if not self.caja_abierta:
             QMessageBox.warning(self, "Error", "No hay caja abierta.")
             return
+        caja_id = self.caja_abierta.id
         try:
-            if self.inputMontoCierre.text().strip() == "":
-                hoy = datetime.now()
-                ventas = self.sesion.query(Venta).filter(
-                    Venta.caja_id == caja.id,
-                    Venta.fecha >= caja.fecha_apertura,
-                    Venta.fecha <= hoy
-                ).all()
-                total = sum(v.total for v in ventas)
-                saldo_final = float(caja.monto_apertura) + float(total)
-                monto_cierre = saldo_final
-            else:
-                monto_cierre = float(self.inputMontoCierre.text())
+            texto = self.inputMontoCierre.text().strip()
+            monto_cierre = float(texto) if texto else None
         except ValueError:
             QMessageBox.warning(self, "Error", "Monto Cierre inválido")
             return
-        hoy = datetime.now()
-        ventas = self.sesion.query(Venta).filter(
-            Venta.caja_id == caja.id,
-            Venta.fecha >= caja.fecha_apertura,
-            Venta.fecha <= hoy
-        ).all()
-        total = sum(v.total for v in ventas)
-        caja.total_ventas = total
-        caja.fecha_cierre = hoy
-        caja.monto_cierre = monto_cierre
-        self.sesion.commit()
+        try:
+            with sesion_operacion() as sesion:
+                total, monto_cierre = cerrar_caja(sesion, caja_id, monto_cierre)
+        except (CajaNoAbiertaError, BaseOcupadaError) as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
         QMessageBox.information(self, "Caja", f"Caja cerrada. Total ventas: {total:.2f}. Monto Cierre: {monto_cierre:.2f}")
-        preview_dialog = ReportePreviewDialog(caja, self)
+        preview_dialog = ReportePreviewDialog(caja_id, self)
         preview_dialog.exec()
         self.accept()
 
 class VentanaCajaModule(QWidget):
+    TABLAS = ("caja",)
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         layout = QVBoxLayout(self)
         self.tablaCaja = QTableWidget()
         self.tablaCaja.setColumnCount(5)
@@ -900,10 +1269,15 @@ class VentanaCajaModule(QWidget):
         self.btnPrevisualizar = QPushButton("Previsualización")
         self.btnPrevisualizar.clicked.connect(self.previsualizar_reporte)
         layout.addWidget(self.btnPrevisualizar)
+        self.btnConciliar = QPushButton("Verificar Totales")
+        self.btnConciliar.clicked.connect(self.conciliar)
+        layout.addWidget(self.btnConciliar)
         self.actualizar()
 
     def actualizar(self):
-        cajas = self.sesion.query(Caja).filter(Caja.fecha_cierre != None).all()
+        with sesion_operacion() as sesion:
+            cajas = sesion.query(Caja).filter(Caja.fecha_cierre != None).all()
+            openCaja = sesion.query(Caja.id).filter(Caja.fecha_cierre == None).first()
         self.tablaCaja.setRowCount(len(cajas))
         for i, caja in enumerate(cajas):
             self.tablaCaja.setItem(i, 0, QTableWidgetItem(str(caja.id)))
@@ -911,16 +1285,23 @@ class VentanaCajaModule(QWidget):
             self.tablaCaja.setItem(i, 2, QTableWidgetItem(caja.fecha_cierre.strftime("%Y-%m-%d %H:%M:%S")))
             self.tablaCaja.setItem(i, 3, QTableWidgetItem(str(caja.monto_apertura)))
             self.tablaCaja.setItem(i, 4, QTableWidgetItem(str(caja.total_ventas if caja.total_ventas else 0)))
-        openCaja = self.sesion.query(Caja).filter(Caja.fecha_cierre == None).first()
+        self.cajaAbierta = openCaja.id if openCaja else None
         if openCaja:
             self.btnCaja.setText("Cerrar Caja")
         else:
             self.btnCaja.setText("Abrir Caja")
 
+    def aplicar_cambio(self, cambio):
+        # Cada venta actualiza la caja abierta, que no figura en la lista: solo
+        # se recarga si cambió otra caja o si la abierta se cerró
+        if cambio.operacion == "update" and cambio.claves == {self.cajaAbierta}:
+            with servicios.engine.connect() as conn:
+                if conn.scalar(select(Caja.fecha_cierre).where(Caja.id == self.cajaAbierta)) is None:
+                    return
+        self.actualizar()
+
     def accion_caja(self):
-        dialog = VentanaCaja(self)
-        if dialog.exec() == QDialog.DialogCode.Accepted:
-            self.actualizar()
+        VentanaCaja(self).exec()
 
     def previsualizar_reporte(self):
         fila = self.tablaCaja.currentRow()
@@ -928,72 +1309,91 @@ class VentanaCajaModule(QWidget):
             QMessageBox.warning(self, "Aviso", "Seleccione una caja para previsualizar su reporte.")
             return
         caja_id = int(self.tablaCaja.item(fila, 0).text())
-        caja = self.sesion.query(Caja).filter_by(id=caja_id).first()
-        if not caja:
+        with sesion_operacion() as sesion:
+            existe = sesion.get(Caja, caja_id) is not None
+        if not existe:
             QMessageBox.warning(self, "Error", "No se encontró la caja seleccionada.")
             return
-        preview_dialog = ReportePreviewDialog(caja, self)
+        preview_dialog = ReportePreviewDialog(caja_id, self)
         preview_dialog.exec()
 
+    def conciliar(self):
+        fila = self.tablaCaja.currentRow()
+        if fila < 0:
+            QMessageBox.warning(self, "Aviso", "Seleccione una caja para verificar sus totales.")
+            return
+        caja_id = int(self.tablaCaja.item(fila, 0).text())
+        with sesion_operacion() as sesion:
+            diferencias = conciliar_caja(sesion, caja_id)
+        if not diferencias:
+            QMessageBox.information(self, "Caja", "Los totales acumulados coinciden con las ventas registradas.")
+            return
+        detalle = "\n".join(f"{campo}: acumulado {acumulado}, según ventas {calculado}"
+                            for campo, (acumulado, calculado) in diferencias.items())
+        if QMessageBox.question(
+            self, "Caja", f"Los totales no coinciden:\n{detalle}\n\n¿Corregir los acumulados?"
+        ) == QMessageBox.StandardButton.Yes:
+            try:
+                with sesion_operacion() as sesion:
+                    corregir_caja(sesion, caja_id)
+            except BaseOcupadaError as e:
+                QMessageBox.warning(self, "Error", str(e))
+
 class VentanaDevoluciones(QWidget):
+    TABLAS = ("ventas", "caja")
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.sesion = SessionLocal()
         self.setLayout(QVBoxLayout())
-        self.tablaDevoluciones = QTableWidget()
-        self.tablaDevoluciones.setColumnCount(4)
-        self.tablaDevoluciones.setHorizontalHeaderLabels(["Venta ID", "Fecha", "Total", "Estado"])
-        header = self.tablaDevoluciones.horizontalHeader()
-        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        self.tablaDevoluciones.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-        self.tablaDevoluciones.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        filtrosLayout = QHBoxLayout()
+        self.filtrosVentas = FiltrosVentas()
+        self.filtrosVentas.cambiado.connect(self.cargar_devoluciones)
+        filtrosLayout.addWidget(self.filtrosVentas)
+        filtrosLayout.addStretch()
+        self.layout().addLayout(filtrosLayout)
+        self.modeloDevoluciones = ModeloTablaSQL([
+            ("Venta ID", Venta.id, None),
+            ("Fecha", Venta.fecha, formato_fecha),
+            ("Total", Venta.total, None),
+            ("Estado", Venta.estado, ESTADOS_VENTA.get),
+        ], lambda q: q.select_from(Venta).where(Venta.caja_id != None),
+            Venta.id, self)
+        self.modeloDevoluciones.set_filtros(*self.filtrosVentas.condiciones(), recargar=False)
+        self.tablaDevoluciones = crear_vista_tabla(self.modeloDevoluciones, 1, Qt.SortOrder.DescendingOrder)
         self.layout().addWidget(self.tablaDevoluciones)
         btnCancelarVenta = QPushButton("Cancelar Venta")
         btnCancelarVenta.clicked.connect(self.cancelar_venta)
         self.layout().addWidget(btnCancelarVenta)
-        self.cargar_devoluciones()
 
     def cargar_devoluciones(self):
-        ventas = self.sesion.query(Venta).filter(Venta.caja_id != None).all()
-        self.tablaDevoluciones.setRowCount(len(ventas))
-        for i, v in enumerate(ventas):
-            cancelacion = self.sesion.query(VentaCancelada).filter_by(venta_id=v.id).first()
-            estado = "Cancelada" if cancelacion else "Activa"
-            self.tablaDevoluciones.setItem(i, 0, QTableWidgetItem(str(v.id)))
-            self.tablaDevoluciones.setItem(i, 1, QTableWidgetItem(v.fecha.strftime("%Y-%m-%d %H:%M:%S")))
-            self.tablaDevoluciones.setItem(i, 2, QTableWidgetItem(str(v.total)))
-            self.tablaDevoluciones.setItem(i, 3, QTableWidgetItem(estado))
+        self.modeloDevoluciones.set_filtros(*self.filtrosVentas.condiciones())
+
+    def aplicar_cambio(self, cambio):
+        if cambio.tabla == Venta.__tablename__:
+            self.modeloDevoluciones.actualizar_filas(cambio.claves)
+        else:
+            self.filtrosVentas.aplicar_cambio_cajas(cambio)
 
     def cancelar_venta(self):
-        fila = self.tablaDevoluciones.currentRow()
+        fila = self.tablaDevoluciones.currentIndex().row()
         if fila < 0:
             QMessageBox.warning(self, "Aviso", "Selecciona una venta para cancelar")
             return
-        venta_id = int(self.tablaDevoluciones.item(fila, 0).text())
-        venta = self.sesion.query(Venta).filter_by(id=venta_id).first()
-        if not venta:
-            QMessageBox.warning(self, "Error", "Venta no encontrada")
+        venta_id = self.modeloDevoluciones.valor(fila, 0)
+        motivo, ok = QInputDialog.getText(self, "Cancelar Venta", f"Motivo de la cancelación de la venta {venta_id}:")
+        if not ok:
             return
-        if QMessageBox.question(self, "Cancelar Venta", "¿Está seguro de cancelar esta venta? Esto eliminará la venta.") != QMessageBox.StandardButton.Yes:
+        try:
+            with sesion_operacion() as sesion:
+                total = cancelar_venta(sesion, venta_id, motivo.strip() or None)
+        except (VentaNoCancelableError, BaseOcupadaError) as e:
+            QMessageBox.warning(self, "Error", str(e))
             return
-        if venta.caja_id:
-            caja = self.sesion.query(Caja).filter_by(id=venta.caja_id).first()
-            if caja and caja.total_ventas:
-                caja.total_ventas -= venta.total
-                if caja.total_ventas < 0:
-                    caja.total_ventas = 0
-        detalles = self.sesion.query(DetalleVenta).filter_by(venta_id=venta.id).all()
-        for d in detalles:
-            prod = self.sesion.query(Producto).filter_by(id=d.producto_id).first()
-            if prod:
-                prod.stock += d.cantidad
-            self.sesion.delete(d)
-        self.sesion.delete(venta)
-        self.sesion.commit()
-        QMessageBox.information(self, "Cancelación", "Venta cancelada y eliminada, stock reabastecido.")
-        self.cargar_devoluciones()
+        mostrar_estado(self, f"Venta {venta_id} cancelada ({float(total):.2f}), stock reabastecido.")
 
 class MainMenu(QWidget):
+    TABLAS = ()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.mainWindow = parent
@@ -1018,15 +1418,117 @@ class MainMenu(QWidget):
                 col = 0
                 row += 1
 
+# Tiempos de arranque desde el inicio de las importaciones. Con
+# SALUS_TRAZA_ARRANQUE=1 cada etapa se informa por stderr.
+class TrazaArranque:
+    def __init__(self, inicio):
+        self.inicio = inicio
+        self.etapas = []
+        self.activa = str(config_valor("traza_arranque", "")).lower() in ("1", "true", "si")
+
+    def marcar(self, etapa):
+        ms = (time.perf_counter() - self.inicio) * 1000
+        self.etapas.append((etapa, ms))
+        if self.activa:
+            print(f"[arranque] {etapa}: {ms:.0f} ms", file=sys.stderr, flush=True)
+
+traza_arranque = TrazaArranque(INICIO_ARRANQUE)
+
+class DetectorPrimerPintado(QObject):
+    def __init__(self, widget, al_pintar):
+        super().__init__(widget)
+        self.al_pintar = al_pintar
+        widget.installEventFilter(self)
+
+    def eventFilter(self, objeto, evento):
+        if evento.type() == QEvent.Type.Paint:
+            objeto.removeEventFilter(self)
+            self.al_pintar()
+        return False
+
+class DetectorAcciones(QObject):
+    # Filtro de toda la aplicación: cada entrada del usuario abre una acción
+    # nueva en medidor_sql. Un evento que el hijo ignora se propaga al padre;
+    # esa segunda llegada no es una acción nueva. El clic empieza al apretar:
+    # lo que el widget hace al soltar (clicked) queda dentro de la misma acción.
+    TIPOS = {
+        QEvent.Type.MouseButtonPress: "Clic", QEvent.Type.MouseButtonDblClick: "Doble clic",
+        QEvent.Type.KeyPress: "Tecla", QEvent.Type.Wheel: "Rueda",
+    }
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.ultimo = None
+        app.installEventFilter(self)
+
+    def eventFilter(self, objeto, evento):
+        tipo = self.TIPOS.get(evento.type())
+        if tipo is None or not isinstance(objeto, QWidget):
+            return False
+        if tipo == "Tecla" and evento.isAutoRepeat():
+            return False
+        marca = (evento.type(), evento.timestamp())
+        if self.ultimo and self.ultimo[0] == marca and self.propagado(objeto, self.ultimo[1]):
+            return False
+        self.ultimo = (marca, objeto)
+        medidor_sql.iniciar_accion(f"{tipo} en {self.describir(objeto)}")
+        return False
+
+    def propagado(self, objeto, anterior):
+        try:
+            return objeto.isAncestorOf(anterior)
+        except RuntimeError:
+            # El widget anterior ya fue destruido
+            return False
+
+    def describir(self, widget):
+        # Las vistas reciben los clics en su viewport, un QWidget sin nombre
+        while type(widget) is QWidget and widget.parentWidget():
+            widget = widget.parentWidget()
+        if isinstance(widget, QMenu) and widget.activeAction():
+            descripcion = f"menú «{widget.activeAction().text()}»"
+        elif isinstance(widget, QAbstractButton):
+            descripcion = f"botón «{widget.text()}»"
+        elif isinstance(widget, QLineEdit) and widget.placeholderText():
+            descripcion = f"campo «{widget.placeholderText()}»"
+        else:
+            descripcion = type(widget).__name__
+        modulo = widget
+        while modulo is not None and not hasattr(modulo, "TABLAS"):
+            modulo = modulo.parentWidget()
+        return f"{descripcion} ({type(modulo).__name__})" if modulo is not None else descripcion
+
 class VentanaPrincipal(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Salus JJV - Sistema de Ventas")
         self.setWindowIcon(QIcon("icon.ico"))
         self.setGeometry(100, 100, 1000, 600)
+        cola = obtener_cola_reportes()
+        cola.terminado.connect(lambda ruta: self.statusBar().showMessage(f"Reporte guardado en {ruta}", 5000))
+        cola.fallido.connect(lambda error: self.statusBar().showMessage(f"Error al generar reporte. {error}", 15000))
+        self.datosIniciados = False
+        # Cada módulo se crea la primera vez que se abre y queda en la pila,
+        # suscrito a los cambios de las tablas que muestra
+        self.pilaModulos = QStackedWidget()
+        self.setCentralWidget(self.pilaModulos)
+        self.modulos = {}
+        DetectorPrimerPintado(self, self.primer_pintado)
+        DetectorAcciones(QApplication.instance())
+        self.etiquetaSQL = QLabel()
+        self.statusBar().addPermanentWidget(self.etiquetaSQL)
+        self.temporizadorSQL = QTimer(self)
+        self.temporizadorSQL.setInterval(500)
+        self.temporizadorSQL.timeout.connect(self.actualizar_costo_sql)
+        # Respaldo por si la ventana no llega a pintarse (por ejemplo, minimizada)
+        QTimer.singleShot(1000, self.iniciar_datos)
         self.init_ui()
         self.showMaximized()
 
+    def primer_pintado(self):
+        traza_arranque.marcar("primer pintado")
+        QTimer.singleShot(0, self.iniciar_datos)
+
     def init_ui(self):
         archivo_menu = self.menuBar().addMenu("Archivo")
         salir_action = QAction("Salir", self)
@@ -1058,9 +1560,18 @@ class VentanaPrincipal(QMainWindow):
         acerca_action = QAction("Acerca de", self)
         acerca_action.triggered.connect(lambda: QMessageBox.information(self, "Acerca de", "Salus JJV\nVersión 1.0"))
         exportar_db_action = QAction("Exportar Base de Datos", self)
-        exportar_db_action.triggered.connect(exportar_base_datos_json)
+        exportar_db_action.triggered.connect(self.exportar_base_datos)
+        self.costo_sql_action = QAction("Costo SQL por acción", self)
+        self.costo_sql_action.setShortcut(QKeySequence(Qt.Key.Key_F12))
+        self.costo_sql_action.setCheckable(True)
+        self.costo_sql_action.setEnabled(medidor_sql.activo)
+        self.costo_sql_action.toggled.connect(self.mostrar_costo_sql)
         ayuda_menu.addAction(acerca_action)
         ayuda_menu.addAction(exportar_db_action)
+        ayuda_menu.addAction(self.costo_sql_action)
+        self.costo_sql_action.setChecked(
+            medidor_sql.activo and str(config_valor("costo_sql_visible", "")).lower() in ("1", "true", "si"))
+        self.mostrar_costo_sql(self.costo_sql_action.isChecked())
         self.mostrar_main_menu()
 
     def keyPressEvent(self, event):
@@ -1069,49 +1580,289 @@ class VentanaPrincipal(QMainWindow):
         else:
             super().keyPressEvent(event)
 
+    def mostrar_costo_sql(self, visible):
+        self.etiquetaSQL.setVisible(visible)
+        if visible:
+            self.actualizar_costo_sql()
+            self.temporizadorSQL.start()
+        else:
+            self.temporizadorSQL.stop()
+
+    def actualizar_costo_sql(self):
+        accion = medidor_sql.accion
+        self.etiquetaSQL.setText(f"{accion.nombre}: {accion.consultas} consultas, "
+                                 f"{accion.segundos * 1000:.1f} ms, {accion.filas} filas")
+
+    def exportar_base_datos(self):
+        if getattr(self, "hiloExportacion", None) and self.hiloExportacion.isRunning():
+            QMessageBox.information(self, "Exportar Base de Datos", "Ya hay una exportación en curso.")
+            return
+        filename, _ = QFileDialog.getSaveFileName(
+            self, "Exportar Base de Datos", "",
+            "NDJSON (*.ndjson);;NDJSON gzip (*.ndjson.gz);;NDJSON zstd (*.ndjson.zst);;"
+            "JSON (*.json);;JSON gzip (*.json.gz);;JSON zstd (*.json.zst)"
+        )
+        if not filename:
+            return
+        formato, compresion = formato_desde_nombre(filename)
+        self.hiloExportacion = HiloExportacion(filename, formato, compresion, self)
+        self.progresoExportacion = QProgressDialog("Exportando base de datos...", "Cancelar", 0, 0, self)
+        self.progresoExportacion.setWindowModality(Qt.WindowModality.NonModal)
+        self.progresoExportacion.canceled.connect(lambda: setattr(self.hiloExportacion, "cancelar", True))
+        self.hiloExportacion.progreso.connect(self.actualizar_progreso_exportacion)
+        self.hiloExportacion.terminado.connect(self.exportacion_terminada)
+        self.hiloExportacion.fallido.connect(self.exportacion_fallida)
+        self.progresoExportacion.show()
+        self.hiloExportacion.start()
+
+    def actualizar_progreso_exportacion(self, procesadas, total):
+        self.progresoExportacion.setMaximum(total)
+        self.progresoExportacion.setValue(procesadas)
+
+    def exportacion_terminada(self, ruta):
+        self.progresoExportacion.reset()
+        self.statusBar().showMessage(f"Base de datos exportada en {ruta}", 5000)
+
+    def exportacion_fallida(self, error):
+        self.progresoExportacion.reset()
+        QMessageBox.warning(self, "Exportar Base de Datos", f"Error al exportar: {error}")
+
+    def iniciar_datos(self):
+        # Se llama tras el primer pintado (o por el temporizador de respaldo):
+        # el menú ya está a la vista mientras se abre la base
+        if self.datosIniciados:
+            return
+        self.datosIniciados = True
+        try:
+            iniciar_base_datos()
+            traza_arranque.marcar("base de datos")
+            # Índice de códigos de barras listo antes del primer escaneo
+            cache_productos.cargar()
+            traza_arranque.marcar("caché de productos")
+        except Exception as e:
+            QMessageBox.critical(self, "Base de datos", f"No se pudo abrir la base de datos: {e}")
+            self.close()
+            return
+        if str(config_valor("salir_tras_arranque", "")).lower() in ("1", "true", "si"):
+            QApplication.quit()
+
+    def mostrar_modulo(self, clase):
+        modulo = self.modulos.get(clase)
+        if modulo is None:
+            modulo = clase(self)
+            self.modulos[clase] = modulo
+            self.pilaModulos.addWidget(modulo)
+            if clase.TABLAS:
+                registro_cambios.suscribir(modulo.aplicar_cambio, *clase.TABLAS)
+                modulo.destroyed.connect(lambda _=None, f=modulo.aplicar_cambio: registro_cambios.desuscribir(f))
+        self.pilaModulos.setCurrentWidget(modulo)
+        return modulo
+
     def mostrar_main_menu(self):
-        self.setCentralWidget(MainMenu(self))
+        self.mostrar_modulo(MainMenu)
 
     def mostrar_productos(self):
-        self.setCentralWidget(VentanaProductos(self))
+        self.mostrar_modulo(VentanaProductos)
 
     def mostrar_inventario(self):
-        self.setCentralWidget(VentanaInventario(self))
+        self.mostrar_modulo(VentanaInventario)
 
     def mostrar_ventas(self):
-        self.setCentralWidget(VentanaVentas(self))
+        self.mostrar_modulo(VentanaVentas)
 
     def mostrar_ventas_realizadas(self):
-        self.setCentralWidget(VentanaVentasRealizadas(self))
+        self.mostrar_modulo(VentanaVentasRealizadas)
 
     def mostrar_caja(self):
-        self.setCentralWidget(VentanaCajaModule(self))
+        self.mostrar_modulo(VentanaCajaModule)
 
     def mostrar_devoluciones(self):
-        self.setCentralWidget(VentanaDevoluciones(self))
-
-def exportar_base_datos_json():
-    session = SessionLocal()
-    data = {}
-    models = [Producto, InventarioEntry, Venta, DetalleVenta, Caja, VentaCancelada]
-    for model in models:
-        table_name = model.__tablename__
-        items = session.query(model).all()
-        data[table_name] = [{col.name: getattr(item, col.name) for col in model.__table__.columns} for item in items]
-    filename, _ = QFileDialog.getSaveFileName(None, "Exportar Base de Datos", "", "JSON Files (*.json)")
-    if filename:
-        try:
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4, default=str)
-            QMessageBox.information(None, "Exportar Base de Datos", "Base de datos exportada exitosamente.")
-        except Exception as e:
-            QMessageBox.warning(None, "Exportar Base de Datos", f"Error al exportar: {str(e)}")
-    session.close()
+        self.mostrar_modulo(VentanaDevoluciones)
+
+def comando_exportar(args):
+    formato, compresion = formato_desde_nombre(args.destino)
+    formato = args.formato or formato
+    compresion = args.compresion or compresion
+    def progreso(procesadas, total):
+        print(f"\rExportando: {procesadas}/{total} filas", end="", file=sys.stderr, flush=True)
+    filas = exportar_base_datos(args.destino, formato, compresion, progreso=None if args.silencioso else progreso)
+    if not args.silencioso:
+        print(file=sys.stderr)
+    print(f"{filas} filas exportadas en {args.destino}")
+
+def fecha_argumento(valor):
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fecha inválida: {valor} (se espera AAAA-MM-DD)")
+
+def comando_reporte(args):
+    for ruta in escribir_reporte_ventas(args.destino, args.caja, args.desde, args.hasta):
+        print(f"Reporte escrito en {ruta}")
+
+def ejecutar_cli(argv):
+    parser = argparse.ArgumentParser(prog="main.py", description="Salus JJV sin interfaz gráfica")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    exportar = sub.add_parser("export", help="Exporta la base de datos completa")
+    exportar.add_argument("destino", help="Archivo de salida (.ndjson, .json, opcionalmente .gz o .zst)")
+    exportar.add_argument("--formato", choices=["ndjson", "json"])
+    exportar.add_argument("--compresion", choices=["gzip", "zstd"])
+    exportar.add_argument("--silencioso", action="store_true", help="No mostrar el progreso")
+    exportar.set_defaults(funcion=comando_exportar)
+    sub.add_parser(
+        "migrar", help="Aplica las migraciones de esquema pendientes"
+    ).set_defaults(funcion=comando_migrar, preparar=False)
+    sub.add_parser(
+        "verificar-indices", help="Comprueba con EXPLAIN QUERY PLAN que las consultas críticas usan índices"
+    ).set_defaults(funcion=comando_verificar_indices)
+    conciliar = sub.add_parser("conciliar-caja", help="Verifica los totales acumulados de caja contra las ventas")
+    conciliar.add_argument("--caja", type=int, help="ID de caja (por defecto todas)")
+    conciliar.add_argument("--corregir", action="store_true", help="Reescribe los acumulados con los valores calculados")
+    conciliar.set_defaults(funcion=comando_conciliar_caja)
+    sub.add_parser(
+        "reconstruir-resumen", help="Recalcula el resumen diario de ventas desde el detalle"
+    ).set_defaults(funcion=comando_reconstruir_resumen)
+    resumen = sub.add_parser("resumen-ventas", help="Totales por producto en un rango de fechas")
+    resumen.add_argument("--desde", type=fecha_argumento, help="AAAA-MM-DD")
+    resumen.add_argument("--hasta", type=fecha_argumento, help="AAAA-MM-DD")
+    resumen.add_argument("--caja", type=int, help="ID de caja (por defecto todas)")
+    resumen.set_defaults(funcion=comando_resumen_ventas)
+    reporte = sub.add_parser("reporte", help="Escribe el reporte de ventas de un rango de fechas o una caja")
+    reporte.add_argument("destino", help="Archivo de salida (.xlsx, .csv o .parquet)")
+    reporte.add_argument("--desde", type=fecha_argumento, help="AAAA-MM-DD")
+    reporte.add_argument("--hasta", type=fecha_argumento, help="AAAA-MM-DD")
+    reporte.add_argument("--caja", type=int, help="ID de caja (por defecto todas)")
+    reporte.set_defaults(funcion=comando_reporte)
+    importar = sub.add_parser("importar", help="Importa productos y stock desde un CSV o XLSX (upsert por código de barras)")
+    importar.add_argument("archivo", help="Columnas: codigo_barras, nombre, precio_compra, precio_venta, cantidad, ...")
+    importar.set_defaults(funcion=comando_importar)
+    args = parser.parse_args(argv)
+    try:
+        iniciar_base_datos(preparar=getattr(args, "preparar", True))
+        args.funcion(args)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def comando_importar(args):
+    with sesion_operacion() as sesion:
+        resultado = importar_productos(sesion, args.archivo)
+    for numero, error in resultado.errores:
+        print(f"Línea {numero}: {error}", file=sys.stderr)
+    print(f"{resultado.filas} filas leídas: {resultado.creados} productos nuevos, {resultado.actualizados} actualizados, "
+          f"{resultado.entradas} entradas de stock, {len(resultado.errores)} filas con errores")
+
+def comando_migrar(args):
+    aplicadas = preparar_base_datos(servicios.engine)
+    for descripcion in aplicadas:
+        print(f"Aplicada: {descripcion}")
+    print("La base de datos está actualizada." if not aplicadas else f"{len(aplicadas)} migraciones aplicadas.")
+
+# Consultas de los caminos críticos, armadas con las mismas funciones que usa
+# la aplicación. Ninguna debe recorrer una tabla completa; las ordenadas deben
+# salir del índice ya en orden, sin B-tree temporal.
+def consultas_criticas():
+    hoy = date.today()
+    consultas = []
+    for nombre, caja_id in (("Página del historial de ventas", None), ("Página del historial de una caja", 1)):
+        modelo = modelo_historial_ventas()
+        modelo.orden = (1, True)
+        modelo.set_filtros(*condiciones_ventas(hoy, caja_id=caja_id), recargar=False)
+        ultima = (None,) * len(modelo.columnas) + (datetime.now(), 1)
+        pagina = modelo.consulta(modelo.condiciones_siguientes(ultima)[0]).limit(modelo.TAMANO_PAGINA)
+        consultas.append((nombre, pagina, True))
+    modelo = modelo_detalle_venta()
+    modelo.set_filtros(DetalleVenta.venta_id == 1, recargar=False)
+    consultas.append(("Detalle de una venta", modelo.consulta().limit(modelo.TAMANO_PAGINA), False))
+    consultas += [
+        ("Detalle del reporte de una caja", consulta_detalle_reporte(caja_id=1), True),
+        ("Detalle del reporte entre fechas", consulta_detalle_reporte(desde=hoy, hasta=hoy), True),
+        ("Resumen por producto de una caja", consulta_resumen_ventas(caja_id=1), False),
+        ("Resumen por producto entre fechas", consulta_resumen_ventas(hoy, hoy), False),
+        ("Reposición de stock al cancelar", reposicion_stock_venta(1), False),
+        ("Resumen diario al cancelar", text(SQL_ACUMULAR_VENTAS_DIARIAS), False),
+    ]
+    return consultas
+
+def verificar_planes_consulta(engine):
+    resultados = []
+    with engine.connect() as conn:
+        for nombre, sentencia, ordenada in consultas_criticas():
+            compilada = sentencia.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+            # El plan no depende de los valores de los parámetros
+            parametros = (None,) * len(compilada.positiontup or ())
+            plan = [fila[3] for fila in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compilada), parametros)]
+            # Recorrer una subconsulta ya materializada (pocas filas) no cuenta
+            materializadas = {paso.split()[1] for paso in plan if paso.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+            ok = not any(paso.startswith("SCAN ") and paso.split()[1] not in materializadas for paso in plan)
+            if ordenada:
+                ok = ok and not any(paso.startswith("USE TEMP B-TREE") for paso in plan)
+            resultados.append((nombre, plan, ok))
+    return resultados
+
+def comando_verificar_indices(args):
+    fallidas = 0
+    for nombre, plan, ok in verificar_planes_consulta(servicios.engine):
+        print(f"[{'OK' if ok else 'FALLA'}] {nombre}")
+        for paso in plan:
+            print(f"    {paso}")
+        fallidas += not ok
+    if fallidas:
+        raise RuntimeError(f"{fallidas} consultas críticas recorren tablas completas u ordenan fuera del índice")
+
+def comando_reconstruir_resumen(args):
+    sesion = SessionLocal()
+    try:
+        filas = reconstruir_ventas_diarias(sesion)
+    finally:
+        sesion.close()
+    print(f"Resumen diario reconstruido: {filas} filas.")
+
+def comando_resumen_ventas(args):
+    sesion = SessionLocal()
+    try:
+        filas = resumen_ventas(sesion, args.desde, args.hasta, args.caja)
+    finally:
+        sesion.close()
+    print(f"{'Producto':<40} {'Cantidad':>10} {'Ingreso':>12} {'Costo':>12}")
+    for nombre, cantidad, ingreso, costo in filas:
+        print(f"{nombre:<40} {cantidad:>10} {float(ingreso):>12.2f} {float(costo):>12.2f}")
+    print(f"{'Total':<40} {sum(f[1] for f in filas):>10} "
+          f"{sum(float(f[2]) for f in filas):>12.2f} {sum(float(f[3]) for f in filas):>12.2f}")
+
+def comando_conciliar_caja(args):
+    sesion = SessionLocal()
+    try:
+        cajas = [args.caja] if args.caja else [c for (c,) in sesion.execute(select(Caja.id).order_by(Caja.id))]
+        # Termina la lectura: cada corrección abre su propia transacción de escritura
+        sesion.rollback()
+        con_diferencias = 0
+        for caja_id in cajas:
+            diferencias = corregir_caja(sesion, caja_id) if args.corregir else conciliar_caja(sesion, caja_id)
+            for campo, (acumulado, calculado) in diferencias.items():
+                print(f"Caja {caja_id}: {campo} acumulado {acumulado}, según ventas {calculado}")
+            con_diferencias += bool(diferencias)
+    finally:
+        sesion.close()
+    if con_diferencias and not args.corregir:
+        raise RuntimeError(f"{con_diferencias} cajas con totales que no coinciden")
+    print(f"{len(cajas)} cajas verificadas, {con_diferencias} con diferencias"
+          + (" corregidas." if args.corregir and con_diferencias else "."))
+
+COMANDOS_CLI = (
+    "export", "migrar", "verificar-indices", "conciliar-caja", "reconstruir-resumen", "resumen-ventas", "reporte",
+    "importar"
+)
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMANDOS_CLI + ("-h", "--help"):
+        sys.exit(ejecutar_cli(sys.argv[1:]))
+    traza_arranque.marcar("importaciones")
     app = QApplication(sys.argv)
     ventana = VentanaPrincipal()
     ventana.show()
+    traza_arranque.marcar("ventana creada")
     sys.exit(app.exec())
 
 if __name__ == "__main__":
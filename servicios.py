@@ -0,0 +1,1641 @@
+# Datos y servicios de Salus JJV, sin Qt: configuración, conexión y esquema,
+# avisos de cambios, servicios que leen y escriben con una sesión, reportes y
+# exportación. main.py arma la interfaz y la línea de comandos encima; los
+# benchmarks y cualquier uso sin pantalla importan solo este módulo.
+import time
+import sys
+import os
+import sqlite3
+import io
+import re
+import gzip
+from datetime import date, datetime, timedelta
+import json
+import csv
+import random
+import functools
+import logging
+import logging.handlers
+import threading
+import unicodedata
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, Column, Index, Integer, String, Numeric, Date, DateTime, ForeignKey
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy.exc import OperationalError
+from sqlalchemy import text, select, update, insert, delete, bindparam, func, column
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+
+# Configuración local: variables de entorno SALUS_<CLAVE> o salus_config.json
+CONFIG_ARCHIVO = os.environ.get("SALUS_CONFIG", "salus_config.json")
+_config = None
+
+def config_valor(clave, defecto=None):
+    global _config
+    entorno = os.environ.get(f"SALUS_{clave.upper()}")
+    if entorno is not None:
+        return entorno
+    if _config is None:
+        try:
+            with open(CONFIG_ARCHIVO, encoding="utf-8") as f:
+                _config = json.load(f)
+        except (OSError, ValueError):
+            _config = {}
+    return _config.get(clave, defecto)
+
+DIRECTORIO_REPORTES = "reportes"
+PLANTILLA_REPORTE_VENTA = "venta_{id}_{fecha:%Y%m%d_%H%M%S}.xlsx"
+
+# Perfiles de almacenamiento: pragmas que se aplican a cada conexión nueva.
+# Se elige con perfil_almacenamiento y se puede ajustar pragma por pragma con
+# "pragmas" en salus_config.json o con SALUS_PRAGMA_<NOMBRE>.
+DATABASE_URL = "sqlite:///database.db"
+PERFIL_POR_DEFECTO = "rendimiento"
+PERFILES_ALMACENAMIENTO = {
+    # WAL y synchronous=NORMAL: un corte de luz puede perder la última
+    # transacción pero nunca corrompe la base; los commits no esperan al fsync
+    "rendimiento": {
+        "journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -65536,
+        "mmap_size": 268435456, "temp_store": "MEMORY", "busy_timeout": 5000,
+    },
+    # WAL con fsync en cada commit
+    "seguro": {
+        "journal_mode": "WAL", "synchronous": "FULL", "cache_size": -16384,
+        "mmap_size": 0, "temp_store": "MEMORY", "busy_timeout": 5000,
+    },
+    # Base en una carpeta compartida: WAL no funciona sobre sistemas de archivos de red
+    "red": {
+        "journal_mode": "DELETE", "synchronous": "FULL", "cache_size": -16384,
+        "mmap_size": 0, "temp_store": "MEMORY", "busy_timeout": 15000,
+    },
+    # Valores por defecto de SQLite
+    "compatible": {},
+}
+PRAGMAS_SOPORTADOS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+
+def pragmas_configurados(perfil):
+    if perfil not in PERFILES_ALMACENAMIENTO:
+        raise ValueError(f"Perfil de almacenamiento desconocido: {perfil}")
+    pragmas = dict(PERFILES_ALMACENAMIENTO[perfil])
+    extra = config_valor("pragmas", {}) or {}
+    if isinstance(extra, str):
+        extra = json.loads(extra)
+    pragmas.update(extra)
+    for nombre in PRAGMAS_SOPORTADOS:
+        valor = os.environ.get(f"SALUS_PRAGMA_{nombre.upper()}")
+        if valor is not None:
+            pragmas[nombre] = valor
+    for nombre, valor in pragmas.items():
+        if nombre not in PRAGMAS_SOPORTADOS or not re.fullmatch(r"-?\w+", str(valor)):
+            raise ValueError(f"Pragma no válido: {nombre} = {valor}")
+    return pragmas
+
+def crear_engine(url=None, perfil=None):
+    url = url or config_valor("database_url", DATABASE_URL)
+    pragmas = pragmas_configurados(perfil or config_valor("perfil_almacenamiento", PERFIL_POR_DEFECTO))
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # Una sola conexión compartida: cada conexión a :memory: es una base distinta
+        nuevo = create_engine(url, echo=False, poolclass=StaticPool,
+                              connect_args={"check_same_thread": False})
+    else:
+        # SQLite admite un solo escritor; más conexiones solo suman descriptores
+        # y cachés de páginas sin aumentar el rendimiento
+        nuevo = create_engine(url, echo=False, poolclass=QueuePool, pool_size=5, max_overflow=5)
+
+    @event.listens_for(nuevo, "connect")
+    def aplicar_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for nombre, valor in pragmas.items():
+            cursor.execute(f"PRAGMA {nombre} = {valor}")
+        cursor.close()
+
+    # Las escrituras empiezan con BEGIN IMMEDIATE (opción "escritura", ver
+    # escritura()): toman el lock de escritura al abrir la transacción,
+    # esperando hasta busy_timeout si otra terminal lo tiene, en lugar de
+    # leer y recién al escribir encontrarse con SQLITE_BUSY. El resto sigue
+    # con el BEGIN implícito del driver antes del primer INSERT/UPDATE/DELETE.
+    @event.listens_for(nuevo, "begin")
+    def iniciar_transaccion(conn):
+        if conn.get_execution_options().get("escritura"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    if medidor_sql.activo:
+        medidor_sql.instalar(nuevo)
+    return nuevo
+
+# Medición de SQL por acción del usuario. Cada clic, tecla o giro de rueda en
+# la interfaz abre una acción nueva, y las consultas que corren en el hilo de
+# la interfaz hasta la siguiente se le atribuyen, incluidas las diferidas por
+# temporizadores como la búsqueda. El tiempo de un SELECT es hasta su primera
+# fila; las filas se cuentan a medida que se leen. Las sentencias que superan
+# sql_lento_ms, de cualquier hilo, van a un log rotativo con su acción.
+class CostoAccion:
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.consultas = 0
+        self.segundos = 0.0
+        self.filas = 0
+
+class MedidorSQL:
+    def __init__(self):
+        self.activo = str(config_valor("medir_sql", "1")).lower() in ("1", "true", "si")
+        self.umbral = float(config_valor("sql_lento_ms", 200)) / 1000
+        self.archivo = config_valor("sql_lento_archivo", "salus_sql_lento.log")
+        self.hilo = threading.main_thread().ident
+        self.accion = CostoAccion("Arranque")
+        self._log = None
+
+    def instalar(self, engine):
+        event.listen(engine, "connect", self.conectar)
+        event.listen(engine, "before_cursor_execute", self.antes)
+        event.listen(engine, "after_cursor_execute", self.despues)
+
+    def iniciar_accion(self, nombre):
+        self.accion = CostoAccion(nombre)
+
+    def conectar(self, dbapi_connection, connection_record):
+        dbapi_connection.row_factory = self.contar_fila
+
+    def contar_fila(self, cursor, fila):
+        if threading.get_ident() == self.hilo:
+            self.accion.filas += 1
+        return fila
+
+    def antes(self, conn, cursor, sentencia, parametros, contexto, executemany):
+        # En el contexto de la ejecución y no en la conexión: una sentencia que
+        # falla no llega a despues() y su inicio se descarta con el contexto
+        contexto.inicio_sql = time.perf_counter()
+
+    def despues(self, conn, cursor, sentencia, parametros, contexto, executemany):
+        duracion = time.perf_counter() - contexto.inicio_sql
+        if threading.get_ident() == self.hilo:
+            self.accion.consultas += 1
+            self.accion.segundos += duracion
+        if duracion >= self.umbral:
+            parametros = f"{len(parametros)} filas" if executemany else repr(parametros)[:500]
+            self.log_lento().warning("%.1f ms [%s] %s -- %s", duracion * 1000, self.accion.nombre,
+                                     " ".join(sentencia.split()), parametros)
+
+    def log_lento(self):
+        if self._log is None:
+            self._log = logging.getLogger("salus.sql_lento")
+            self._log.propagate = False
+            manejador = logging.handlers.RotatingFileHandler(
+                self.archivo, maxBytes=int(config_valor("sql_lento_bytes", 1048576)), backupCount=3, encoding="utf-8")
+            manejador.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self._log.addHandler(manejador)
+        return self._log
+
+medidor_sql = MedidorSQL()
+
+# El engine y el esquema se preparan en iniciar_base_datos(), no al importar:
+# la aplicación muestra la ventana antes de tocar la base
+engine = None
+SessionLocal = sessionmaker()
+Base = declarative_base()
+
+# Bus de cambios: cada commit publica, por tabla y operación, las claves de
+# las filas que escribió, y las pantallas y cachés suscritas parchean solo
+# esas filas. claves es None cuando no se sabe qué filas tocó la sentencia.
+# Se publica en el hilo que hizo el commit (hoy, siempre el de la interfaz).
+class Cambio:
+    def __init__(self, tabla, claves, operacion, columnas=None):
+        self.tabla = tabla
+        self.claves = claves
+        self.operacion = operacion
+        # Columnas escritas por los update; None si no se sabe (o en insert y delete)
+        self.columnas = columnas
+
+class RegistroCambios:
+    def __init__(self):
+        self.suscriptores = {}
+
+    def suscribir(self, funcion, *tablas):
+        for tabla in tablas:
+            self.suscriptores.setdefault(tabla, []).append(funcion)
+
+    def desuscribir(self, funcion):
+        for funciones in self.suscriptores.values():
+            if funcion in funciones:
+                funciones.remove(funcion)
+
+    def publicar(self, cambio):
+        for funcion in list(self.suscriptores.get(cambio.tabla, ())):
+            try:
+                funcion(cambio)
+            except Exception as e:
+                # El commit ya está hecho: un suscriptor con error no debe
+                # hacerlo parecer fallido
+                print(f"Error al aplicar cambio en {cambio.tabla}: {e}", file=sys.stderr)
+
+registro_cambios = RegistroCambios()
+
+def marcar_cambio(sesion, tabla, claves=None, operacion="update", columnas=None):
+    # Los eventos cubren el ORM y los insert/update/delete de Core (con las
+    # claves de la opción de ejecución "claves", si la sentencia la trae);
+    # las escrituras con text() se marcan a mano
+    cambios = sesion.info.setdefault("cambios", {})
+    anteriores = cambios.get((tabla, operacion), set())
+    if claves is None or anteriores is None:
+        cambios[(tabla, operacion)] = None
+    else:
+        anteriores.update(claves)
+        cambios[(tabla, operacion)] = anteriores
+    escritas = sesion.info.setdefault("columnas_cambiadas", {})
+    if (tabla, operacion) not in escritas:
+        escritas[(tabla, operacion)] = None if columnas is None else set(columnas)
+    elif columnas is None:
+        escritas[(tabla, operacion)] = None
+    elif escritas[(tabla, operacion)] is not None:
+        escritas[(tabla, operacion)].update(columnas)
+
+def columnas_sentencia(sentencia):
+    # Nombres de las columnas del VALUES/SET de un insert o update; None si no
+    # se pueden saber
+    valores = getattr(sentencia, "_values", None)
+    return {getattr(columna, "key", columna) for columna in valores} if valores else None
+
+def clave_objeto(objeto):
+    clave = inspect(objeto).mapper.primary_key_from_instance(objeto)
+    return clave[0] if len(clave) == 1 else tuple(clave)
+
+@event.listens_for(Session, "after_flush")
+def _cambios_del_flush(sesion, contexto):
+    for operacion, objetos in (("insert", sesion.new), ("update", sesion.dirty), ("delete", sesion.deleted)):
+        for objeto in objetos:
+            if operacion != "update":
+                marcar_cambio(sesion, objeto.__tablename__, [clave_objeto(objeto)], operacion)
+            elif sesion.is_modified(objeto):
+                columnas = [atributo.key for atributo in inspect(objeto).attrs if atributo.history.has_changes()]
+                marcar_cambio(sesion, objeto.__tablename__, [clave_objeto(objeto)], operacion, columnas)
+
+@event.listens_for(Session, "do_orm_execute")
+def _cambios_de_sentencias(estado):
+    for operacion, es in (("insert", estado.is_insert), ("update", estado.is_update), ("delete", estado.is_delete)):
+        if es:
+            marcar_cambio(estado.session, estado.statement.table.name,
+                          estado.execution_options.get("claves"), operacion,
+                          columnas_sentencia(estado.statement) if operacion == "update" else None)
+
+@event.listens_for(Session, "after_commit")
+def _publicar_cambios(sesion):
+    cambios = sesion.info.pop("cambios", None)
+    escritas = sesion.info.pop("columnas_cambiadas", {})
+    for (tabla, operacion), claves in (cambios or {}).items():
+        columnas = escritas.get((tabla, operacion))
+        registro_cambios.publicar(Cambio(tabla, None if claves is None else frozenset(claves), operacion,
+                                         None if columnas is None else frozenset(columnas)))
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_cambios(sesion):
+    sesion.info.pop("cambios", None)
+    sesion.info.pop("columnas_cambiadas", None)
+
+# Una sesión por operación del usuario: el mapa de identidad vive lo que dura
+# la operación y cada operación lee el estado actual, no objetos que otra
+# pantalla pudo haber cambiado
+@contextmanager
+def sesion_operacion():
+    sesion = SessionLocal()
+    try:
+        yield sesion
+    except Exception:
+        sesion.rollback()
+        raise
+    finally:
+        sesion.close()
+
+class Producto(Base):
+    __tablename__ = "productos"
+    id = Column(Integer, primary_key=True)
+    nombre = Column(String(255), nullable=False)
+    descripcion = Column(String)
+    precio_compra = Column(Numeric(10, 2), nullable=False)
+    precio_venta = Column(Numeric(10, 2), nullable=False)
+    stock = Column(Integer, nullable=False)
+    categoria = Column(String(100))
+    fecha_vencimiento = Column(Date)
+    codigo_barras = Column(String(50), unique=True)
+    # Sube con cada escritura de la fila; la edición la compara para no pisar
+    # cambios de otra terminal
+    version = Column(Integer, nullable=False, default=1)
+
+class InventarioEntry(Base):
+    __tablename__ = "inventario"
+    id = Column(Integer, primary_key=True)
+    producto_id = Column(Integer, ForeignKey("productos.id"), index=True)
+    cantidad = Column(Integer, nullable=False)
+    fecha_ingreso = Column(DateTime, default=lambda: datetime.now(), onupdate=lambda: datetime.now())
+
+VENTA_ACTIVA = "activa"
+VENTA_CANCELADA = "cancelada"
+ESTADOS_VENTA = {VENTA_ACTIVA: "Activa", VENTA_CANCELADA: "Cancelada"}
+
+class Venta(Base):
+    __tablename__ = "ventas"
+    # El historial pagina las ventas activas por fecha; también cubre las
+    # consultas por estado
+    __table_args__ = (Index("ix_ventas_estado_fecha", "estado", "fecha"),)
+    id = Column(Integer, primary_key=True)
+    fecha = Column(DateTime, default=lambda: datetime.now(), index=True)
+    total = Column(Numeric(10, 2), nullable=False)
+    caja_id = Column(Integer, ForeignKey("caja.id"), nullable=True, index=True)
+    # Las ventas canceladas no se borran: quedan marcadas y con su VentaCancelada
+    estado = Column(String(20), nullable=False, default=VENTA_ACTIVA)
+
+class DetalleVenta(Base):
+    __tablename__ = "detalle_ventas"
+    id = Column(Integer, primary_key=True)
+    venta_id = Column(Integer, ForeignKey("ventas.id"), index=True)
+    producto_id = Column(Integer, ForeignKey("productos.id"), index=True)
+    cantidad = Column(Integer, nullable=False)
+    subtotal = Column(Numeric(10, 2), nullable=False)
+    # Costo de compra de la línea al momento de la venta
+    costo = Column(Numeric(10, 2), nullable=True)
+
+class Caja(Base):
+    __tablename__ = "caja"
+    id = Column(Integer, primary_key=True)
+    fecha_apertura = Column(DateTime, default=lambda: datetime.now(), nullable=False)
+    fecha_cierre = Column(DateTime, nullable=True)
+    monto_apertura = Column(Numeric(10, 2), nullable=False)
+    monto_cierre = Column(Numeric(10, 2), nullable=True)
+    total_ventas = Column(Numeric(10, 2), nullable=True)
+    # Acumulados del turno, actualizados dentro de cada venta y cancelación
+    num_ventas = Column(Integer, nullable=False, default=0)
+    num_canceladas = Column(Integer, nullable=False, default=0)
+    total_bruto = Column(Numeric(10, 2), nullable=False, default=0)
+    total_cancelado = Column(Numeric(10, 2), nullable=False, default=0)
+
+class VentaCancelada(Base):
+    __tablename__ = "ventas_canceladas"
+    id = Column(Integer, primary_key=True)
+    venta_id = Column(Integer, ForeignKey("ventas.id"), index=True)
+    fecha_cancelacion = Column(DateTime, default=lambda: datetime.now())
+    motivo = Column(String(255))
+
+# Resumen de ventas por día, producto y caja, mantenido por el cobro y la
+# cancelación. Las ventas sin caja se acumulan en caja_id 0.
+class VentaDiaria(Base):
+    __tablename__ = "ventas_diarias"
+    fecha = Column(Date, primary_key=True)
+    producto_id = Column(Integer, ForeignKey("productos.id"), primary_key=True)
+    caja_id = Column(Integer, primary_key=True, index=True)
+    cantidad = Column(Integer, nullable=False, default=0)
+    ingreso = Column(Numeric(10, 2), nullable=False, default=0)
+    costo = Column(Numeric(10, 2), nullable=False, default=0)
+
+_SELECT_VENTAS_DIARIAS = (
+    "SELECT date(v.fecha), d.producto_id, coalesce(v.caja_id, 0), "
+    ":signo * sum(d.cantidad), :signo * sum(d.subtotal), :signo * coalesce(sum(d.costo), 0) "
+    "FROM ventas v JOIN detalle_ventas d ON d.venta_id = v.id WHERE {filtro} "
+    "GROUP BY date(v.fecha), d.producto_id, coalesce(v.caja_id, 0)"
+)
+SQL_ACUMULAR_VENTAS_DIARIAS = (
+    "INSERT INTO ventas_diarias (fecha, producto_id, caja_id, cantidad, ingreso, costo) "
+    + _SELECT_VENTAS_DIARIAS.format(filtro="v.id = :venta_id")
+    + " ON CONFLICT (fecha, producto_id, caja_id) DO UPDATE SET "
+    "cantidad = cantidad + excluded.cantidad, ingreso = ingreso + excluded.ingreso, costo = costo + excluded.costo"
+)
+SQL_RECONSTRUIR_VENTAS_DIARIAS = (
+    "INSERT INTO ventas_diarias (fecha, producto_id, caja_id, cantidad, ingreso, costo) "
+    + _SELECT_VENTAS_DIARIAS.format(filtro="v.estado = :estado")
+)
+
+# Búsqueda de productos: índice FTS5 sobre productos sincronizado por triggers
+LIMITE_BUSQUEDA = 200
+FTS_DISPONIBLE = True
+
+# Migraciones de esquema. create_all solo crea las tablas que faltan; cualquier
+# cambio sobre una base ya instalada se agrega como un paso nuevo al final de
+# MIGRACIONES. PRAGMA user_version guarda el último paso aplicado.
+def _existe_tabla(db, nombre):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (nombre,)).fetchone() is not None
+
+def _agregar_columna(db, tabla, columna, definicion):
+    # En bases nuevas create_all ya creó la columna
+    if columna not in {fila[1] for fila in db.execute(f"PRAGMA table_info({tabla})")}:
+        db.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+def _migracion_busqueda(db):
+    if _existe_tabla(db, "productos_fts"):
+        return
+    try:
+        db.execute(
+            "CREATE VIRTUAL TABLE productos_fts USING fts5("
+            "nombre, descripcion, categoria, codigo_barras, "
+            "content='productos', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError:
+        # SQLite compilado sin FTS5: la búsqueda usa LIKE como respaldo
+        return
+    db.execute(
+        "CREATE TRIGGER productos_fts_ai AFTER INSERT ON productos BEGIN "
+        "INSERT INTO productos_fts(rowid, nombre, descripcion, categoria, codigo_barras) "
+        "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.codigo_barras); "
+        "END"
+    )
+    db.execute(
+        "CREATE TRIGGER productos_fts_ad AFTER DELETE ON productos BEGIN "
+        "INSERT INTO productos_fts(productos_fts, rowid, nombre, descripcion, categoria, codigo_barras) "
+        "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.codigo_barras); "
+        "END"
+    )
+    # Solo las columnas indexadas: los cambios de stock no deben tocar el índice
+    db.execute(
+        "CREATE TRIGGER productos_fts_au AFTER UPDATE OF nombre, descripcion, categoria, codigo_barras "
+        "ON productos BEGIN "
+        "INSERT INTO productos_fts(productos_fts, rowid, nombre, descripcion, categoria, codigo_barras) "
+        "VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria, old.codigo_barras); "
+        "INSERT INTO productos_fts(rowid, nombre, descripcion, categoria, codigo_barras) "
+        "VALUES (new.id, new.nombre, new.descripcion, new.categoria, new.codigo_barras); "
+        "END"
+    )
+    db.execute("INSERT INTO productos_fts(productos_fts) VALUES ('rebuild')")
+
+def _migracion_indices(db):
+    # Mismos nombres que generan los index=True de los modelos en bases nuevas
+    for tabla, columna in [
+        ("detalle_ventas", "venta_id"), ("detalle_ventas", "producto_id"),
+        ("ventas", "caja_id"), ("ventas", "fecha"),
+        ("inventario", "producto_id"), ("ventas_canceladas", "venta_id"),
+    ]:
+        db.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabla}_{columna} ON {tabla} ({columna})")
+
+def _migracion_totales_caja(db):
+    _agregar_columna(db, "caja", "num_ventas", "INTEGER NOT NULL DEFAULT 0")
+    _agregar_columna(db, "caja", "num_canceladas", "INTEGER NOT NULL DEFAULT 0")
+    _agregar_columna(db, "caja", "total_bruto", "NUMERIC(10, 2) NOT NULL DEFAULT 0")
+    _agregar_columna(db, "caja", "total_cancelado", "NUMERIC(10, 2) NOT NULL DEFAULT 0")
+    # Las ventas canceladas hasta ahora se borraban, así que no hay nada que contar como cancelado
+    db.execute(
+        "UPDATE caja SET "
+        "num_ventas = (SELECT count(*) FROM ventas WHERE ventas.caja_id = caja.id), "
+        "total_bruto = (SELECT coalesce(sum(total), 0) FROM ventas WHERE ventas.caja_id = caja.id)"
+    )
+
+def _migracion_estado_ventas(db):
+    _agregar_columna(db, "ventas", "estado", f"VARCHAR(20) NOT NULL DEFAULT '{VENTA_ACTIVA}'")
+    db.execute(
+        f"UPDATE ventas SET estado = '{VENTA_CANCELADA}' "
+        "WHERE id IN (SELECT venta_id FROM ventas_canceladas)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS ix_ventas_estado ON ventas (estado)")
+
+def _migracion_ventas_diarias(db):
+    _agregar_columna(db, "detalle_ventas", "costo", "NUMERIC(10, 2)")
+    # Para las ventas anteriores solo se conoce el costo de compra actual
+    db.execute(
+        "UPDATE detalle_ventas SET costo = cantidad * "
+        "(SELECT precio_compra FROM productos WHERE productos.id = detalle_ventas.producto_id) "
+        "WHERE costo IS NULL"
+    )
+    db.execute("DELETE FROM ventas_diarias")
+    db.execute(SQL_RECONSTRUIR_VENTAS_DIARIAS, {"signo": 1, "estado": VENTA_ACTIVA})
+
+def _migracion_historial_ventas(db):
+    db.execute("CREATE INDEX IF NOT EXISTS ix_ventas_estado_fecha ON ventas (estado, fecha)")
+    db.execute("DROP INDEX IF EXISTS ix_ventas_estado")
+
+def _migracion_version_productos(db):
+    _agregar_columna(db, "productos", "version", "INTEGER NOT NULL DEFAULT 1")
+
+MIGRACIONES = [
+    (1, "Índice de búsqueda de productos", _migracion_busqueda),
+    (2, "Índices de ventas, detalle, inventario y cancelaciones", _migracion_indices),
+    (3, "Totales acumulados de caja", _migracion_totales_caja),
+    (4, "Estado de las ventas", _migracion_estado_ventas),
+    (5, "Resumen diario de ventas", _migracion_ventas_diarias),
+    (6, "Índice del historial de ventas", _migracion_historial_ventas),
+    (7, "Versión de los productos", _migracion_version_productos),
+]
+
+def migrar(engine):
+    aplicadas = []
+    conexion = engine.raw_connection()
+    try:
+        db = conexion.driver_connection
+        for numero, descripcion, funcion in MIGRACIONES:
+            # BEGIN IMMEDIATE: si dos terminales arrancan a la vez, solo una migra
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if db.execute("PRAGMA user_version").fetchone()[0] < numero:
+                    funcion(db)
+                    db.execute(f"PRAGMA user_version = {numero}")
+                    aplicadas.append(descripcion)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+    finally:
+        conexion.close()
+    return aplicadas
+
+def preparar_base_datos(engine):
+    global FTS_DISPONIBLE
+    # Con la base ya en la última versión no hay nada que crear ni migrar y el
+    # arranque se ahorra create_all y un BEGIN IMMEDIATE por migración. Por eso
+    # toda tabla nueva necesita también su paso en MIGRACIONES.
+    with engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    aplicadas = []
+    if version < MIGRACIONES[-1][0]:
+        Base.metadata.create_all(engine)
+        aplicadas = migrar(engine)
+    with engine.connect() as conn:
+        FTS_DISPONIBLE = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'productos_fts'"
+        ).first() is not None
+    return aplicadas
+
+def iniciar_base_datos(url=None, perfil=None, preparar=True):
+    global engine
+    if engine is None:
+        engine = crear_engine(url, perfil)
+        SessionLocal.configure(bind=engine)
+        if preparar:
+            preparar_base_datos(engine)
+    return engine
+
+def consulta_fts(texto):
+    # Cada palabra se busca como prefijo y todas deben aparecer
+    terminos = [t.replace('"', '""') for t in texto.split()]
+    return " ".join(f'"{t}"*' for t in terminos if t)
+
+def filtro_busqueda_productos(texto):
+    consulta = consulta_fts(texto.strip())
+    if not consulta:
+        return None
+    if not FTS_DISPONIBLE:
+        return Producto.nombre.icontains(texto.strip(), autoescape=True)
+    return Producto.id.in_(
+        text("SELECT rowid FROM productos_fts WHERE productos_fts MATCH :q")
+        .bindparams(q=consulta).columns(column("rowid", Integer))
+    )
+
+def buscar_productos(sesion, texto, limite=LIMITE_BUSQUEDA):
+    consulta = consulta_fts(texto.strip())
+    if not consulta:
+        return sesion.query(Producto).order_by(Producto.id).limit(limite).all()
+    if not FTS_DISPONIBLE:
+        return sesion.query(Producto).filter(Producto.nombre.ilike(f"%{texto.strip()}%"))\
+            .order_by(Producto.id).limit(limite).all()
+    ids = [fila[0] for fila in sesion.execute(
+        text("SELECT rowid FROM productos_fts WHERE productos_fts MATCH :q ORDER BY rank LIMIT :n"),
+        {"q": consulta, "n": limite}
+    )]
+    if not ids:
+        return []
+    productos = {p.id: p for p in sesion.query(Producto).filter(Producto.id.in_(ids))}
+    return [productos[i] for i in ids if i in productos]
+
+# Nombres de productos e índice por código de barras compartidos entre pantallas;
+# se invalida al modificar productos y se recarga en el siguiente uso
+class CacheProductos:
+    # Más productos pendientes que esto y conviene recargar todo
+    MAXIMO_PENDIENTES = 500
+    # Lo único que guarda de cada producto; el stock y la versión que cambia
+    # cada venta no la afectan
+    COLUMNAS = frozenset(("nombre", "precio_venta", "codigo_barras"))
+
+    def __init__(self):
+        self._nombres = None
+        self._por_codigo = None
+        self._codigos = None
+        self._pendientes = set()
+
+    def consulta(self):
+        return select(Producto.id, Producto.nombre, Producto.precio_venta, Producto.codigo_barras)
+
+    def cargar(self):
+        self._nombres = {}
+        self._por_codigo = {}
+        self._codigos = {}
+        self._pendientes = set()
+        with engine.connect() as conn:
+            for fila in conn.execute(self.consulta().order_by(Producto.id)):
+                self.agregar(*fila)
+
+    def agregar(self, producto_id, nombre, precio_venta, codigo):
+        self._nombres[producto_id] = nombre
+        if codigo:
+            self._por_codigo[codigo] = (producto_id, nombre, float(precio_venta))
+            self._codigos[producto_id] = codigo
+
+    def quitar(self, producto_id):
+        self._nombres.pop(producto_id, None)
+        codigo = self._codigos.pop(producto_id, None)
+        if codigo is not None:
+            self._por_codigo.pop(codigo, None)
+
+    def aplicar_cambio(self, cambio):
+        # Solo se anotan las claves; se releen en la próxima consulta, así un
+        # commit no paga lecturas que quizá nadie use
+        if self._nombres is None:
+            return
+        if cambio.operacion == "update" and cambio.columnas is not None and not cambio.columnas & self.COLUMNAS:
+            return
+        if cambio.claves is None or len(self._pendientes) + len(cambio.claves) > self.MAXIMO_PENDIENTES:
+            self.invalidar()
+        else:
+            self._pendientes.update(cambio.claves)
+
+    def actualizar_pendientes(self):
+        pendientes, self._pendientes = self._pendientes, set()
+        for producto_id in pendientes:
+            self.quitar(producto_id)
+        with engine.connect() as conn:
+            for fila in conn.execute(self.consulta().where(Producto.id.in_(pendientes))):
+                self.agregar(*fila)
+
+    def asegurar_cargado(self):
+        if self._nombres is None:
+            self.cargar()
+        elif self._pendientes:
+            self.actualizar_pendientes()
+
+    def nombres(self):
+        self.asegurar_cargado()
+        return self._nombres
+
+    def nombre(self, producto_id):
+        return self.nombres().get(producto_id, "Desconocido")
+
+    def por_codigo(self, codigo):
+        self.asegurar_cargado()
+        return self._por_codigo.get(codigo)
+
+    def invalidar(self):
+        self._nombres = None
+        self._por_codigo = None
+        self._codigos = None
+        self._pendientes = set()
+
+cache_productos = CacheProductos()
+registro_cambios.suscribir(cache_productos.aplicar_cambio, Producto.__tablename__)
+
+# Varias terminales sobre la misma base. Cada servicio que escribe abre su
+# transacción con escritura() y la mantiene corta: lee y escribe sin esperar al
+# usuario. Si aun así otra terminal retiene el lock más allá de busy_timeout,
+# reintentar_bloqueo repite el servicio entero, que ya deshizo su transacción.
+REINTENTOS_BLOQUEO = int(config_valor("reintentos_bloqueo", 5))
+ESPERA_BLOQUEO_S = 0.05
+reintentos_bloqueo = 0
+
+class BaseOcupadaError(Exception):
+    def __init__(self):
+        super().__init__("La base de datos está ocupada por otra terminal. Intente de nuevo.")
+
+def escritura(sesion):
+    # Solo sirve como lo primero de la transacción: si la sesión ya leyó,
+    # sigue la transacción de lectura y un SQLITE_BUSY lo cubre el reintento
+    if not sesion.in_transaction():
+        sesion.connection(execution_options={"escritura": True})
+
+def es_bloqueo(error):
+    original = getattr(error, "orig", error)
+    codigo = getattr(original, "sqlite_errorcode", None)
+    if codigo is not None:
+        return codigo & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(original) or "busy" in str(original)
+
+def reintentar_bloqueo(servicio):
+    @functools.wraps(servicio)
+    def envoltura(sesion, *args, **kwargs):
+        global reintentos_bloqueo
+        for intento in range(REINTENTOS_BLOQUEO):
+            try:
+                return servicio(sesion, *args, **kwargs)
+            except OperationalError as e:
+                if not es_bloqueo(e):
+                    raise
+                if intento == REINTENTOS_BLOQUEO - 1:
+                    raise BaseOcupadaError() from e
+            reintentos_bloqueo += 1
+            # Espera exponencial con azar, para que las terminales no vuelvan a chocar a la vez
+            time.sleep(ESPERA_BLOQUEO_S * 2 ** intento * random.uniform(0.5, 1.5))
+    return envoltura
+
+class StockInsuficienteError(Exception):
+    def __init__(self, nombre):
+        super().__init__(f"Stock insuficiente para {nombre}")
+        self.nombre = nombre
+
+@reintentar_bloqueo
+def registrar_venta(sesion, caja_id, carrito):
+    # Toda la venta en una transacción: una lectura de productos, descuento
+    # condicional de stock y alta masiva del detalle. Si algo falla no queda
+    # ninguna Venta huérfana.
+    cantidades = {}
+    for item in carrito:
+        cantidades[item["producto_id"]] = cantidades.get(item["producto_id"], 0) + item["cantidad"]
+    total = sum(item["subtotal"] for item in carrito)
+    try:
+        escritura(sesion)
+        productos = {fila.id: fila for fila in sesion.execute(
+            select(Producto.id, Producto.nombre, Producto.stock, Producto.precio_compra)
+            .where(Producto.id.in_(cantidades))
+        )}
+        for producto_id, cantidad in cantidades.items():
+            fila = productos.get(producto_id)
+            if fila is None:
+                raise StockInsuficienteError(f"el producto ID {producto_id}")
+            if cantidad > fila.stock:
+                raise StockInsuficienteError(fila.nombre)
+        tabla = Producto.__table__
+        resultado = sesion.execute(
+            update(tabla)
+            .where(tabla.c.id == bindparam("p_id"), tabla.c.stock >= bindparam("p_cantidad"))
+            .values(stock=tabla.c.stock - bindparam("p_cantidad"), version=tabla.c.version + 1)
+            .execution_options(claves=list(cantidades)),
+            [{"p_id": producto_id, "p_cantidad": cantidad} for producto_id, cantidad in cantidades.items()]
+        )
+        # Otra terminal pudo vender el mismo producto entre la lectura y el UPDATE
+        if resultado.rowcount != len(cantidades):
+            raise StockInsuficienteError("uno de los productos del carrito")
+        caja = Caja.__table__
+        sesion.execute(
+            update(caja).where(caja.c.id == caja_id)
+            .values(num_ventas=caja.c.num_ventas + 1, total_bruto=caja.c.total_bruto + total)
+            .execution_options(claves=[caja_id])
+        )
+        venta = Venta(total=total, caja_id=caja_id)
+        sesion.add(venta)
+        sesion.flush()
+        # Las claves del detalle se conocen recién con el RETURNING
+        detalle = sesion.scalars(insert(DetalleVenta).returning(DetalleVenta.id).execution_options(claves=()), [
+            {"venta_id": venta.id, "producto_id": item["producto_id"],
+             "cantidad": item["cantidad"], "subtotal": item["subtotal"],
+             "costo": productos[item["producto_id"]].precio_compra * item["cantidad"]}
+            for item in carrito
+        ]).all()
+        marcar_cambio(sesion, DetalleVenta.__tablename__, detalle, "insert")
+        sesion.execute(text(SQL_ACUMULAR_VENTAS_DIARIAS), {"signo": 1, "venta_id": venta.id})
+        marcar_cambio(sesion, VentaDiaria.__tablename__)
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return venta
+
+class VentaNoCancelableError(Exception):
+    def __init__(self, venta_id):
+        super().__init__(f"La venta {venta_id} no existe o ya está cancelada")
+        self.venta_id = venta_id
+
+def reposicion_stock_venta(venta_id):
+    # Devuelve al stock lo vendido en la venta, producto por producto
+    detalle = (
+        select(DetalleVenta.producto_id, func.sum(DetalleVenta.cantidad).label("cantidad"))
+        .where(DetalleVenta.venta_id == venta_id)
+        .group_by(DetalleVenta.producto_id)
+        .subquery()
+    )
+    productos = Producto.__table__
+    return (
+        update(productos).where(productos.c.id == detalle.c.producto_id)
+        .values(stock=productos.c.stock + detalle.c.cantidad, version=productos.c.version + 1)
+        .returning(productos.c.id)
+        .execution_options(claves=())
+    )
+
+@reintentar_bloqueo
+def cancelar_venta(sesion, venta_id, motivo=None):
+    # Una sola transacción: marca la venta (solo si sigue activa, así dos
+    # terminales no la cancelan dos veces), repone el stock de todo el detalle
+    # con un UPDATE ... FROM y deja el registro en ventas_canceladas
+    ventas = Venta.__table__
+    try:
+        escritura(sesion)
+        venta = sesion.execute(
+            update(ventas).where(ventas.c.id == venta_id, ventas.c.estado == VENTA_ACTIVA)
+            .values(estado=VENTA_CANCELADA)
+            .returning(ventas.c.total, ventas.c.caja_id)
+            .execution_options(claves=[venta_id])
+        ).first()
+        if venta is None:
+            raise VentaNoCancelableError(venta_id)
+        repuestos = sesion.scalars(reposicion_stock_venta(venta_id)).all()
+        marcar_cambio(sesion, Producto.__tablename__, repuestos, columnas=("stock", "version"))
+        if venta.caja_id is not None:
+            caja = Caja.__table__
+            # total_ventas solo tiene valor en cajas cerradas; max() con NULL lo deja en NULL
+            sesion.execute(
+                update(caja).where(caja.c.id == venta.caja_id)
+                .values(num_canceladas=caja.c.num_canceladas + 1,
+                        total_cancelado=caja.c.total_cancelado + venta.total,
+                        total_ventas=func.max(caja.c.total_ventas - venta.total, 0))
+                .execution_options(claves=[venta.caja_id])
+            )
+        sesion.execute(text(SQL_ACUMULAR_VENTAS_DIARIAS), {"signo": -1, "venta_id": venta_id})
+        marcar_cambio(sesion, VentaDiaria.__tablename__)
+        sesion.execute(insert(VentaCancelada).values(venta_id=venta_id, motivo=motivo))
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return venta.total
+
+@reintentar_bloqueo
+def reconstruir_ventas_diarias(sesion):
+    try:
+        escritura(sesion)
+        sesion.execute(delete(VentaDiaria))
+        sesion.execute(text(SQL_RECONSTRUIR_VENTAS_DIARIAS), {"signo": 1, "estado": VENTA_ACTIVA})
+        marcar_cambio(sesion, VentaDiaria.__tablename__)
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return sesion.scalar(select(func.count()).select_from(VentaDiaria))
+
+def consulta_resumen_ventas(desde=None, hasta=None, caja_id=None):
+    # Totales por producto desde ventas_diarias, sin recorrer el detalle de ventas.
+    # desde y hasta son fechas inclusivas.
+    consulta = (
+        select(Producto.nombre, func.sum(VentaDiaria.cantidad),
+               func.sum(VentaDiaria.ingreso), func.sum(VentaDiaria.costo))
+        .join(Producto, Producto.id == VentaDiaria.producto_id)
+        .group_by(VentaDiaria.producto_id, Producto.nombre)
+        .having(func.sum(VentaDiaria.cantidad) != 0)
+        .order_by(Producto.nombre)
+    )
+    if desde:
+        consulta = consulta.where(VentaDiaria.fecha >= desde)
+    if hasta:
+        consulta = consulta.where(VentaDiaria.fecha <= hasta)
+    if caja_id:
+        consulta = consulta.where(VentaDiaria.caja_id == caja_id)
+    return consulta
+
+def resumen_ventas(sesion, desde=None, hasta=None, caja_id=None):
+    return sesion.execute(consulta_resumen_ventas(desde, hasta, caja_id)).all()
+
+def totales_ventas(sesion, *condiciones):
+    # Cantidad, suma y ticket promedio de las ventas activas que cumplen las condiciones
+    return sesion.execute(
+        select(func.count(Venta.id), func.coalesce(func.sum(Venta.total), 0), func.avg(Venta.total))
+        .where(Venta.estado == VENTA_ACTIVA, *[c for c in condiciones if c is not None])
+    ).one()
+
+def total_neto_caja(caja):
+    return (caja.total_bruto or 0) - (caja.total_cancelado or 0)
+
+def conciliar_caja(sesion, caja_id):
+    # Recalcula los acumulados desde las ventas y devuelve las diferencias
+    # como {campo: (acumulado, calculado)}; solo lee, corregir_caja escribe
+    caja = sesion.get(Caja, caja_id)
+    if caja is None:
+        raise ValueError(f"No existe la caja {caja_id}")
+    sesion.refresh(caja)
+    cancelada = Venta.estado == VENTA_CANCELADA
+    calculados = sesion.execute(
+        select(func.count(Venta.id),
+               func.count(Venta.id).filter(cancelada),
+               func.coalesce(func.sum(Venta.total), 0),
+               func.coalesce(func.sum(Venta.total).filter(cancelada), 0))
+        .where(Venta.caja_id == caja_id)
+    ).one()
+    diferencias = {}
+    for campo, calculado in zip(("num_ventas", "num_canceladas", "total_bruto", "total_cancelado"), calculados):
+        acumulado = getattr(caja, campo) or 0
+        if round(float(acumulado), 2) != round(float(calculado), 2):
+            diferencias[campo] = (acumulado, calculado)
+    return diferencias
+
+@reintentar_bloqueo
+def corregir_caja(sesion, caja_id):
+    # Vuelve a calcular dentro de la transacción de escritura: una venta de
+    # otra terminal entre la verificación y la corrección no se pisa
+    try:
+        escritura(sesion)
+        diferencias = conciliar_caja(sesion, caja_id)
+        caja = sesion.get(Caja, caja_id)
+        for campo, (_, calculado) in diferencias.items():
+            setattr(caja, campo, calculado)
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return diferencias
+
+class EntradaNoEncontradaError(Exception):
+    def __init__(self, entrada_id):
+        super().__init__(f"La entrada de inventario {entrada_id} no existe")
+        self.entrada_id = entrada_id
+
+class CajaNoAbiertaError(Exception):
+    def __init__(self, caja_id=None):
+        super().__init__("No hay caja abierta." if caja_id is None else f"La caja {caja_id} no existe o ya está cerrada")
+        self.caja_id = caja_id
+
+@reintentar_bloqueo
+def crear_producto(sesion, datos):
+    try:
+        escritura(sesion)
+        producto = Producto(**datos)
+        sesion.add(producto)
+        sesion.flush()
+        producto_id = producto.id
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return producto_id
+
+class ProductoModificadoError(Exception):
+    def __init__(self, producto_id):
+        super().__init__(f"El producto {producto_id} fue modificado o eliminado en otra terminal")
+        self.producto_id = producto_id
+
+@reintentar_bloqueo
+def actualizar_producto(sesion, producto_id, datos, version=None):
+    # Con version, solo escribe si nadie tocó el producto desde que se leyó
+    condiciones = [Producto.id == producto_id]
+    if version is not None:
+        condiciones.append(Producto.version == version)
+    try:
+        escritura(sesion)
+        resultado = sesion.execute(update(Producto).where(*condiciones)
+                                   .values(**datos, version=Producto.version + 1)
+                                   .execution_options(claves=[producto_id]))
+        if resultado.rowcount == 0:
+            raise ProductoModificadoError(producto_id)
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+
+@reintentar_bloqueo
+def eliminar_producto(sesion, producto_id, con_referencias=False):
+    # Sin con_referencias, un producto con ventas o entradas levanta IntegrityError
+    try:
+        escritura(sesion)
+        if con_referencias:
+            sesion.execute(delete(InventarioEntry).where(InventarioEntry.producto_id == producto_id))
+            sesion.execute(delete(DetalleVenta).where(DetalleVenta.producto_id == producto_id))
+        sesion.execute(delete(Producto).where(Producto.id == producto_id)
+                       .execution_options(claves=[producto_id]))
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+
+@reintentar_bloqueo
+def registrar_entrada_inventario(sesion, producto_id, cantidad):
+    try:
+        escritura(sesion)
+        sesion.execute(
+            update(Producto).where(Producto.id == producto_id)
+            .values(stock=Producto.stock + cantidad, version=Producto.version + 1)
+            .execution_options(claves=[producto_id])
+        )
+        entrada = InventarioEntry(producto_id=producto_id, cantidad=cantidad, fecha_ingreso=datetime.now())
+        sesion.add(entrada)
+        sesion.flush()
+        entrada_id = entrada.id
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return entrada_id
+
+@reintentar_bloqueo
+def modificar_entrada_inventario(sesion, entrada_id, cantidad):
+    # La diferencia se toma de la cantidad vigente, no de la que vio el usuario
+    try:
+        escritura(sesion)
+        entrada = sesion.get(InventarioEntry, entrada_id)
+        if entrada is None:
+            raise EntradaNoEncontradaError(entrada_id)
+        diferencia = cantidad - entrada.cantidad
+        entrada.cantidad = cantidad
+        sesion.execute(
+            update(Producto).where(Producto.id == entrada.producto_id)
+            .values(stock=Producto.stock + diferencia, version=Producto.version + 1)
+            .execution_options(claves=[entrada.producto_id])
+        )
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+
+@reintentar_bloqueo
+def eliminar_entrada_inventario(sesion, entrada_id):
+    try:
+        escritura(sesion)
+        entrada = sesion.execute(
+            delete(InventarioEntry).where(InventarioEntry.id == entrada_id)
+            .returning(InventarioEntry.producto_id, InventarioEntry.cantidad)
+            .execution_options(claves=[entrada_id])
+        ).first()
+        if entrada is None:
+            raise EntradaNoEncontradaError(entrada_id)
+        sesion.execute(
+            update(Producto).where(Producto.id == entrada.producto_id)
+            .values(stock=Producto.stock - entrada.cantidad, version=Producto.version + 1)
+            .execution_options(claves=[entrada.producto_id])
+        )
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+
+def caja_abierta(sesion):
+    return sesion.scalars(select(Caja).where(Caja.fecha_cierre.is_(None)).limit(1)).first()
+
+@reintentar_bloqueo
+def abrir_caja(sesion, monto_apertura):
+    try:
+        escritura(sesion)
+        caja = Caja(monto_apertura=monto_apertura)
+        sesion.add(caja)
+        sesion.flush()
+        caja_id = caja.id
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return caja_id
+
+@reintentar_bloqueo
+def cerrar_caja(sesion, caja_id, monto_cierre=None):
+    # Los acumulados se actualizan en cada venta: cerrar no recorre las ventas del turno.
+    # Sin monto de cierre se asume apertura más ventas netas.
+    try:
+        escritura(sesion)
+        caja = sesion.get(Caja, caja_id)
+        if caja is None or caja.fecha_cierre is not None:
+            raise CajaNoAbiertaError(caja_id)
+        total = total_neto_caja(caja)
+        if monto_cierre is None:
+            monto_cierre = float(caja.monto_apertura) + float(total)
+        caja.total_ventas = total
+        caja.fecha_cierre = datetime.now()
+        caja.monto_cierre = monto_cierre
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    return total, monto_cierre
+
+# Importación masiva de productos y stock desde CSV o XLSX. El archivo se lee
+# por lotes: cada lote es un upsert por código de barras y el alta de sus
+# entradas de inventario, todo en una sola transacción. Las filas inválidas
+# se informan y se saltean sin frenar la carga.
+LOTE_IMPORTACION = 1000
+CAMPOS_PRODUCTO_IMPORTACION = ("nombre", "descripcion", "precio_compra", "precio_venta", "categoria", "fecha_vencimiento")
+ALIAS_IMPORTACION = {
+    "codigo": "codigo_barras", "codigo_de_barras": "codigo_barras", "ean": "codigo_barras",
+    "producto": "nombre", "costo": "precio_compra", "precio": "precio_venta",
+    "vencimiento": "fecha_vencimiento", "stock": "cantidad", "unidades": "cantidad",
+}
+
+class ResultadoImportacion:
+    def __init__(self):
+        self.filas = 0
+        self.creados = 0
+        self.actualizados = 0
+        self.entradas = 0
+        self.errores = []
+
+def columna_importacion(encabezado):
+    texto = unicodedata.normalize("NFKD", str(encabezado or "")).encode("ascii", "ignore").decode()
+    texto = re.sub(r"\W+", "_", texto.strip().lower()).strip("_")
+    return ALIAS_IMPORTACION.get(texto, texto)
+
+def leer_filas_importacion(ruta):
+    # Genera (número de línea, {columna: valor}) sin cargar el archivo entero
+    if ruta.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+        libro = load_workbook(ruta, read_only=True, data_only=True)
+        try:
+            filas = libro.active.iter_rows(values_only=True)
+            columnas = [columna_importacion(c) for c in next(filas, ())]
+            if "codigo_barras" not in columnas:
+                raise ValueError("El archivo no tiene una columna codigo_barras")
+            for numero, fila in enumerate(filas, start=2):
+                if any(valor not in (None, "") for valor in fila):
+                    yield numero, dict(zip(columnas, fila))
+        finally:
+            libro.close()
+        return
+    with open(ruta, newline="", encoding="utf-8-sig") as f:
+        try:
+            dialecto = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        f.seek(0)
+        lector = csv.reader(f, dialecto)
+        columnas = [columna_importacion(c) for c in next(lector, [])]
+        if "codigo_barras" not in columnas:
+            raise ValueError("El archivo no tiene una columna codigo_barras")
+        for fila in lector:
+            if any(valor.strip() for valor in fila):
+                yield lector.line_num, dict(zip(columnas, fila))
+
+def _texto_importacion(valor, campo, largo=None):
+    # Las celdas numéricas de una planilla llegan como float: 7790001.0 -> "7790001"
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = str(valor).strip() if valor is not None else ""
+    if largo and len(texto) > largo:
+        raise ValueError(f"{campo} supera los {largo} caracteres")
+    return texto or None
+
+def _monto_importacion(valor, campo):
+    texto = _texto_importacion(valor, campo)
+    if texto is None:
+        return None
+    try:
+        monto = Decimal(texto.replace(",", "."))
+    except InvalidOperation:
+        raise ValueError(f"{campo} no es un número: {texto}")
+    if not monto.is_finite() or monto < 0:
+        raise ValueError(f"{campo} debe ser un número positivo: {texto}")
+    return monto.quantize(Decimal("0.01"))
+
+def _fecha_importacion(valor, campo):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    texto = _texto_importacion(valor, campo)
+    if texto is None:
+        return None
+    for formato in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(texto, formato).date()
+        except ValueError:
+            pass
+    raise ValueError(f"{campo} no es una fecha AAAA-MM-DD o DD/MM/AAAA: {texto}")
+
+def validar_fila_importacion(fila, existentes):
+    codigo = _texto_importacion(fila.get("codigo_barras"), "codigo_barras", 50)
+    if codigo is None:
+        raise ValueError("Falta el código de barras")
+    datos = {
+        "codigo_barras": codigo,
+        "nombre": _texto_importacion(fila.get("nombre"), "nombre", 255),
+        "descripcion": _texto_importacion(fila.get("descripcion"), "descripcion"),
+        "precio_compra": _monto_importacion(fila.get("precio_compra"), "precio_compra"),
+        "precio_venta": _monto_importacion(fila.get("precio_venta"), "precio_venta"),
+        "categoria": _texto_importacion(fila.get("categoria"), "categoria", 100),
+        "fecha_vencimiento": _fecha_importacion(fila.get("fecha_vencimiento"), "fecha_vencimiento"),
+    }
+    cantidad = _monto_importacion(fila.get("cantidad"), "cantidad") or 0
+    if cantidad != int(cantidad):
+        raise ValueError(f"cantidad debe ser un entero: {cantidad}")
+    datos["cantidad"] = int(cantidad)
+    # Un producto existente solo cambia en las columnas que trae la fila
+    if codigo not in existentes:
+        faltantes = [campo for campo in ("nombre", "precio_compra", "precio_venta") if datos[campo] is None]
+        if faltantes:
+            raise ValueError(f"Producto nuevo sin {', '.join(faltantes)}")
+    return datos
+
+def _importar_lote(sesion, lote, resultado):
+    codigos = set()
+    for _, fila in lote:
+        try:
+            codigos.add(_texto_importacion(fila.get("codigo_barras"), "codigo_barras"))
+        except ValueError:
+            pass
+    existentes = set(sesion.scalars(select(Producto.codigo_barras).where(Producto.codigo_barras.in_(codigos))))
+    nuevos = set()
+    validas = []
+    for numero, fila in lote:
+        resultado.filas += 1
+        try:
+            datos = validar_fila_importacion(fila, existentes | nuevos)
+        except ValueError as e:
+            resultado.errores.append((numero, str(e)))
+            continue
+        if datos["codigo_barras"] in existentes or datos["codigo_barras"] in nuevos:
+            resultado.actualizados += 1
+        else:
+            resultado.creados += 1
+            nuevos.add(datos["codigo_barras"])
+        validas.append(datos)
+    if not validas:
+        return
+    # Un solo INSERT ... ON CONFLICT por lote y la cantidad se suma al stock.
+    # Las columnas vacías toman el valor actual ya en el VALUES: SQLite valida
+    # NOT NULL sobre la fila candidata antes de resolver el conflicto
+    tabla = Producto.__table__
+    codigo = bindparam("p_codigo_barras")
+    upsert = insert_sqlite(tabla).values(
+        codigo_barras=codigo, stock=bindparam("p_cantidad"),
+        **{campo: func.coalesce(bindparam(f"p_{campo}", type_=tabla.c[campo].type),
+                                select(tabla.c[campo]).where(tabla.c.codigo_barras == codigo).scalar_subquery())
+           for campo in CAMPOS_PRODUCTO_IMPORTACION},
+    )
+    upsert = upsert.on_conflict_do_update(index_elements=[tabla.c.codigo_barras], set_={
+        **{campo: upsert.excluded[campo] for campo in CAMPOS_PRODUCTO_IMPORTACION},
+        "stock": tabla.c.stock + upsert.excluded.stock,
+        "version": tabla.c.version + 1,
+    })
+    sesion.execute(upsert.execution_options(claves=()), [
+        {"p_codigo_barras": d["codigo_barras"], "p_cantidad": d["cantidad"],
+         **{f"p_{campo}": d[campo] for campo in CAMPOS_PRODUCTO_IMPORTACION}}
+        for d in validas
+    ])
+    ids = dict(sesion.execute(
+        select(Producto.codigo_barras, Producto.id)
+        .where(Producto.codigo_barras.in_({d["codigo_barras"] for d in validas}))
+    ).all())
+    marcar_cambio(sesion, Producto.__tablename__, [ids[c] for c in nuevos], "insert")
+    marcar_cambio(sesion, Producto.__tablename__, [i for c, i in ids.items() if c not in nuevos])
+    ahora = datetime.now()
+    entradas = [{"producto_id": ids[d["codigo_barras"]], "cantidad": d["cantidad"], "fecha_ingreso": ahora}
+                for d in validas if d["cantidad"]]
+    if entradas:
+        claves = sesion.scalars(
+            insert(InventarioEntry).returning(InventarioEntry.id).execution_options(claves=()), entradas
+        ).all()
+        marcar_cambio(sesion, InventarioEntry.__tablename__, claves, "insert")
+        resultado.entradas += len(claves)
+
+@reintentar_bloqueo
+def importar_productos(sesion, ruta, progreso=None, cancelado=None):
+    resultado = ResultadoImportacion()
+    filas = leer_filas_importacion(ruta)
+    try:
+        escritura(sesion)
+        for lote in iter(lambda: list(islice(filas, LOTE_IMPORTACION)), []):
+            _importar_lote(sesion, lote, resultado)
+            if progreso:
+                progreso(resultado.filas)
+            if cancelado and cancelado():
+                raise RuntimeError("Importación cancelada")
+        sesion.commit()
+    except Exception:
+        sesion.rollback()
+        raise
+    finally:
+        filas.close()
+    return resultado
+
+# Datos del reporte de una caja: resumen, detalle y totales por producto se
+# arman una vez y los comparten la previsualización y la exportación
+COLUMNAS_DETALLE_REPORTE = ["Venta ID", "Fecha Venta", "Producto", "Cantidad", "Precio Venta", "Subtotal"]
+COLUMNAS_PRODUCTOS_REPORTE = ["Producto", "Cantidad Total", "Total Ventas", "Costo Total"]
+
+class DatosReporteCaja:
+    def __init__(self, version, resumen, detalle, productos):
+        self.version = version
+        self.resumen = resumen
+        self.detalle = detalle
+        self.productos = productos
+
+def version_caja(sesion, caja_id):
+    # Cambia con cada venta, cancelación y con el cierre, también si ocurren en otra terminal
+    return tuple(sesion.execute(
+        select(Caja.num_ventas, Caja.num_canceladas, Caja.fecha_cierre).where(Caja.id == caja_id)
+    ).one())
+
+TAMANO_LOTE_REPORTE = 5000
+
+def resumen_caja(caja):
+    total_ventas = float(caja.total_ventas) if caja.total_ventas else 0.0
+    return {
+        "Caja ID": caja.id,
+        "Fecha Apertura": caja.fecha_apertura.strftime("%Y-%m-%d %H:%M:%S"),
+        "Monto Apertura": float(caja.monto_apertura),
+        "Fecha Cierre": caja.fecha_cierre.strftime("%Y-%m-%d %H:%M:%S") if caja.fecha_cierre else "Caja abierta",
+        "Monto Cierre": float(caja.monto_cierre) if caja.monto_cierre is not None else 0.0,
+        "Total Ventas": total_ventas,
+        "Saldo Final": float(caja.monto_apertura) + total_ventas,
+    }
+
+def consulta_detalle_reporte(caja_id=None, desde=None, hasta=None):
+    consulta = (
+        select(Venta.id, Venta.fecha, Producto.nombre, DetalleVenta.cantidad,
+               Producto.precio_venta, DetalleVenta.subtotal)
+        .join(DetalleVenta, Venta.id == DetalleVenta.venta_id)
+        .join(Producto, Producto.id == DetalleVenta.producto_id)
+        .where(Venta.estado == VENTA_ACTIVA)
+    )
+    # Fecha e id dan el mismo orden (los ids se asignan al cobrar); se ordena
+    # por el que sigue el índice que se usa, así SQLite lo recorre en orden y no
+    # arma un B-tree temporal con todas las filas
+    if caja_id:
+        consulta = consulta.where(Venta.caja_id == caja_id).order_by(Venta.id)
+    else:
+        consulta = consulta.order_by(Venta.fecha, Venta.id)
+    if desde:
+        consulta = consulta.where(Venta.fecha >= datetime.combine(desde, datetime.min.time()))
+    if hasta:
+        consulta = consulta.where(Venta.fecha < datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+    return consulta
+
+def filas_detalle_reporte(sesion, caja_id=None, desde=None, hasta=None):
+    # Generador: las filas se leen del cursor por lotes, nunca todas juntas
+    resultado = sesion.execute(consulta_detalle_reporte(caja_id, desde, hasta),
+                               execution_options={"yield_per": TAMANO_LOTE_REPORTE})
+    for venta_id, fecha, nombre, cantidad, precio, subtotal in resultado:
+        yield venta_id, fecha.strftime("%Y-%m-%d %H:%M:%S"), nombre, cantidad, float(precio), float(subtotal)
+
+def filas_productos_reporte(sesion, caja_id=None, desde=None, hasta=None):
+    return [
+        (nombre, cantidad, float(ingreso), float(costo))
+        for nombre, cantidad, ingreso, costo in resumen_ventas(sesion, desde, hasta, caja_id)
+    ]
+
+def construir_datos_reporte(sesion, caja_id):
+    version = version_caja(sesion, caja_id)
+    return DatosReporteCaja(
+        version,
+        resumen_caja(sesion.get(Caja, caja_id)),
+        list(filas_detalle_reporte(sesion, caja_id)),
+        filas_productos_reporte(sesion, caja_id),
+    )
+
+class CacheReportes:
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self._datos = OrderedDict()
+
+    def obtener(self, caja_id):
+        # Las cajas cerradas no cambian (salvo una cancelación, que cambia la
+        # versión) y quedan en caché hasta que las desplace el LRU
+        sesion = SessionLocal()
+        try:
+            datos = self._datos.get(caja_id)
+            if datos is None or datos.version != version_caja(sesion, caja_id):
+                datos = construir_datos_reporte(sesion, caja_id)
+                self._datos[caja_id] = datos
+            self._datos.move_to_end(caja_id)
+            while len(self._datos) > self.capacidad:
+                self._datos.popitem(last=False)
+            return datos
+        finally:
+            sesion.close()
+
+    def invalidar(self, caja_id=None):
+        if caja_id is None:
+            self._datos.clear()
+        else:
+            self._datos.pop(caja_id, None)
+
+    def aplicar_cambio(self, cambio):
+        # Ventas, cancelaciones y cierres actualizan la fila de su caja
+        if cambio.claves is None:
+            self.invalidar()
+        else:
+            for caja_id in cambio.claves:
+                self.invalidar(caja_id)
+
+cache_reportes = CacheReportes(int(config_valor("cache_reportes", 16)))
+registro_cambios.suscribir(cache_reportes.aplicar_cambio, Caja.__tablename__)
+
+# Escritores de reportes: cada hoja recibe un iterable de filas y lo vuelca al
+# archivo a medida que lo recorre, así el tamaño del reporte no limita la memoria
+class EscritorReporte(ABC):
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.rutas = []
+
+    def ruta_hoja(self, nombre, extension):
+        # Formatos sin hojas: un archivo por hoja, reporte.csv -> reporte_detalle_ventas.csv
+        sufijo = re.sub(r"\W+", "_", nombre.lower()).strip("_")
+        return f"{os.path.splitext(self.ruta)[0]}_{sufijo}{extension}"
+
+    @abstractmethod
+    def hoja(self, nombre, columnas, filas):
+        pass
+
+    def cerrar(self):
+        pass
+
+    def descartar(self):
+        for ruta in self.rutas:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        # No dejar archivos a medio escribir que parezcan un reporte válido
+        if tipo is None:
+            try:
+                self.cerrar()
+                return False
+            except Exception:
+                self.descartar()
+                raise
+        self.descartar()
+        return False
+
+class EscritorReporteXlsx(EscritorReporte):
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        from openpyxl import Workbook
+        # write_only: openpyxl pasa cada fila a un temporal en disco en vez de
+        # mantener todas las celdas del libro en memoria
+        self.libro = Workbook(write_only=True)
+
+    def hoja(self, nombre, columnas, filas):
+        hoja = self.libro.create_sheet(nombre[:31])
+        hoja.append(columnas)
+        for fila in filas:
+            hoja.append(fila)
+
+    def cerrar(self):
+        self.rutas.append(self.ruta)
+        self.libro.save(self.ruta)
+
+class EscritorReporteCsv(EscritorReporte):
+    def hoja(self, nombre, columnas, filas):
+        ruta = self.ruta_hoja(nombre, ".csv")
+        self.rutas.append(ruta)
+        with open(ruta, "w", newline="", encoding="utf-8") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(columnas)
+            escritor.writerows(filas)
+
+class EscritorReporteParquet(EscritorReporte):
+    def __init__(self, ruta):
+        super().__init__(ruta)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Los reportes Parquet requieren el paquete pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+    def hoja(self, nombre, columnas, filas):
+        ruta = self.ruta_hoja(nombre, ".parquet")
+        self.rutas.append(ruta)
+        filas = iter(filas)
+        escritor = None
+        try:
+            # Un grupo de filas por lote; el esquema sale del primer lote
+            while lote := list(islice(filas, TAMANO_LOTE_REPORTE)):
+                valores = list(zip(*lote))
+                if escritor is None:
+                    tabla = self.pa.Table.from_arrays([self.pa.array(v) for v in valores], names=columnas)
+                    escritor = self.pq.ParquetWriter(ruta, tabla.schema)
+                else:
+                    tabla = self.pa.Table.from_arrays(
+                        [self.pa.array(v, type=campo.type) for v, campo in zip(valores, escritor.schema)],
+                        schema=escritor.schema
+                    )
+                escritor.write_table(tabla)
+        finally:
+            if escritor is not None:
+                escritor.close()
+        if escritor is None:
+            self.pq.write_table(self.pa.table({columna: [] for columna in columnas}), ruta)
+
+FORMATOS_REPORTE = {
+    ".xlsx": EscritorReporteXlsx,
+    ".csv": EscritorReporteCsv,
+    ".parquet": EscritorReporteParquet,
+}
+
+def abrir_escritor_reporte(ruta):
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension not in FORMATOS_REPORTE:
+        raise ValueError(f"Formato de reporte no soportado: {extension or ruta}")
+    return FORMATOS_REPORTE[extension](ruta)
+
+def escribir_reporte_caja(ruta, datos):
+    with abrir_escritor_reporte(ruta) as escritor:
+        escritor.hoja("Resumen Caja", list(datos.resumen), [tuple(datos.resumen.values())])
+        escritor.hoja("Detalle Ventas", COLUMNAS_DETALLE_REPORTE, datos.detalle)
+        escritor.hoja("Productos Vendidos", COLUMNAS_PRODUCTOS_REPORTE, datos.productos)
+    return escritor.rutas
+
+def escribir_reporte_ventas(ruta, caja_id=None, desde=None, hasta=None):
+    # Extractos grandes (un mes, un año): el detalle va del cursor al archivo
+    # sin pasar por la caché de reportes
+    sesion = SessionLocal()
+    try:
+        with abrir_escritor_reporte(ruta) as escritor:
+            if caja_id:
+                caja = sesion.get(Caja, caja_id)
+                if caja is None:
+                    raise ValueError(f"No existe la caja {caja_id}")
+                resumen = resumen_caja(caja)
+                escritor.hoja("Resumen Caja", list(resumen), [tuple(resumen.values())])
+            escritor.hoja("Detalle Ventas", COLUMNAS_DETALLE_REPORTE,
+                          filas_detalle_reporte(sesion, caja_id, desde, hasta))
+            escritor.hoja("Productos Vendidos", COLUMNAS_PRODUCTOS_REPORTE,
+                          filas_productos_reporte(sesion, caja_id, desde, hasta))
+        return escritor.rutas
+    finally:
+        sesion.close()
+
+def ruta_reporte_venta(venta_id, fecha):
+    nombre = config_valor("plantilla_reporte_venta", PLANTILLA_REPORTE_VENTA).format(id=venta_id, fecha=fecha)
+    return os.path.join(config_valor("directorio_reportes", DIRECTORIO_REPORTES), nombre)
+
+def escribir_reporte_venta(venta_id):
+    session = SessionLocal()
+    try:
+        venta = session.get(Venta, venta_id)
+        detalle = session.execute(
+            select(Producto.nombre, DetalleVenta.cantidad, Producto.precio_venta, DetalleVenta.subtotal)
+            .join(Producto, Producto.id == DetalleVenta.producto_id)
+            .where(DetalleVenta.venta_id == venta.id)
+        ).all()
+        productos = session.execute(
+            select(Producto.nombre, func.sum(DetalleVenta.cantidad), func.sum(DetalleVenta.subtotal))
+            .join(Producto, Producto.id == DetalleVenta.producto_id)
+            .where(DetalleVenta.venta_id == venta.id)
+            .group_by(Producto.id, Producto.nombre)
+        ).all()
+        filename = ruta_reporte_venta(venta.id, venta.fecha)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with EscritorReporteXlsx(filename) as escritor:
+            escritor.hoja("Venta", ["Venta ID", "Fecha", "Total"],
+                          [(venta.id, venta.fecha.strftime("%Y-%m-%d %H:%M:%S"), float(venta.total))])
+            escritor.hoja("Detalle Venta", ["Producto", "Cantidad", "Precio Venta", "Subtotal"],
+                          [(nombre, cantidad, float(precio), float(subtotal))
+                           for nombre, cantidad, precio, subtotal in detalle])
+            escritor.hoja("Productos Vendidos", ["Producto", "Cantidad Total", "Total Ventas"],
+                          [(nombre, cantidad, float(total)) for nombre, cantidad, total in productos])
+        return filename
+    finally:
+        session.close()
+
+# Exportación de la base en streaming: las filas se leen por lotes con
+# yield_per y se escriben a medida que llegan, sin armar todo en memoria
+MODELOS_EXPORTACION = [Producto, InventarioEntry, Venta, DetalleVenta, Caja, VentaCancelada]
+TAMANO_LOTE_EXPORTACION = 2000
+
+def formato_desde_nombre(ruta):
+    nombre = ruta.lower()
+    compresion = None
+    if nombre.endswith(".gz"):
+        compresion = "gzip"
+        nombre = nombre[:-3]
+    elif nombre.endswith(".zst"):
+        compresion = "zstd"
+        nombre = nombre[:-4]
+    formato = "json" if nombre.endswith(".json") else "ndjson"
+    return formato, compresion
+
+def abrir_salida(ruta, compresion):
+    if compresion == "gzip":
+        return gzip.open(ruta, "wt", encoding="utf-8")
+    if compresion == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("La compresión zstd requiere el paquete zstandard")
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(ruta, "wb")), encoding="utf-8")
+    if compresion:
+        raise ValueError(f"Compresión desconocida: {compresion}")
+    return open(ruta, "w", encoding="utf-8")
+
+def exportar_base_datos(ruta, formato="ndjson", compresion=None, progreso=None, cancelado=None):
+    if formato not in ("ndjson", "json"):
+        raise ValueError(f"Formato desconocido: {formato}")
+    with engine.connect() as conn:
+        tablas = [modelo.__table__ for modelo in MODELOS_EXPORTACION]
+        total = sum(conn.execute(select(func.count()).select_from(tabla)).scalar() for tabla in tablas)
+        try:
+            with abrir_salida(ruta, compresion) as f:
+                escribir_exportacion(conn, f, tablas, formato, total, progreso, cancelado)
+        except Exception:
+            # No dejar un archivo a medio escribir que parezca una exportación válida
+            if os.path.exists(ruta):
+                os.remove(ruta)
+            raise
+    return total
+
+def escribir_exportacion(conn, f, tablas, formato, total, progreso, cancelado):
+    procesadas = 0
+    if formato == "json":
+        f.write("{")
+    for n, tabla in enumerate(tablas):
+        if formato == "json":
+            f.write(f'{"," if n else ""}\n{json.dumps(tabla.name)}: [')
+        resultado = conn.execution_options(yield_per=TAMANO_LOTE_EXPORTACION).execute(select(tabla))
+        primera = True
+        for lote in resultado.partitions():
+            for fila in lote:
+                datos = json.dumps(dict(fila._mapping), default=str, ensure_ascii=False)
+                if formato == "json":
+                    f.write(datos if primera else "," + datos)
+                    primera = False
+                else:
+                    f.write(f'{{"tabla": {json.dumps(tabla.name)}, "fila": {datos}}}\n')
+            procesadas += len(lote)
+            if progreso:
+                progreso(procesadas, total)
+            if cancelado and cancelado():
+                resultado.close()
+                raise RuntimeError("Exportación cancelada")
+        if formato == "json":
+            f.write("]")
+    if formato == "json":
+        f.write("\n}\n")